@@ -5,11 +5,12 @@ import argparse
 import daemon
 from daemon import pidlockfile as pidfile
 
-def runSwitch(switch_type, host, port, statusfile):
+def runSwitch(switch_type, host, port, statusfile, seed=None, notify=None):
     # Don't import anything playground or asyncio related until after the fork.
     from playground.network.devices import Switch, UnreliableSwitch
     from playground.network.protocols.spmp import SPMPServerProtocol, FramedProtocolAdapter
     from playground.common.logging import EnablePresetLogging, PRESET_NONE, PRESET_DEBUG, PRESET_LEVELS 
+    from playground.common.os import notifyReady, FAILED
     import asyncio, logging
     
     try:
@@ -43,7 +44,13 @@ def runSwitch(switch_type, host, port, statusfile):
                                 "get-error-rate"        :(lambda    : "Errors per Bytes = {}".format(self.getErrorRate())),
                                 "set-error-rate"        :(lambda rate, horizon: self.setErrorRate(int(rate), int(horizon))),
                                 "get-delay-rate"        :(lambda    : "Every {} packets, delay {} second".format(*self.getDelayRate())),
-                                "set-delay-rate"        :(lambda rate, delay: self.setDelayRate(int(rate), float(delay)))
+                                "set-delay-rate"        :(lambda rate, delay: self.setDelayRate(float(rate), float(delay))),
+                                "get-seed"              :(lambda    : str(self.getSeed())),
+                                "set-seed"              :(lambda seed: self.setSeed(int(seed))),
+                                "get-impairment"        :(lambda address="default": self.getImpairment(address)),
+                                "set-impairment"        :(lambda address, setting, value: self.setImpairment(address, setting, value)),
+                                "clear-impairment"      :(lambda address: self.clearImpairment(address)),
+                                "get-link-stats"        :(lambda    : str(self.getLinkStats()))
                         })
                     
             def ProtocolFactory(self):
@@ -52,7 +59,10 @@ def runSwitch(switch_type, host, port, statusfile):
                 spmpServerProtocol = SPMPServerProtocol(self, self.SPMPApi)
                 framedProtocol = FramedProtocolAdapter(spmpServerProtocol, originalProtocol)
                 return framedProtocol
-        switch = SPMPSwitch()
+        switchArgs = {}
+        if BaseSwitch == UnreliableSwitch:
+            switchArgs["seed"] = seed
+        switch = SPMPSwitch(**switchArgs)
         
         loop = asyncio.get_event_loop()
         coro = loop.create_server(switch.ProtocolFactory, host=host, port=port, family=socket.AF_INET)
@@ -61,11 +71,14 @@ def runSwitch(switch_type, host, port, statusfile):
         if statusfile:
             with open(statusfile,"w+") as f:
                 f.write("{}".format(servingPort))
+        # tell the launcher (e.g., pnetworking on) that we're serving
+        notifyReady(notify, statusfile)
         logging.getLogger("playground.launch_switch").debug("start run forever on port {}".format(servingPort))
         loop.run_forever()
         server.close()
     except Exception as e:
         logging.getLogger("playground.launch_switch").debug("Launch of switch failed because: {}".format(e))
+        notifyReady(notify, statusfile, FAILED, str(e))
 
 def main():
     parser = argparse.ArgumentParser()
@@ -75,6 +88,8 @@ def main():
     parser.add_argument("--statusfile", help="file to record status; useful for communications")
     parser.add_argument("--pidfile", help="file to record pid; useful for communciations")
     parser.add_argument("--unreliable", action="store_true", default=False, help="Introduce errors on the wire")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for unreliable switch impairments")
+    parser.add_argument("--notify", help="unix datagram socket to signal once serving")
     parser.add_argument("--no-daemon", action="store_true", default=False, help="do not launch switch in a daemon; remain in foreground")
     args = parser.parse_args()
     
@@ -90,7 +105,7 @@ def main():
         switch_type = "unreliable"
     
     if args.no_daemon:
-        runSwitch(switch_type, host, args.port, statusFileName)    
+        runSwitch(switch_type, host, args.port, statusFileName, args.seed, args.notify)    
     else:
         with daemon.DaemonContext(
             working_directory=workingDir,
@@ -98,7 +113,7 @@ def main():
             pidfile=pidfile.TimeoutPIDLockFile(pidFileName),
             ) as context:
             
-            runSwitch(switch_type, host, args.port, statusFileName)
+            runSwitch(switch_type, host, args.port, statusFileName, args.seed, args.notify)
 
 if __name__=="__main__":
     main()
@@ -15,13 +15,16 @@ import daemon
 from daemon import pidlockfile as pidfile
 
             
-def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon):
+def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon, incremental_delivery=False, unix_socket=None,
+            port_range=None, port_reuse_delay=None, max_backlog=None, backlog_pushback=False, coalesce_bytes=None,
+            notify=None):
 
     # normally, all of this would be global. We have it
     # here so it is not messing with the fork!
     from playground.network.devices import VNIC
     from playground.network.protocols.spmp import HiddenSPMPServerProtocol
     from playground.common.logging import EnablePresetLogging, PRESET_NONE, PRESET_DEBUG, PRESET_LEVELS 
+    from playground.common.os import notifyReady, FAILED
     
     import asyncio
     
@@ -53,11 +56,34 @@ def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon)
                             "verbs"                :(lambda    : ", ".join(list(self.SPMPApi.keys()))),
                             "get-promiscuity-level":(lambda    : str(self.promiscuousLevel())),
                             "set-promiscuity-level":(lambda lvl: self.setPromiscuousLevel(int(lvl))),
+                            "get-mtu"              :(lambda    : str(self.mtu())),
+                            "set-mtu"              :(lambda mtu: self.setMtu(int(mtu))),
+                            "get-coalesce-bytes"   :(lambda    : str(self.coalesceBytes() or 0)),
+                            "set-coalesce-bytes"   :(lambda n  : self.setCoalesceBytes(int(n))),
+                            "get-port-stats"       :(lambda    : self.portStats()),
+                            "get-port-reuse-delay" :(lambda    : str(self.portAllocator().reuseDelay())),
+                            "set-port-reuse-delay" :(lambda dly: self.portAllocator().setReuseDelay(float(dly))),
+                            "start-capture"        :(lambda path, *fltr      : self.spmpStartCapture(path, fltr)),
+                            "start-capture-mmap"   :(lambda path, size, *fltr: self.spmpStartCapture(path, fltr, int(size))),
+                            "stop-capture"         :(lambda path: self.stopCapture(os.path.abspath(path))),
+                            "capture-status"       :(lambda    : self.spmpCaptureStatus()),
                             "all-log-levels"       :(lambda    : ", ".join(PRESET_LEVELS)),
                             "get-log-level"        :(lambda    : self._presetLogging),
                             "set-log-level"        :(lambda lvl: self.setLogLevel(lvl)),
                             "switch-live"          :(lambda    : self._spmp_connection_status)
                             }
+        def spmpStartCapture(self, path, filterArgs, mmapSize=None):
+            # the filter may arrive as one argument or one per word
+            self.startCapture(os.path.abspath(path), " ".join(filterArgs) or None, mmapSize)
+            
+        def spmpCaptureStatus(self):
+            status = self.captureStatus()
+            return "\n".join("{}: {}".format(k, status[k]) for k in status)
+            
+        def portStats(self):
+            status = self.portAllocator().status()
+            return ", ".join("{}={}".format(k, status[k]) for k in status)
+            
         def connectionMade(self):
             super().connectionMade()
             self._spmp_connection_status = "Connected"
@@ -75,8 +101,9 @@ def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon)
             return spmpServerProtocol
 
     class StatusManager:
-        def __init__(self, statusfile, port, switchIp, switchPort, vnic):
+        def __init__(self, statusfile, port, switchIp, switchPort, vnic, unixSocket=None):
             self._port = port
+            self._unixSocket = unixSocket
             self._vnic = vnic
             self._statusfile = statusfile
             self._switchIp = switchIp
@@ -92,6 +119,8 @@ def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon)
             #print("{} writing status {} to {}".format(self._port, status, self._statusfile))
             with open(self._statusfile, "w+") as f:
                 f.write("{}\n{}\n{}".format(self._port, ":".join([self._switchIp, self._switchPort]), status))
+                if self._unixSocket:
+                    f.write("\n{}".format(self._unixSocket))
             
         
     class ConnectToSwitchTask:
@@ -137,19 +166,35 @@ def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon)
     
     vnicStatusListeners.reset() # reset listeners
     
-    vnic = StatusVnic(vnic_address)
+    vnic = StatusVnic(vnic_address, incrementalDelivery=incremental_delivery, 
+                      portRange=port_range, portReuseDelay=port_reuse_delay,
+                      maxBacklog=max_backlog, backlogPushback=backlog_pushback,
+                      coalesceBytes=coalesce_bytes)
     
     # Connection to the switch is optional. That is, the VNIC should be
     # up and "operating" even if it can't connect to the switch. So
     # start the server first.    
     coro = loop.create_server(vnic.controlConnectionFactory, host="127.0.0.1", port=port)
 
-    server = loop.run_until_complete(coro)
-    servingPort = server.sockets[0].getsockname()[1]
+    try:
+        server = loop.run_until_complete(coro)
+        servingPort = server.sockets[0].getsockname()[1]
+        
+        # Local applications can also use a unix domain socket
+        unixServer = None
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            unixServer = loop.run_until_complete(loop.create_unix_server(vnic.controlConnectionFactory, path=unix_socket))
+    except Exception as e:
+        notifyReady(notify, statusfile, FAILED, str(e))
+        raise
     
-    statusManager = StatusManager(statusfile, servingPort, switch_address, switch_port, vnic)
+    statusManager = StatusManager(statusfile, servingPort, switch_address, switch_port, vnic, unix_socket)
     vnicStatusListeners.listeners.add(statusManager)
     statusManager.writeStatus("Disconnected")
+    # serving. Tell the launcher (e.g., pnetworking on); the switch connection can come later.
+    notifyReady(notify, statusfile)
     
     switchConnector = ConnectToSwitchTask(vnic, switch_address, switch_port)
     vnicStatusListeners.listeners.add(switchConnector)
@@ -159,6 +204,9 @@ def runVnic(vnic_address, port, statusfile, switch_address, switch_port, daemon)
     loop.run_forever()
     logger.info("Server Close")
     server.close()
+    if unixServer:
+        unixServer.close()
+        os.path.exists(unix_socket) and os.unlink(unix_socket)
     loop.close()
 
 
@@ -171,16 +219,27 @@ def main():
     parser.add_argument("--port", type=int, default=0, help="TCP port for serving VNIC connections")
     parser.add_argument("--statusfile", help="file to record status; useful for communications")
     parser.add_argument("--pidfile", help="file to record pid; useful for communciations")
+    parser.add_argument("--unix-socket", help="also serve VNIC connections on this unix domain socket path")
+    parser.add_argument("--incremental-delivery", action="store_true", default=False, help="deliver large messages as they arrive instead of after reassembly")
+    parser.add_argument("--port-range", help="ephemeral port range for outbound connections, as START-END (END exclusive)")
+    parser.add_argument("--port-reuse-delay", type=float, help="seconds a closed port waits before it is reused")
+    parser.add_argument("--max-backlog", type=int, help="bytes held per connection until the application connects")
+    parser.add_argument("--backlog-pushback", action="store_true", default=False, help="pause the switch link instead of dropping when a backlog is full")
+    parser.add_argument("--coalesce-bytes", type=int, help="merge small writes to a connection within a loop iteration, up to this many bytes")
+    parser.add_argument("--notify", help="unix datagram socket to signal once serving")
     parser.add_argument("--no-daemon", action="store_true", default=False, help="do not launch VNIC in a daemon; remain in foreground")
     args = parser.parse_args()
    
     workingDir = os.path.expanduser(os.path.expandvars(args.working_directory))
     pidFileName = os.path.expanduser(os.path.expandvars(args.pidfile))
     statusFileName = os.path.expanduser(os.path.expandvars(args.statusfile))
+    portRange = args.port_range and tuple(int(p) for p in args.port_range.split("-"))
     pidFileDir = os.path.dirname(pidFileName)
     
     if args.no_daemon:
-        runVnic(args.vnic_address, args.port, statusFileName, args.switch_address, args.switch_port, False)
+        runVnic(args.vnic_address, args.port, statusFileName, args.switch_address, args.switch_port, False, args.incremental_delivery, args.unix_socket,
+                portRange, args.port_reuse_delay, args.max_backlog, args.backlog_pushback,
+                args.coalesce_bytes, args.notify)
     
     else:
         with daemon.DaemonContext(
@@ -189,7 +248,9 @@ def main():
             pidfile=pidfile.TimeoutPIDLockFile(pidFileName),
             ) as context:
             
-            runVnic(args.vnic_address, args.port, statusFileName, args.switch_address, args.switch_port, True)
+            runVnic(args.vnic_address, args.port, statusFileName, args.switch_address, args.switch_port, True, args.incremental_delivery, args.unix_socket,
+                    portRange, args.port_reuse_delay, args.max_backlog, args.backlog_pushback,
+                    args.coalesce_bytes, args.notify)
 
 if __name__=="__main__":
     main()
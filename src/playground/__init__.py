@@ -25,15 +25,30 @@ logging_control.EnablePresetLogging(logging_control.PRESET_NONE)
 # set up
 
 # 5.
-# Configure connectors
-from .network.devices.vnic import connect
-reloadConnectors = connect.ConnectorService.reloadConnectors
-setConnector = connect.ConnectorService.setConnector
-getConnector = connect.ConnectorService.getConnector
-create_server = connect.create_server
-create_connection = connect.create_connection
-Connector    = connect.PlaygroundConnector
-Configure.CONFIG_MODULES.append(connect.ConnectorService)
+# Configure connectors. The connect module pulls in the VNIC, PNMS,
+# and packet code, so it is imported on first use of these names
+# rather than by "import playground".
+_CONNECT_NAMES = {
+    "connect":           (),
+    "reloadConnectors":  ("ConnectorService", "reloadConnectors"),
+    "setConnector":      ("ConnectorService", "setConnector"),
+    "getConnector":      ("ConnectorService", "getConnector"),
+    "create_server":     ("create_server",),
+    "create_connection": ("create_connection",),
+    "Connector":         ("PlaygroundConnector",),
+}
+
+def __getattr__(name):
+    if name not in _CONNECT_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    from .network.devices.vnic import connect
+    value = connect
+    for attribute in _CONNECT_NAMES[name]:
+        value = getattr(value, attribute)
+    globals()[name] = value
+    return value
+    
+Configure.CONFIG_MODULES.append("playground.network.devices.vnic.connect:ConnectorService")
 
 
 
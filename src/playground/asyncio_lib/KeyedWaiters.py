@@ -0,0 +1,88 @@
+import asyncio
+
+class KeyedWaiters:
+    """
+    Waiters keyed by what they wait for (a connection id, a request id,
+    a protocol). Each wait gets its own future, and resolve(key, value)
+    sets the result of that key's futures directly: no task is scheduled
+    and waiters on other keys aren't woken.
+
+    A waiter can pass a predicate on the resolved value (e.g., "at least
+    n connections"). Waiters whose predicate isn't satisfied keep waiting
+    for the next resolve of their key.
+    """
+    def __init__(self):
+        self._waiters = {} # key -> [(predicate, future)]
+
+    def wait(self, key, predicate=None):
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(key, []).append((predicate, future))
+        # a cancelled (e.g., timed out) waiter shouldn't stay registered
+        future.add_done_callback(lambda f: f.cancelled() and self._forget(key, f))
+        return future
+
+    def waiting(self, key):
+        return key in self._waiters
+
+    def resolve(self, key, value=None):
+        """
+        Returns the number of waiters resolved.
+        """
+        waiters = self._waiters.pop(key, None)
+        if not waiters: return 0
+        stillWaiting = []
+        resolved = 0
+        for predicate, future in waiters:
+            if future.done(): continue
+            if predicate is None or predicate(value):
+                future.set_result(value)
+                resolved += 1
+            else:
+                stillWaiting.append((predicate, future))
+        if stillWaiting:
+            self._waiters[key] = stillWaiting
+        return resolved
+
+    def fail(self, key, exception):
+        for predicate, future in self._waiters.pop(key, []):
+            if not future.done():
+                future.set_exception(exception)
+
+    def _forget(self, key, future):
+        waiters = [waiter for waiter in self._waiters.get(key, []) if waiter[1] is not future]
+        if waiters:
+            self._waiters[key] = waiters
+        else:
+            self._waiters.pop(key, None)
+
+def basicUnitTest():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    waiters = KeyedWaiters()
+
+    one = waiters.wait("a")
+    two = waiters.wait("a", lambda value: value >= 2)
+    other = waiters.wait("b")
+    assert waiters.resolve("a", 1) == 1
+    assert one.result() == 1
+    assert not two.done() and not other.done()
+    assert waiters.resolve("a", 2) == 1
+    assert two.result() == 2
+    assert not waiters.waiting("a") and waiters.waiting("b")
+    assert waiters.resolve("a", 3) == 0
+
+    waiters.fail("b", Exception("failed"))
+    assert isinstance(other.exception(), Exception)
+
+    async def timesOut():
+        try:
+            await asyncio.wait_for(waiters.wait("c"), 0.01)
+        except asyncio.TimeoutError:
+            return True
+    assert loop.run_until_complete(timesOut())
+    assert not waiters.waiting("c")
+    loop.close()
+
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic unit test completed successfully.")
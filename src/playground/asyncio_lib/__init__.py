@@ -1 +1 @@
-from .SimpleCondition import SimpleCondition
\ No newline at end of file
+from .KeyedWaiters import KeyedWaiters
\ No newline at end of file
@@ -1,5 +1,25 @@
 import asyncio
 
+class TestHandle:
+    def __init__(self, when, callback, args):
+        self._when = when
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+        
+    def when(self):
+        return self._when
+        
+    def cancel(self):
+        self._cancelled = True
+        
+    def cancelled(self):
+        return self._cancelled
+        
+    def __call__(self):
+        if not self._cancelled:
+            self._callback(*self._args)
+
 class TestLoopEx(asyncio.AbstractEventLoop):
 
     def __init__(self):
@@ -22,28 +42,67 @@ class TestLoopEx(asyncio.AbstractEventLoop):
             
     def _test_set_transport_factory(self, f):
         self._transportFactory = f
+        
+    # Public names used by the unit tests
+    advanceClock = _test_advance_time
+    setTransportFactory = _test_set_transport_factory
     
     def stop(self):
         self._running=False
         
+    def close(self):
+        self._running=False
+        self._schedule = []
+        
     def is_running(self):
         return self._running
         
     def is_closed(self):
         return not self._running
         
-    def call_soon(self, f, args=None):
-        self.call_later(0.0, f, args)
+    def get_debug(self):
+        return False
+        
+    def call_soon(self, f, *args, context=None):
+        return self.call_later(0.0, f, *args)
         
-    def call_later(self, delay, f, args=None):
-        if args == None:
-            args = ()
-        self._schedule.append(((self._clock_time + delay), lambda: f(*args)))
+    def call_later(self, delay, f, *args, context=None):
+        return self.call_at(self._clock_time + delay, f, *args)
+        
+    def call_at(self, when, f, *args, context=None):
+        handle = TestHandle(when, f, args)
+        self._schedule.append((when, handle))
+        # sort is stable, so callbacks at the same time keep their order
         self._schedule.sort(key=lambda schedule_element: schedule_element[0])
+        return handle
         
     def time(self):
         return self._clock_time
         
+    def create_future(self):
+        return asyncio.Future(loop=self)
+        
+    def create_task(self, coro):
+        """
+        Runs coro a step at a time on the test clock. When it awaits
+        a future, the next step is scheduled for when that future is done.
+        """
+        task = self.create_future()
+        def step():
+            try:
+                awaiting = coro.send(None)
+            except StopIteration as result:
+                task.set_result(result.value)
+            except Exception as error:
+                task.set_exception(error)
+            else:
+                if asyncio.isfuture(awaiting):
+                    awaiting.add_done_callback(lambda f: self.call_soon(step))
+                else:
+                    self.call_soon(step)
+        self.call_soon(step)
+        return task
+        
     async def create_connection(self, factory, addr, port):
         if not self._transportFactory:
             raise Exception("Not Ready. Requires a transport factory")
@@ -6,6 +6,8 @@ Created on Oct 1, 2017
 import playground
 import os
 import configparser
+import importlib
+import json
 import time
 
 class Configure:
@@ -28,6 +30,8 @@ class Configure:
     if INSTANCE_CONFIG_PATH:
         SEARCH_ORDER.insert(0, INSTANCE_CONFIG_KEY)
     
+    # objects with InitializeConfigModule, or "module:attribute" names
+    # of them (imported by Initialize)
     CONFIG_MODULES = []
     
     @classmethod
@@ -57,6 +61,9 @@ class Configure:
             os.mkdir(location)
             
         for module in cls.CONFIG_MODULES:
+            if isinstance(module, str):
+                moduleName, attribute = module.split(":")
+                module = getattr(importlib.import_module(moduleName), attribute)
             module.InitializeConfigModule(location, overwrite)
             
     @classmethod
@@ -67,6 +74,14 @@ class Configure:
         cls.SEARCH_ORDER = [customPathId] + cls.SEARCH_ORDER
         
 class PlaygroundConfigFile:
+    """
+    With snapshot=True, the parsed file is also kept as JSON next to
+    it (path + SNAPSHOT_SUFFIX), tagged with the file's mtime and size.
+    While those match, loading reads the snapshot instead of parsing.
+    """
+    SNAPSHOT_VERSION = 1
+    SNAPSHOT_SUFFIX  = ".snapshot"
+    
     @classmethod
     def Exists(cls, identifier, location=None):
         if location==None:
@@ -78,7 +93,7 @@ class PlaygroundConfigFile:
         return os.path.exists(path)
         
     @classmethod
-    def Open(cls, identifier, access="read", create="", location=None, **spec):
+    def Open(cls, identifier, access="read", create="", location=None, snapshot=False, **spec):
         if access not in ["read","write"]:
             raise Exception("Unknown access mode {}".format(access))
         if create not in ["", "overwrite", "ifneeded"]:
@@ -99,13 +114,14 @@ class PlaygroundConfigFile:
                 ))
         if not os.path.exists(path):
             raise Exception("No such config file {}.".format(identifier))
-        return cls(identifier, access, path, spec)
+        return cls(identifier, access, path, spec, snapshot)
         
-    def __init__(self, identifier, access, path, spec):
+    def __init__(self, identifier, access, path, spec, snapshot=False):
         self._identifier = identifier
         self._access = access
         self._path = path
         self._spec = spec
+        self._snapshot = snapshot
         self._modtime = time.time()
         self.reload(force=True)
         
@@ -128,17 +144,70 @@ class PlaygroundConfigFile:
     def reload(self, force=False):
         newLastModifiedTime = os.path.getmtime(self._path)
         if newLastModifiedTime > self._modtime or force:
-            self._config = configparser.ConfigParser()
-            self._config.read(self._path)
+            self._config = self._snapshot and self._loadSnapshot() or self._parse()
             for sec in self._spec:
                 if sec not in self._config:
                     self._config[sec] = self._spec[sec]
+            self._modtime = newLastModifiedTime
                 
     def save(self):
         if self._access not in ["write"]:
             raise Exception("Cannot save a read-only config.")
-        with open(self._path, 'w+') as configfile:
+        # write and rename, so readers never see a partly written file
+        tmpPath = "{}.{}".format(self._path, os.getpid())
+        with open(tmpPath, 'w+') as configfile:
             self._config.write(configfile)
+        if os.path.exists(self._path):
+            os.chmod(tmpPath, os.stat(self._path).st_mode)
+        os.replace(tmpPath, self._path)
+        if self._snapshot:
+            self._writeSnapshot(self._config, self._fileKey())
+            
+    def _fileKey(self):
+        fileStat = os.stat(self._path)
+        return [fileStat.st_mtime_ns, fileStat.st_size]
+        
+    def _parse(self):
+        # stat first. If the file changes while being read, the snapshot is stale on arrival.
+        fileKey = self._snapshot and self._fileKey()
+        config = configparser.ConfigParser()
+        config.read(self._path)
+        if self._snapshot:
+            self._writeSnapshot(config, fileKey)
+        return config
+        
+    def _loadSnapshot(self):
+        try:
+            with open(self._path + self.SNAPSHOT_SUFFIX) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if snapshot.get("version") != self.SNAPSHOT_VERSION or snapshot.get("file") != self._fileKey():
+            return None
+        config = configparser.ConfigParser(defaults=snapshot["defaults"])
+        config.read_dict(snapshot["sections"])
+        return config
+        
+    def _writeSnapshot(self, config, fileKey):
+        defaults = dict(config.defaults())
+        # items() includes the defaults. Keep them out of the sections, so a
+        # config loaded from the snapshot doesn't save them into every section.
+        sections = {section: {option: value for option, value in config.items(section, raw=True)
+                              if defaults.get(option) != value}
+                    for section in config.sections()}
+        snapshot = {"version":  self.SNAPSHOT_VERSION,
+                    "file":     fileKey,
+                    "defaults": defaults,
+                    "sections": sections}
+        snapshotPath = self._path + self.SNAPSHOT_SUFFIX
+        tmpPath = "{}.{}".format(snapshotPath, os.getpid())
+        try:
+            with open(tmpPath, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmpPath, snapshotPath)
+        except OSError:
+            # e.g., no write access. Just parse next time.
+            pass
                 
     def __getitem__(self, key):
         return self._config[key]
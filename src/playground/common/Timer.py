@@ -3,7 +3,15 @@ NOTE: We're currently tying this class to asyncio.
 Consider making an asyncio  implementation that 
 can be swapped out
 """
-import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _eventLoop(loop=None):
+    # asyncio is imported on first use. Importing it here would make
+    # it part of "import playground" (through playground.common).
+    import asyncio
+    return loop or asyncio.get_event_loop()
 
 class TimePeriod:
     def __init__(self, seconds):
@@ -19,13 +27,172 @@ class Minutes(TimePeriod):
     def __init__(self, minutes):
         super().__init__(minutes*60)
 
+class CallLaterBackend:
+    """
+    The default Timer backend. Every timer gets its own
+    loop.call_later handle.
+    """
+    def __init__(self, loop=None):
+        self._loop = _eventLoop(loop)
+        
+    def callLater(self, delay, callback):
+        return self._loop.call_later(delay, callback)
+        
+class TimingWheel:
+    """
+    A hierarchical timing wheel (in the style of the classic
+    Linux kernel timers) for when there are a lot of timers.
+    
+    Time is divided into ticks of RESOLUTION seconds. Level 0
+    has one slot per tick; each higher level has slots that cover
+    a full turn of the level below it. Starting and cancelling a
+    timer is O(1): it is just added to or removed from a slot. As
+    the wheel turns, the next slot in a higher level is cascaded
+    down into the lower levels.
+    
+    The whole wheel is driven by a single loop.call_later per
+    tick, and only while timers are pending. Timers fire no
+    earlier than requested and at most one tick late.
+    
+    Use TimingWheel.ForLoop() to share one wheel per event loop.
+    """
+    RESOLUTION = 0.05
+    SLOT_BITS  = 6
+    LEVELS     = 5
+    
+    # ForLoop keeps the wheel on the loop itself, so it goes away with the loop
+    _LOOP_ATTRIBUTE = "_playgroundTimingWheel"
+    
+    class Entry:
+        __slots__ = ["wheel", "callback", "expires", "slot"]
+        
+        def __init__(self, wheel, callback, expires):
+            self.wheel    = wheel
+            self.callback = callback
+            self.expires  = expires
+            self.slot     = None
+            
+        def cancel(self):
+            if self.slot is not None:
+                del self.slot[self]
+                self.slot = None
+                self.wheel._count -= 1
+                
+        def cancelled(self):
+            return self.slot is None
+    
+    @classmethod
+    def ForLoop(cls, loop=None):
+        loop = _eventLoop(loop)
+        if loop.is_closed():
+            # let go of the wheel (and its pending callbacks); it will never tick again
+            loop.__dict__.pop(cls._LOOP_ATTRIBUTE, None)
+            raise RuntimeError("Event loop is closed")
+        wheel = getattr(loop, cls._LOOP_ATTRIBUTE, None)
+        if wheel is None:
+            wheel = cls(loop)
+            setattr(loop, cls._LOOP_ATTRIBUTE, wheel)
+        return wheel
+    
+    def __init__(self, loop=None, resolution=None):
+        self._loop = _eventLoop(loop)
+        self._resolution = resolution or self.RESOLUTION
+        self._slotCount = 1 << self.SLOT_BITS
+        self._slotMask = self._slotCount - 1
+        # entries are stored as dict keys (ordered, O(1) removal)
+        self._levels = [[{} for i in range(self._slotCount)] for j in range(self.LEVELS)]
+        self._maxTicks = (1 << (self.SLOT_BITS * self.LEVELS)) - 1
+        self._epoch = self._loop.time()
+        self._nextTick = 0
+        self._tickHandle = None
+        self._count = 0
+        
+    def __len__(self):
+        return self._count
+        
+    def _currentTick(self):
+        return int((self._loop.time() - self._epoch) / self._resolution)
+        
+    def callLater(self, delay, callback):
+        if self._tickHandle is None:
+            # The wheel was idle (and therefore empty). Catch it up to now.
+            self._nextTick = self._currentTick()
+            self._tickHandle = self._loop.call_later(self._resolution, self._tick)
+        deadline = self._loop.time() + delay - self._epoch
+        expires = int(deadline / self._resolution)
+        if expires * self._resolution < deadline:
+            expires += 1
+        entry = self.Entry(self, callback, expires)
+        self._insert(entry)
+        self._count += 1
+        return entry
+        
+    def _insert(self, entry):
+        ticks = entry.expires - self._nextTick
+        if ticks < 0:
+            # already due; run at the next tick
+            entry.expires = self._nextTick
+            ticks = 0
+        slotTick = entry.expires
+        if ticks > self._maxTicks:
+            # beyond the wheel. Park it in the top level, keeping its real expiry.
+            # When that slot cascades, it is inserted again from the remaining ticks.
+            ticks = self._maxTicks
+            slotTick = self._nextTick + self._maxTicks
+        level = 0
+        while ticks >= (1 << (self.SLOT_BITS * (level+1))):
+            level += 1
+        slot = self._levels[level][(slotTick >> (self.SLOT_BITS * level)) & self._slotMask]
+        slot[entry] = None
+        entry.slot = slot
+        
+    def _cascade(self, level):
+        index = (self._nextTick >> (self.SLOT_BITS * level)) & self._slotMask
+        slot = self._levels[level][index]
+        self._levels[level][index] = {}
+        for entry in slot:
+            self._insert(entry)
+        return index
+        
+    def _tick(self):
+        try:
+            currentTick = self._currentTick()
+            while self._nextTick <= currentTick:
+                index = self._nextTick & self._slotMask
+                level = 1
+                while index == 0 and level < self.LEVELS:
+                    index = self._cascade(level)
+                    level += 1
+                index = self._nextTick & self._slotMask
+                slot = self._levels[0][index]
+                self._levels[0][index] = {}
+                self._nextTick += 1
+                # a callback can cancel another entry of this slot (removing it
+                # from the dict), so iterate over a copy and skip cancelled entries
+                for entry in list(slot):
+                    if entry.slot is not slot:
+                        continue
+                    entry.slot = None
+                    self._count -= 1
+                    try:
+                        entry.callback()
+                    except Exception as e:
+                        logger.error("Timing wheel callback {} failed: {}".format(entry.callback, e))
+        finally:
+            # whatever happened above, the wheel must keep turning while timers are pending
+            if self._count:
+                self._tickHandle = self._loop.call_later(self._resolution, self._tick)
+            else:
+                self._tickHandle = None
+
 class Timer:
-    def __init__(self, timePeriod, callback, *args):
+    def __init__(self, timePeriod, callback, *args, backend=None):
         self._delay = timePeriod.seconds()
         self._callback = callback
         self._callbackArgs = args
         self._task = None
-        self._loop = asyncio.get_event_loop()
+        self._loop = _eventLoop()
+        self._backend = backend or CallLaterBackend(self._loop)
         
     def _fireCallback(self):
         if self._delay:
@@ -46,25 +213,32 @@ class Timer:
     def start(self):
         origDelay = self._delay
         self._delay = 0
-        self._task = self._loop.call_later(origDelay, self._fireCallback)
+        self._task = self._backend.callLater(origDelay, self._fireCallback)
     
     def expire(self):
         self._task.cancel()
         self._callback(*self._callbackArgs)
         
 def basicUnitTest():
+    basicBackendTest(CallLaterBackend)
+    basicBackendTest(TimingWheel)
+    timingWheelTest()
+
+def basicBackendTest(backendType):
     from playground.asyncio_lib.testing import TestLoopEx
+    import asyncio
             
     testLoop = TestLoopEx()
     asyncio.set_event_loop(testLoop)
+    backend = backendType(testLoop)
     
     results = []
     def callback(results, index):
         results.append("Callback{}".format(index))
         
-    t1 = Timer(Seconds(10), callback, results, 0)
-    t2 = Timer(Seconds(20), callback, results, 1)
-    t3 = Timer(Seconds(20), callback, results, 2)
+    t1 = Timer(Seconds(10), callback, results, 0, backend=backend)
+    t2 = Timer(Seconds(20), callback, results, 1, backend=backend)
+    t3 = Timer(Seconds(20), callback, results, 2, backend=backend)
     
     t1.start()    
     t2.start()
@@ -90,6 +264,93 @@ def basicUnitTest():
     
     testLoop.close()
     
+def timingWheelTest():
+    from playground.asyncio_lib.testing import TestLoopEx
+    import random
+    
+    testLoop = TestLoopEx()
+    wheel = TimingWheel(testLoop)
+    
+    # spread timers across every level of the wheel
+    fired = {}
+    deadlines = {}
+    entries = []
+    rng = random.Random(0)
+    for i in range(2000):
+        delay = rng.choice([0.01, 1, 30, 600, 20000]) * rng.random()
+        deadlines[i] = delay
+        entries.append(wheel.callLater(delay, lambda i=i: fired.__setitem__(i, testLoop.time())))
+    assert len(wheel) == 2000
+    
+    cancelled = set(range(0, 2000, 7))
+    for i in cancelled:
+        entries[i].cancel()
+    assert len(wheel) == 2000 - len(cancelled)
+    
+    for i in range(25000):
+        testLoop.advanceClock(1)
+    assert len(wheel) == 0
+    assert set(fired.keys()) == set(range(2000)) - cancelled
+    for i in fired:
+        # TestLoopEx runs late callbacks when the clock moves, so allow
+        # one clock step on top of the wheel resolution.
+        assert deadlines[i] <= fired[i] <= deadlines[i] + 1 + wheel.RESOLUTION
+        
+    # an idle wheel stops ticking
+    assert not testLoop._schedule
+    testLoop.close()
+    
+    # a callback that cancels a timer due in the same tick
+    testLoop = TestLoopEx()
+    wheel = TimingWheel(testLoop)
+    fired = []
+    entries = {}
+    def cancelB():
+        fired.append("a")
+        entries["b"].cancel()
+    entries["a"] = wheel.callLater(1, cancelB)
+    entries["b"] = wheel.callLater(1, lambda: fired.append("b"))
+    entries["c"] = wheel.callLater(1, lambda: fired.append("c"))
+    wheel.callLater(5, lambda: fired.append("later"))
+    for i in range(10):
+        testLoop.advanceClock(1)
+    assert fired == ["a", "c", "later"] and len(wheel) == 0
+    testLoop.close()
+    
+    # delays beyond the top level fire when requested, not at the wheel's horizon
+    class SmallWheel(TimingWheel):
+        SLOT_BITS = 2
+        LEVELS    = 2
+    testLoop = TestLoopEx()
+    wheel = SmallWheel(testLoop)
+    horizon = wheel._maxTicks*wheel.RESOLUTION
+    fired = {}
+    for delay in [0.5, horizon+0.5, 3*horizon, 10.0]:
+        wheel.callLater(delay, lambda delay=delay: fired.__setitem__(delay, testLoop.time()))
+    for i in range(250):
+        testLoop.advanceClock(wheel.RESOLUTION)
+    assert len(fired) == 4 and len(wheel) == 0
+    for delay in fired:
+        assert delay <= fired[delay] + 1e-9 and fired[delay] <= delay + 2*wheel.RESOLUTION + 1e-9
+    testLoop.close()
+    
+    # ForLoop shares one wheel per loop, and doesn't keep loops alive
+    import gc, weakref
+    testLoop = TestLoopEx()
+    wheel = TimingWheel.ForLoop(testLoop)
+    assert TimingWheel.ForLoop(testLoop) is wheel
+    wheel.callLater(10, lambda: None)
+    loopRef, wheelRef = weakref.ref(testLoop), weakref.ref(wheel)
+    testLoop.close()
+    try:
+        TimingWheel.ForLoop(testLoop)
+        assert False, "a closed loop has no wheel"
+    except RuntimeError:
+        pass
+    del testLoop, wheel
+    gc.collect()
+    assert loopRef() is None and wheelRef() is None
+    
 if __name__=="__main__":
     basicUnitTest()
     print("Basic Unit Test completed successfully")
\ No newline at end of file
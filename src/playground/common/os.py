@@ -1,4 +1,4 @@
-import subprocess
+import os, select, shutil, socket, subprocess, tempfile, time
 
 def getCmdOutput(*args):
     output = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -18,3 +18,97 @@ def isPidAlive(pid):
     if len(lines) == 1:
         return True
     return False
+
+READY  = "READY"
+FAILED = "FAILED"
+
+def notifyReady(notifyPath, key, status=READY, message=""):
+    """
+    Tells the ReadinessListener at notifyPath that the process launched
+    for key is serving (or, with status=FAILED, that it never will be).
+    """
+    if not notifyPath: return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto("{}\n{}\n{}".format(status, key, message).encode(), notifyPath)
+    except OSError:
+        # nobody is listening anymore (e.g., the launcher gave up)
+        pass
+    finally:
+        sock.close()
+
+class ReadinessListener:
+    """
+    A unix datagram socket that launched daemons signal (notifyReady)
+    once they are serving, so the launcher doesn't have to poll for
+    their pid and status files. One listener can wait on any number of
+    launches at once; each is identified by a key the launcher and the
+    daemon agree on.
+    """
+    def __init__(self):
+        # a fresh directory keeps the path short (sun_path is 108 bytes)
+        self._directory = tempfile.mkdtemp(prefix="playground-")
+        self._path = os.path.join(self._directory, "notify")
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._path)
+        self._socket.setblocking(False)
+        self._received = {}
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, *args):
+        self.close()
+        
+    def path(self):
+        return self._path
+        
+    def wait(self, keys, timeout):
+        """
+        Waits until at least one of keys has signalled, or for timeout
+        seconds. Returns {key: (status, message)} for the keys that have
+        signalled. A key is only returned once.
+        """
+        keys = list(keys)
+        deadline = time.monotonic() + timeout
+        while True:
+            self._receive()
+            signalled = {key: self._received.pop(key) for key in keys if key in self._received}
+            remaining = deadline - time.monotonic()
+            if signalled or remaining <= 0:
+                return signalled
+            select.select([self._socket], [], [], remaining)
+            
+    def _receive(self):
+        while True:
+            try:
+                data = self._socket.recv(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            status, key, message = (data.decode().split("\n", 2) + ["", ""])[:3]
+            self._received[key] = (status, message)
+            
+    def close(self):
+        self._socket.close()
+        shutil.rmtree(self._directory, ignore_errors=True)
+        
+def basicUnitTest():
+    with ReadinessListener() as readiness:
+        assert readiness.wait(["a"], 0.01) == {}
+        notifyReady(readiness.path(), "a")
+        notifyReady(readiness.path(), "b", FAILED, "no port")
+        notifyReady(readiness.path(), "ignored")
+        assert readiness.wait(["a", "b"], 1) == {"a": (READY, ""), "b": (FAILED, "no port")}
+        assert readiness.wait(["a"], 0.01) == {}
+        
+        start = time.monotonic()
+        readiness.wait(["c"], 0.1)
+        assert time.monotonic() - start >= 0.1
+        path = readiness.path()
+    assert not os.path.exists(path)
+    # a listener that has gone away is not an error
+    notifyReady(path, "a")
+    
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic unit test completed successfully.")
@@ -7,6 +7,7 @@ Created on Oct 23, 2013
 '''
 from playground.common import CustomConstant as Constant
 from asyncio import Protocol, Transport
+import weakref
 
 class StackingProtocolFactory:
     """
@@ -53,10 +54,41 @@ class StackingProtocol(Protocol):
         self._higherProtocol = higherProtocol # error if already set?
     
 class StackingTransport(Transport):
+    """
+    A transport whose write hands data to the lower transport unchanged
+    is a passthrough. Transports stacked on a passthrough write past it,
+    to the first lower transport that does something with the data. A
+    StackingTransport is a passthrough unless its class overrides write
+    or writelines, or it sets PASSTHROUGH (a layer that only watches
+    writes can set it True to be skipped). A transport whose write or
+    writelines is replaced on the instance (e.g., by ProtocolObservation)
+    is not skipped. Replacing or restoring one makes every transport
+    work out its write target again on its next write.
+    
+    writelines hands the list of buffers down as it is, so the bottom
+    transport gets them in one call (asyncio's socket transports send
+    them together, with sendmsg where available).
+    """
+    PASSTHROUGH = None
+    
+    # bumped when any instance's write or writelines is replaced or restored
+    _adaptations = 0
+    
+    @classmethod
+    def IsPassthrough(cls, transport):
+        if not isinstance(transport, StackingTransport): return False
+        if "write" in transport.__dict__ or "writelines" in transport.__dict__:
+            # adapted per instance (e.g., by ProtocolObservation)
+            return False
+        if transport.PASSTHROUGH is not None:
+            return transport.PASSTHROUGH
+        transportClass = type(transport)
+        return transportClass.write is StackingTransport.write and transportClass.writelines is StackingTransport.writelines
     
     def __init__(self, lowerTransport, extra=None):
         super().__init__(extra)
         self._lowerTransport = lowerTransport
+        self._updateWriteTransport()
         if self.get_extra_info("sockname", None) == None:
             self._extra["sockname"] = lowerTransport.get_extra_info("sockname", None)
         if self.get_extra_info("peername", None) == None:
@@ -64,6 +96,24 @@ class StackingTransport(Transport):
         if self.get_extra_info("spawnport", None) == None:
             self._extra["spawnport"] = lowerTransport.get_extra_info("spawnport", None)
             
+    def __setattr__(self, name, value):
+        if name == "write" or name == "writelines":
+            StackingTransport._adaptations += 1
+        super().__setattr__(name, value)
+        
+    def __delattr__(self, name):
+        if name == "write" or name == "writelines":
+            StackingTransport._adaptations += 1
+        super().__delattr__(name)
+        
+    def _updateWriteTransport(self):
+        writeTransport = self._lowerTransport
+        while self.IsPassthrough(writeTransport):
+            writeTransport = writeTransport._lowerTransport
+        self._writeTransport = writeTransport
+        self._writeAdaptations = StackingTransport._adaptations
+        return writeTransport
+        
     def lowerTransport(self):
         return self._lowerTransport
     
@@ -77,9 +127,16 @@ class StackingTransport(Transport):
         return self._lowerTransport.abort()
         
     def write(self, data):
-        return self._lowerTransport.write(data)
+        if self._writeAdaptations != StackingTransport._adaptations:
+            return self._updateWriteTransport().write(data)
+        return self._writeTransport.write(data)
         
     def writelines(self, iterable):
+        if type(self).write is StackingTransport.write and "write" not in self.__dict__:
+            if self._writeAdaptations != StackingTransport._adaptations:
+                return self._updateWriteTransport().writelines(iterable)
+            return self._writeTransport.writelines(iterable)
+        # write does something with the data. Each buffer goes through it.
         for i in iterable:
             self.write(i)
 
@@ -87,106 +144,178 @@ class StackingTransport(Transport):
 class ProtocolObservation:
     """
     This class allows a given protocol to be observed (i.e.,
-    listeners can receive event notifications). When a protocol
-    is observed, its methods are adapted to report events
-    to listeners. A protocol can be un-adapted at any time.
-    
-    Some events have automatic consequences. For example, when
-    connection_made is called, it automatically records the
-    transport and assigns a new transport with an adapted write method.
-    Similarly, when a protocol's connection_lost method is called,
-    it is automatically removed from observation.
-    
-    To prevent duplicate modification, a protocol's adapter
-    is saved. Attempts to create a new adapter are prevented
-    and the existing adapter returned.
+    listeners can receive event notifications). An observed
+    protocol's class is swapped for a subclass (one per protocol
+    class) that reports connection_made, data_received, and
+    connection_lost. Protocols that aren't observed are untouched
+    and pay nothing. A protocol can be un-adapted at any time.
+    
+    Some events have automatic consequences. When connection_made
+    is called, the transport's write method is adapted to report
+    data sent. When connection_lost is called, the protocol is
+    removed from observation (listeners hear about it first).
+    
+    Observations are held by weak reference, so a protocol that
+    never gets connection_lost isn't kept alive by being observed.
+    While observed, a protocol's bytes and events are counted (see
+    Counters). Listeners can ask for a sample of the data events
+    (every sampleRate'th one) instead of all of them.
     """
-    OBSERVED_PROTOCOLS    = {}
+    OBSERVED_PROTOCOLS    = {} # id(protocol) -> Observation, removed when the protocol is collected
+    OBSERVED_CLASSES      = {}
     
     EVENT_CONNECTION_MADE = Constant(intValue=0)
     EVENT_CONNECTION_LOST = Constant(intValue=1)
     EVENT_DATA_RECEIVED   = Constant(intValue=2)
     EVENT_DATA_SENT       = Constant(intValue=3)
     
-    class ProtocolAdapter:
+    class Observation:
         def __init__(self, protocol):
-            self.originalConnectionMade = protocol.connection_made
-            self.originalConnectionLost = protocol.connection_lost
-            self.originalDataReceived   = protocol.data_received
-            self.transport              = None
+            protocolId = id(protocol)
+            observations = ProtocolObservation.OBSERVED_PROTOCOLS
+            self.protocol  = weakref.ref(protocol, lambda ref: observations.pop(protocolId, None))
+            self.originalClass = protocol.__class__
+            self.listeners = {} # listener -> sample rate
+            self.notifyList = ()
+            self.bytesReceived, self.bytesSent, self.dataReceived, self.dataSent = 0, 0, 0, 0
+            self.transport = None
             self.originalTransportWrite = None
-            self.listeners = set([])
+            self.instanceTransportWrite = False
             
-        def transportData(self, protocol):
-            self.transport = protocol.transport
-            self.originalTransportWrite = protocol.transport.write
-            protocol.transport.write = lambda *args, **kargs: ProtocolObservation.protocolEvent(protocol, 
-                                                                     self.originalTransportWrite,
-                                                                     ProtocolObservation.EVENT_DATA_SENT,
-                                                                     *args, **kargs)
+        def setListener(self, listener, sampleRate):
+            if sampleRate:
+                self.listeners[listener] = sampleRate
+            else:
+                del self.listeners[listener]
+            # iterated on every event. Rebuilt (not copied) when listeners change.
+            self.notifyList = tuple(self.listeners.items())
+            
+        def notify(self, protocol, event, r, args, kargs, count=0):
+            for listener, sampleRate in self.notifyList:
+                if sampleRate == 1 or count % sampleRate == 0:
+                    listener(protocol, event, r, args, kargs)
+                    
+        def transportData(self, transport):
+            self.transport = transport
+            self.originalTransportWrite = transport.write
+            self.instanceTransportWrite = "write" in getattr(transport, "__dict__", {})
+            transport.write = self.transportWrite
+            
+        def transportWrite(self, data):
+            r = self.originalTransportWrite(data)
+            self.dataSent += 1
+            self.bytesSent += len(data)
+            if self.notifyList:
+                protocol = self.protocol()
+                if protocol is not None:
+                    self.notify(protocol, ProtocolObservation.EVENT_DATA_SENT, r, (data,), {}, self.dataSent)
+            return r
             
         def restoreProtocol(self, protocol):
-            protocol.connection_made = self.originalConnectionMade
-            protocol.connection_lost = self.originalConnectionLost
-            protocol.data_received   = self.originalDataReceived
+            protocol.__class__ = self.originalClass
             if self.transport and self.originalTransportWrite:
-                self.transport.write = self.originalTransportWrite
-                self.transport = None
+                if self.instanceTransportWrite:
+                    self.transport.write = self.originalTransportWrite
+                else:
+                    del self.transport.write
+            self.transport = None
             self.originalTransportWrite = None
-            self.originalConnectionLost = None
-            self.originalConnectionMade = None
-            self.originalDataReceived   = None
+            ProtocolObservation.OBSERVED_PROTOCOLS.pop(id(protocol), None)
             
-            if protocol in ProtocolObservation.OBSERVED_PROTOCOLS:
-                del ProtocolObservation.OBSERVED_PROTOCOLS[protocol]
-    
     @classmethod
-    def protocolEvent(cls, protocol, protocolMethod, event, *args, **kargs):
-        r = protocolMethod(*args, **kargs)
-        protocolData = cls.OBSERVED_PROTOCOLS.get(protocol, None)
-        if not protocolData:
-            return r
+    def ObservedClass(cls, protocolClass):
+        """
+        The subclass of protocolClass that observed protocols are
+        switched to. It adds no state, so switching back and forth is safe.
+        """
+        if protocolClass in cls.OBSERVED_CLASSES:
+            return cls.OBSERVED_CLASSES[protocolClass]
+        observations = cls.OBSERVED_PROTOCOLS
         
-        for l in protocolData.listeners:
-            l(protocol, event, r, args, kargs)
-        if event == cls.EVENT_CONNECTION_MADE and protocol.transport:
-            protocolData.transportData(protocol)
-        if event == cls.EVENT_CONNECTION_LOST:
-            protocolData.restoreProtocol(protocol)
-            #del cls.PROTOCOL_LISTENERS[protocol]
-        return r
+        class ObservedProtocol(protocolClass):
+            __slots__ = ()
+            
+            def connection_made(self, *args, **kargs):
+                r = protocolClass.connection_made(self, *args, **kargs)
+                observation = observations.get(id(self), None)
+                if observation is not None:
+                    observation.notify(self, cls.EVENT_CONNECTION_MADE, r, args, kargs)
+                    if getattr(self, "transport", None) and observation.transport is None:
+                        observation.transportData(self.transport)
+                return r
+                
+            def data_received(self, data):
+                r = protocolClass.data_received(self, data)
+                observation = observations.get(id(self), None)
+                if observation is not None:
+                    observation.dataReceived += 1
+                    observation.bytesReceived += len(data)
+                    if observation.notifyList:
+                        observation.notify(self, cls.EVENT_DATA_RECEIVED, r, (data,), {},
+                                           observation.dataReceived)
+                return r
+                
+            def connection_lost(self, *args, **kargs):
+                r = protocolClass.connection_lost(self, *args, **kargs)
+                observation = observations.get(id(self), None)
+                if observation is not None:
+                    observation.notify(self, cls.EVENT_CONNECTION_LOST, r, args, kargs)
+                    observation.restoreProtocol(self)
+                return r
+                
+        ObservedProtocol.__name__     = protocolClass.__name__
+        ObservedProtocol.__qualname__ = protocolClass.__qualname__
+        ObservedProtocol.__module__   = protocolClass.__module__
+        cls.OBSERVED_CLASSES[protocolClass] = ObservedProtocol
+        return ObservedProtocol
     
     @classmethod
     def EnableProtocol(cls, protocol):
-        if not protocol in cls.OBSERVED_PROTOCOLS:
-            protocolData = cls.ProtocolAdapter(protocol)
-            cls.OBSERVED_PROTOCOLS[protocol] = protocolData
-            protocol.connection_made = lambda *args, **kargs: cls.protocolEvent(protocol, 
-                                                                               protocolData.originalConnectionMade, 
-                                                                               cls.EVENT_CONNECTION_MADE, 
-                                                                               *args, **kargs)
-            protocol.connection_lost = lambda *args, **kargs: cls.protocolEvent(protocol, 
-                                                                               protocolData.originalConnectionLost, 
-                                                                               cls.EVENT_CONNECTION_LOST,
-                                                                               *args, **kargs)
-            protocol.data_received   = lambda *args, **kargs: cls.protocolEvent(protocol, protocolData.originalDataReceived,  
-                                                                               cls.EVENT_DATA_RECEIVED,
-                                                                               *args, **kargs)
+        if not id(protocol) in cls.OBSERVED_PROTOCOLS:
+            observation = cls.Observation(protocol)
+            cls.OBSERVED_PROTOCOLS[id(protocol)] = observation
+            protocol.__class__ = cls.ObservedClass(protocol.__class__)
+            if getattr(protocol, "transport", None):
+                # already connected
+                observation.transportData(protocol.transport)
         return protocol
+        
+    @classmethod
+    def DisableProtocol(cls, protocol):
+        observation = cls.OBSERVED_PROTOCOLS.get(id(protocol), None)
+        if observation:
+            observation.restoreProtocol(protocol)
     
     @classmethod
-    def Listen(cls, protocol, listener):
+    def Listen(cls, protocol, listener, sampleRate=1):
+        """
+        The listener is called as listener(protocol, event, result, args, kargs).
+        With a sampleRate of n, it gets every n'th data event (both
+        connection events, always).
+        """
         cls.EnableProtocol(protocol)
-        cls.OBSERVED_PROTOCOLS[protocol].listeners.add(listener)
+        cls.OBSERVED_PROTOCOLS[id(protocol)].setListener(listener, sampleRate)
         
     @classmethod
     def StopListening(cls, protocol, listener):
-        adapter = cls.OBSERVED_PROTOCOLS.get(protocol, None)
-        if not adapter or not listener in adapter.listeners: return
+        observation = cls.OBSERVED_PROTOCOLS.get(id(protocol), None)
+        if not observation or not listener in observation.listeners: return
         
-        adapter.listeners.remove(listener)
-        if not adapter.listeners:
-            adapter.restoreProtocol(protocol)
+        observation.setListener(listener, None)
+        if not observation.listeners:
+            observation.restoreProtocol(protocol)
+            
+    @classmethod
+    def Counters(cls, protocol):
+        """
+        Byte and event counts (bytesReceived, bytesSent, dataReceived,
+        dataSent) since the protocol was enabled, or None if it isn't
+        observed. Still available to connection lost listeners.
+        """
+        observation = cls.OBSERVED_PROTOCOLS.get(id(protocol), None)
+        if observation is None: return None
+        return {"bytesReceived": observation.bytesReceived, "bytesSent":    observation.bytesSent,
+                "dataReceived":  observation.dataReceived,  "dataSent":     observation.dataSent}
     
     @classmethod
     def EnableProtocolClass(cls, protocolClass):
@@ -277,3 +406,117 @@ class ENABLE_PACKET_TRACING(object):
         self.traceLogger.handle(r)
 playgroundlog.PlaygroundLoggingFormatter.SPECIAL_CONVERTERS["packet_trace"] = ENABLE_PACKET_TRACING.FormatPacketData
 """
+
+def basicUnitTest():
+    import gc
+    class WriteTransport:
+        def __init__(self):
+            self.written = []
+        def write(self, data):
+            self.written.append(data)
+    class EchoProtocol(Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+        def data_received(self, data):
+            self.transport.write(data)
+        def connection_lost(self, exc):
+            self.transport = None
+            
+    events, sampled = [], []
+    protocol = EchoProtocol()
+    ProtocolObservation.Listen(protocol, lambda p, event, r, args, kargs: events.append(event))
+    ProtocolObservation.Listen(protocol, lambda p, event, r, args, kargs: sampled.append(event), sampleRate=2)
+    assert isinstance(protocol, EchoProtocol) and type(protocol) != EchoProtocol
+    
+    transport = WriteTransport()
+    protocol.connection_made(transport)
+    for data in [b"a", b"bc", b"def"]:
+        protocol.data_received(data)
+    assert transport.written == [b"a", b"bc", b"def"]
+    assert ProtocolObservation.Counters(protocol) == {"bytesReceived":6, "bytesSent":6, "dataReceived":3, "dataSent":3}
+    
+    # each data_received also writes. Data events are sampled for the second listener.
+    E = ProtocolObservation
+    assert events == [E.EVENT_CONNECTION_MADE] + [E.EVENT_DATA_SENT, E.EVENT_DATA_RECEIVED]*3
+    assert sampled == [E.EVENT_CONNECTION_MADE, E.EVENT_DATA_SENT, E.EVENT_DATA_RECEIVED]
+    
+    protocol.connection_lost(None)
+    assert events[-1] == E.EVENT_CONNECTION_LOST
+    assert type(protocol) == EchoProtocol and "write" not in transport.__dict__
+    assert ProtocolObservation.Counters(protocol) is None
+    
+    # not kept alive by observation
+    leaked = EchoProtocol()
+    ProtocolObservation.EnableProtocol(leaked)
+    leaked.connection_made(WriteTransport())
+    del leaked
+    gc.collect()
+    assert len(ProtocolObservation.OBSERVED_PROTOCOLS) == 0
+    
+    stackingTransportTest()
+    
+def stackingTransportTest():
+    class BottomTransport(Transport):
+        def __init__(self):
+            super().__init__()
+            self.calls = []
+        def write(self, data):
+            self.calls.append(("write", data))
+        def writelines(self, buffers):
+            self.calls.append(("writelines", list(buffers)))
+    class FramingTransport(StackingTransport):
+        def write(self, data):
+            super().write(len(data).to_bytes(2, "big") + data)
+    class WatchingTransport(StackingTransport):
+        PASSTHROUGH = True
+        def write(self, data):
+            raise Exception("Declared passthrough. Should be skipped.")
+    
+    bottom = BottomTransport()
+    passthrough = StackingTransport(StackingTransport(bottom))
+    watched = WatchingTransport(passthrough)
+    top = StackingTransport(watched)
+    assert StackingTransport.IsPassthrough(passthrough) and top._writeTransport is bottom
+    top.write(b"a")
+    top.writelines([b"b", b"c"])
+    assert bottom.calls == [("write", b"a"), ("writelines", [b"b", b"c"])]
+    
+    # a layer that changes the data sees each buffer
+    bottom.calls = []
+    framing = FramingTransport(StackingTransport(bottom))
+    top = StackingTransport(StackingTransport(framing))
+    assert not StackingTransport.IsPassthrough(framing) and top._writeTransport is framing
+    top.writelines([b"b", b"cd"])
+    assert bottom.calls == [("write", b"\x00\x01b"), ("write", b"\x00\x02cd")]
+    
+    # an observed layer is not skipped, even though its transport is adapted
+    # after the layers above it are built (or after they are connected)
+    class LayerProtocol(StackingProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+            if self.higherProtocol():
+                self.higherProtocol().connection_made(StackingTransport(transport))
+    for observeFirst in [True, False]:
+        bottom.calls, events = [], []
+        down, middle, up = LayerProtocol(), LayerProtocol(), LayerProtocol()
+        down.setHigherProtocol(middle)
+        middle.setHigherProtocol(up)
+        listener = lambda p, event, r, args, kargs: events.append(event)
+        if observeFirst:
+            ProtocolObservation.Listen(middle, listener)
+        down.connection_made(bottom)
+        if not observeFirst:
+            ProtocolObservation.Listen(middle, listener)
+        up.transport.write(b"x")
+        up.transport.writelines([b"y", b"z"])
+        assert ProtocolObservation.EVENT_DATA_SENT in events
+        assert ProtocolObservation.Counters(middle)["bytesSent"] == 3
+        assert bottom.calls == [("write", b"x"), ("write", b"y"), ("write", b"z")]
+        # once restored, the layer is skipped again
+        ProtocolObservation.StopListening(middle, listener)
+        up.transport.writelines([b"w"])
+        assert bottom.calls[-1] == ("writelines", [b"w"]) and up.transport._writeTransport is bottom
+    
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic unit test completed successfully.")
@@ -1,5 +1,18 @@
 
-# now call these
-from .switch import Switch, UnreliableSwitch
-from .vnic import VNIC
-from .routing import HierarchyWAN
+# The device classes are imported on first use. Otherwise, importing
+# any one device package (e.g., pnms) would import all of them.
+import importlib
+
+_DEVICE_CLASSES = {
+    "Switch":           ".switch",
+    "UnreliableSwitch": ".switch",
+    "VNIC":             ".vnic",
+    "HierarchyWAN":     ".routing",
+}
+
+def __getattr__(name):
+    if name not in _DEVICE_CLASSES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(_DEVICE_CLASSES[name], __name__), name)
+    globals()[name] = value
+    return value
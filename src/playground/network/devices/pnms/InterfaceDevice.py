@@ -1,6 +1,7 @@
 from .PNMSDevice import PNMSDevice
 from .NetworkAccessPoint import NetworkAccessPointDevice
 from .NetworkManager import NetworkManager
+import os
 
 class InterfaceDevice(PNMSDevice):
     CanConnectTo = [NetworkAccessPointDevice]
@@ -16,6 +17,9 @@ class InterfaceDevice(PNMSDevice):
     
     CONFIG_ROUTE_DEFAULT = "default"
     
+    # sun_path is 108 bytes on Linux, including the terminating null
+    UNIX_PATH_MAX = 107
+    
     @classmethod
     def initialize_help(cls):
         return ("{} <playground address>".format(cls.REGISTER_DEVICE_TYPE_NAME))
@@ -64,7 +68,8 @@ cls.REGISTER_DEVICE_TYPE_NAME + """ connect <switch_name>
         self._config.save()
         
     def pnmsAlert(self, device, alert, alertArgs):
-        if device == self.connectedTo() and alert == device.destroy:
+        # alerts go to every loaded device. Check the alert before the config lookup.
+        if alert == device.destroy and device.name() == self.connectedTo():
             self.disable()
             self._disconnect()
         else: super().pnmsAlert(device, alert, alertArgs)
@@ -86,6 +91,30 @@ cls.REGISTER_DEVICE_TYPE_NAME + """ connect <switch_name>
             port = int(f.readline().strip())
         return (ipAddress, port)
         
+    def unixLocation(self):
+        """
+        The path of the unix domain control socket, if the running
+        device advertises one (fourth line of the status file).
+        """
+        if not self.enabled(): return None
+        statusFile, pidFile, lockFile = self._getDeviceRunFiles()
+        with open(statusFile) as f:
+            lines = f.read().split("\n")
+        if len(lines) < 4 or not os.path.exists(lines[3].strip()):
+            return None
+        return lines[3].strip()
+        
+    def _getUnixSocketPath(self):
+        """
+        Where the device should serve its unix domain control socket,
+        or None if the path would be too long for a unix socket.
+        """
+        pnms_path = os.path.dirname(self._pnms.location())
+        path = os.path.join(pnms_path, "device_{}.sock".format(self.name()))
+        if len(path.encode()) > self.UNIX_PATH_MAX:
+            return None
+        return path
+        
     def config(self, verb, args):
         verb = self._sanitizeVerb(verb)
         if verb == self.CONFIG_VERB_CONNECT:
@@ -108,7 +137,9 @@ cls.REGISTER_DEVICE_TYPE_NAME + """ connect <switch_name>
             return "Disabled"
         statusFile, pidFile, lockFile = self._getDeviceRunFiles()
         with open(statusFile) as f:
-            status = f.read()
+            # port, switch location, status, and (optionally) unix socket
+            lines = f.read().split("\n")
+        status = len(lines) > 2 and lines[2] or ""
         if "disconnected" in status.lower():
             return "Failed"
         elif "connected" in status.lower():
@@ -1,9 +1,10 @@
 
 from playground import Configure, PlaygroundConfigFile
-from playground.network.common import PlaygroundAddressBlock
+from playground.network.common import PlaygroundAddressBlock, PlaygroundAddress
 from playground.common.datastructures import DelegateAdapter
+from playground.common.os import ReadinessListener
 
-import os, sys, time, signal
+import contextlib, os, sys, time, signal
 
 """
 Every device can only write to their section.
@@ -110,11 +111,63 @@ class ConnectionDeviceAPI(ConnectionView):
             del self._config[self._device.name()]
         self._config.save()
             
+class RouteIndex:
+    """
+    Longest prefix match over routes. A route is an address block
+    like 1.2.*.*. Its specified leading parts key the index, so a
+    lookup is one dictionary probe per address part, most specific
+    first. Blocks with a wildcard before a specified part (1.*.3.*)
+    are not prefixes; they are checked one by one, most specific first.
+    """
+    def __init__(self, routes, defaultRoute=None):
+        """
+        routes is a list of (address block string, device name)
+        """
+        self._prefixes = {}
+        self._irregular = []
+        self._defaultRoute = defaultRoute
+        for route, device in routes:
+            try:
+                block = PlaygroundAddressBlock.FromString(route)
+            except Exception:
+                continue
+            parts = block.toParts()
+            prefixLength = parts.index("*") if "*" in parts else len(parts)
+            if parts[prefixLength:].count("*") == len(parts) - prefixLength:
+                self._prefixes.setdefault(tuple(parts[:prefixLength]), device)
+            else:
+                self._irregular.append((len(parts)-parts.count("*"), block, device))
+        self._irregular.sort(key=lambda entry: -entry[0])
+        self._prefixLengths = sorted(set(len(prefix) for prefix in self._prefixes), reverse=True)
+        
+    def lookup(self, address):
+        parts = tuple(address.toParts())
+        matchLength, matchDevice = -1, None
+        for length in self._prefixLengths:
+            device = self._prefixes.get(parts[:length], None)
+            if device is not None:
+                matchLength, matchDevice = length, device
+                break
+        for specified, block, device in self._irregular:
+            if specified <= matchLength: break
+            if block.isParentBlock(address):
+                return device
+        if matchDevice is not None:
+            return matchDevice
+        return self._defaultRoute
+        
 class RoutesView(ConfigSectionView):
     DEFAULT_ROUTE_KEY = "__default__"
     
-    def __init__(self, configSection):
+    def __init__(self, configSection, routeIndex=None):
         super().__init__(configSection)
+        self._routeIndex = routeIndex
+        
+    def routeIndex(self):
+        if self._routeIndex is None:
+            routes = [(route, self._config[route]) for route in self._config if route != self.DEFAULT_ROUTE_KEY]
+            self._routeIndex = RouteIndex(routes, self.getDefaultRoute())
+        return self._routeIndex
     
     def lookupDeviceForRoute(self, route):
         return self._config.get(route, None)
@@ -130,13 +183,11 @@ class RoutesView(ConfigSectionView):
         return self._config.get(self.DEFAULT_ROUTE_KEY, None)
         
     def getRoutingDevice(self, address):
-        for route in self._config:
-            if route == self.DEFAULT_ROUTE_KEY:
-                continue
-            routeAddressBlock = PlaygroundAddressBlock.FromString(route)
-            if routeAddressBlock.isParentBlock(address):
-                return self._config[route]
-        return self._config.get(self.DEFAULT_ROUTE_KEY, None)
+        """
+        The device for the most specific route to address, or the
+        default route if none match.
+        """
+        return self.routeIndex().lookup(address)
         
 class RoutesDeviceAPI(RoutesView):    
     # devices need to register their type as one that can accept routes
@@ -166,6 +217,7 @@ class RoutesDeviceAPI(RoutesView):
         if not route in self._config or self._config[route] != self._device.name():
             raise Exception("{} does not have route {}.".format(self._device.name(), route))
         del self._config[route]
+        self._config.save()
         
     def setDefaultRoute(self):
         self._config[self.DEFAULT_ROUTE_KEY] = self._device.name()
@@ -192,6 +244,9 @@ class NetworkManager:
     }
     
     REGISTERED_DEVICE_TYPES = {}
+    
+    # devices launching at once. Launching is mostly interpreter start-up.
+    LAUNCH_CONCURRENCY = 2*(os.cpu_count() or 1)+2
                 
     class ReadOnlyView:
         def __init__(self, pnms, device):
@@ -209,25 +264,91 @@ class NetworkManager:
         self._lastModifiedTime = None
         self._config = None
         
+        # bumped whenever the configuration is loaded or saved.
+        # Cached indexes are rebuilt when it changes.
+        self._configVersion = 0
+        self._routeIndex = None
+        
+        # saves are deferred while in a batch
+        self._batchDepth = 0
+        self._batchDirty = False
+        
     def location(self):
         if self._config is None:
             return None
         return self._config.path()
         
     def loadConfiguration(self):
+        """
+        Devices are constructed on first getDevice, not here. Only
+        on, off, and removeDevice need all of them.
+        """
         self._loadConfig(forced=True)
-        self._loadDevices()
+        self._devices = {}
     
     def saveConfiguration(self):
+        if self._batchDepth:
+            self._batchDirty = True
+            # indexes still need rebuilding
+            self._configVersion += 1
+            return
         self._config.save()
+        self._configChanged()
+        
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Saves inside the block (by devices, routes, connections, ...)
+        are deferred, and the configuration is written once when the
+        outermost batch exits. If the block raises, nothing is written,
+        and the configuration is reloaded from the file. (Devices that
+        were enabled or disabled in the block stay that way.)
+        """
+        self._batchDepth += 1
+        try:
+            yield self
+        except:
+            self._batchDepth -= 1
+            if not self._batchDepth and self._batchDirty:
+                self._batchDirty = False
+                self.reloadConfiguration(forced=True)
+            raise
+        self._batchDepth -= 1
+        if not self._batchDepth and self._batchDirty:
+            self._batchDirty = False
+            self.saveConfiguration()
         
     def reloadConfiguration(self, forced=False):
         self._loadConfig(forced=forced)
-        self._loadDevices()
+        self._devices = {}
+        
+    def reloadIfChanged(self):
+        """
+        Reload if networking.ini was modified (e.g., by another process)
+        since it was last loaded or saved. Returns True if reloaded.
+        """
+        if self._config is None or self._configModifiedTime() == self._lastModifiedTime:
+            return False
+        self.reloadConfiguration(forced=True)
+        return True
+        
+    def configVersion(self):
+        return self._configVersion
+        
+    def _configModifiedTime(self):
+        try:
+            return os.stat(self._config.path()).st_mtime_ns
+        except OSError:
+            return None
+            
+    def _configChanged(self):
+        self._configVersion += 1
+        self._lastModifiedTime = self._configModifiedTime()
         
     def postAlert(self, device, alertType, args):
-        for deviceName in self._devices:
-            self._devices[deviceName].pnmsAlert(device, alertType, args)
+        # only loaded devices. A device loaded later reads its state from the config.
+        for loadedDevice in list(self._devices.values()):
+            loadedDevice.pnmsAlert(device, alertType, args)
         
     def enabled(self):
         return self._enabled
@@ -235,13 +356,72 @@ class NetworkManager:
     def on(self):
         """
         Currently, we don't store any state about being enabled or not.
-        So this is just a macro for turning on all auto enabled devices
+        So this is just a macro for turning on all auto enabled devices.
+        Returns the devices that could not be enabled.
         """
-        for deviceName in self._devices:
-            if self._devices[deviceName].isAutoEnabled() and not self._devices[deviceName].enabled():
-                self._devices[deviceName].enable()
+        self._loadDevices()
+        return self.enableDevices([device for device in self._devices.values()
+                                   if device.isAutoEnabled() and not device.enabled()])
+                                   
+    def enableDevices(self, devices):
+        """
+        Enables devices, and the disabled devices they depend on. Each
+        device is launched as soon as its dependencies (e.g., a VNIC's
+        switch) are up, up to LAUNCH_CONCURRENCY at a time, and is up
+        when it signals readiness. Returns the devices that could not be
+        enabled, including those whose dependencies could not.
+        """
+        # dependencies first, so one pass over pending starts everything that can start
+        pending = []
+        def addPending(device):
+            if device in pending or device.enabled(): return
+            for dependency in device.dependencies():
+                addPending(dependency)
+            pending.append(device)
+        for device in devices:
+            addPending(device)
+        
+        # Don't call enabled() on a device that is launching. A disabled
+        # device cleans up its run files, and these are being written.
+        launching = {} # readiness key -> (device, process, deadline)
+        failed = []
+        with ReadinessListener() as readiness:
+            while pending or launching:
+                launchingDevices = [entry[0] for entry in launching.values()]
+                for device in list(pending):
+                    if len(launching) >= self.LAUNCH_CONCURRENCY: break
+                    dependencies = device.dependencies()
+                    if any(dependency in failed for dependency in dependencies):
+                        pending.remove(device)
+                        failed.append(device)
+                    elif not any(dependency in pending or dependency in launchingDevices for dependency in dependencies):
+                        pending.remove(device)
+                        process = device.startLaunch(readiness)
+                        if process is not None:
+                            launching[device.readinessKey()] = (device, process, time.monotonic()+device.LAUNCH_TIMEOUT)
+                            launchingDevices.append(device)
+                        else:
+                            # nothing to launch separately (or it can't be). Enable the usual way.
+                            device.enable()
+                            if not device.enabled(): failed.append(device)
+                if not launching:
+                    # anything still pending waits on a device that isn't coming up
+                    failed += pending
+                    break
+                
+                deadline = min(entry[2] for entry in launching.values())
+                notifications = readiness.wait(launching.keys(), max(deadline-time.monotonic(), 0))
+                now = time.monotonic()
+                for key in list(launching):
+                    device, process, deviceDeadline = launching[key]
+                    if key in notifications or deviceDeadline <= now:
+                        del launching[key]
+                        if not device.finishLaunch(process, notifications.get(key)):
+                            failed.append(device)
+        return failed
     
     def off(self):
+        self._loadDevices()
         for deviceName in self._devices:
             if self._devices[deviceName].enabled():
                 self._devices[deviceName].disable()
@@ -288,6 +468,8 @@ class NetworkManager:
     def removeDevice(self, deviceName):
         if deviceName not in self._config[self.DEVICES_SECTION_NAME]:
             return
+        # everything that might depend on it has to hear about it.
+        self._loadDevices()
         deviceManager = self.getDevice(deviceName)
         
         self.postAlert(deviceManager, deviceManager.destroy, None)
@@ -332,8 +514,10 @@ class NetworkManager:
         return connectionsView
         
     def routing(self):
-        routingView,_ = self.getSectionAPI(self.ROUTES_SECTION_NAME)
-        return routingView
+        routesSection = self._getRawSectionAdapter(self.ROUTES_SECTION_NAME)
+        if self._routeIndex is None or self._routeIndex[0] != self._configVersion:
+            self._routeIndex = (self._configVersion, RoutesView(routesSection).routeIndex())
+        return RoutesView(routesSection, self._routeIndex[1])
         
     def deviceInfo(self):
         devicesView,_ = self.getSectionAPI(self.DEVICES_SECTION_NAME)
@@ -349,13 +533,34 @@ class NetworkManager:
             self._config = PlaygroundConfigFile.Open("networking", 
                 access="write",
                 create="ifneeded",
+                snapshot=True,
                 **config_spec)
+        self._configChanged()
                             
     def _getDeviceConfigSectionName(self, deviceName):
         return "Config_{}".format(deviceName)
             
     def _loadDevices(self):
-        self._devices = {}
         for deviceName in self._config[self.DEVICES_SECTION_NAME]:
-            # getDevice saves it to self._devices
-            self.getDevice(deviceName, readOnly=False)
+            if deviceName not in self._devices:
+                # getDevice saves it to self._devices
+                self.getDevice(deviceName, readOnly=False)
+
+def basicUnitTest():
+    routes = [("1.*.*.*", "wide"), ("1.2.*.*", "narrow"), ("1.2.3.*", "narrowest"),
+              ("2.*.3.*", "irregular"), ("not a route", "ignored"), ("*.*.*.*", "everything")]
+    index = RouteIndex(routes, "default")
+    address = PlaygroundAddress.FromString
+    
+    # the most specific route wins, regardless of order
+    assert index.lookup(address("1.2.3.4")) == "narrowest"
+    assert index.lookup(address("1.2.4.4")) == "narrow"
+    assert index.lookup(address("1.5.3.4")) == "wide"
+    assert index.lookup(address("2.9.3.4")) == "irregular"
+    assert index.lookup(address("2.9.4.4")) == "everything"
+    assert RouteIndex(routes[:3], "default").lookup(address("5.5.5.5")) == "default"
+    assert RouteIndex([]).lookup(address("5.5.5.5")) == None
+    
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic unit test completed successfully.")
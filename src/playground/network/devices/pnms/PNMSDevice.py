@@ -1,8 +1,8 @@
-from playground.common.os import isPidAlive
+from playground.common.os import isPidAlive, ReadinessListener, READY
 from playground.common import CustomConstant as Constant
 from .NetworkManager import NetworkManager, ConnectionDeviceAPI, RoutesDeviceAPI
 
-import os, signal, time
+import os, signal, subprocess, time
 
 class PNMSDeviceLoader(type):
     """
@@ -53,6 +53,9 @@ class PNMSDevice(metaclass=PNMSDeviceLoader):
     
     REGISTER_DEVICE_TYPE_NAME = None # All abstract classes should leave this none. All concrete classes must specify.
     
+    # seconds a launched device has to signal that it is serving
+    LAUNCH_TIMEOUT = 30
+    
     @classmethod
     def initialize_help(cls):
         return "{name} [ARGS]".format(name=cls.REGISTER_DEVICE_TYPE_NAME)
@@ -95,6 +98,9 @@ class PNMSDevice(metaclass=PNMSDeviceLoader):
     def name(self):
         return self._name
         
+    def dependencies(self):
+        return list(self._deviceDependencies)
+        
     def dependenciesEnabled(self):
         for device in self._deviceDependencies:
             if not device.enabled(): return False
@@ -234,13 +240,66 @@ class PNMSDevice(metaclass=PNMSDeviceLoader):
             if os.path.exists(file):
                 os.unlink(file)
                 
-    def _launch(self, timeout=30):
-        pass
+    def _launchCommand(self):
+        """
+        Devices that run as their own process return the command that
+        launches it. The command must accept --notify <path> and signal
+        readiness there (see playground.common.os.notifyReady), keyed by
+        readinessKey().
+        """
+        return None
+        
+    def readinessKey(self):
+        statusFile, pidFile, lockFile = self._getDeviceRunFiles()
+        return statusFile
         
-    def _waitUntilRunning(self, timeout=30):
-        sleepCount = timeout
-        while not self._running() and sleepCount > 0:
-            time.sleep(1)
-            sleepCount = sleepCount - 1
-        return self._running()
+    def startLaunch(self, readiness):
+        """
+        Starts this device's process and returns it without waiting for
+        the device to come up, so that many devices can launch at once.
+        Returns None if there is nothing to launch. Once readiness has
+        heard from readinessKey() (or timed out), call finishLaunch.
+        """
+        if not self.dependenciesEnabled():
+            return None
+        cmdArgs = self._launchCommand()
+        if cmdArgs is None:
+            return None
+        cmdArgs = cmdArgs + ["--notify", readiness.path()]
+        return subprocess.Popen(cmdArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        
+    def finishLaunch(self, process, notification):
+        """
+        notification is the (status, message) readiness received for this
+        device, or None if it never signalled. Enables the device if it
+        is serving. Otherwise, shuts down whatever is left of it.
+        """
+        if self._launchFinished(process, notification):
+            self._runEnableStatusStateMachine()
+        else:
+            self._enableStatus = self.STATUS_ABNORMAL_SHUTDOWN
+        return self._enableStatus
+        
+    def _launchFinished(self, process, notification):
+        try:
+            # the launcher exits as soon as the daemon has forked
+            output = process.communicate(timeout=5)[0]
+        except subprocess.TimeoutExpired:
+            process.kill()
+            output = process.communicate()[0]
+        if notification and notification[0] == READY and self._running():
+            self._pnms.postAlert(self.enable, True)
+            return True
+        if output: print(output)
+        print("Could not launch {}: {}".format(self.name(), notification and notification[1] or "not ready in time"))
+        self._shutdown()
+        return False
+                
+    def _launch(self, timeout=None):
+        with ReadinessListener() as readiness:
+            process = self.startLaunch(readiness)
+            if process is None:
+                return
+            notifications = readiness.wait([self.readinessKey()], timeout or self.LAUNCH_TIMEOUT)
+            self._launchFinished(process, notifications.get(self.readinessKey()))
         
\ No newline at end of file
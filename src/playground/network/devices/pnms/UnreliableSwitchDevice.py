@@ -1,5 +1,4 @@
 from .NetworkAccessPoint import NetworkAccessPointDevice
-from playground.common.os import getCmdOutput
 
 
 class UnreliableSwitchDevice(NetworkAccessPointDevice):
@@ -11,9 +10,7 @@ class UnreliableSwitchDevice(NetworkAccessPointDevice):
         cmdArgs = [self.LAUNCH_SCRIPT, "--pidfile", pidFile, "--statusfile", statusFile, "--port", port, "--unreliable"]
         return cmdArgs + list(extras)
             
-    def _launch(self, timeout=30):
-        if not self.dependenciesEnabled():
-            return
+    def _launchCommand(self):
         if self.isRemote():
             raise Exception("Cannot launch remote unreliable switches")
         elif self.isManaged():
@@ -29,12 +26,6 @@ class UnreliableSwitchDevice(NetworkAccessPointDevice):
         if self.isLocal():
             cmdArgs.append("--private")
         
-        getCmdOutput(*cmdArgs)
-        
-        running = self._waitUntilRunning(timeout=timeout)
-        if not running:
-            self._shutdown()
-        else:
-            self._pnms.postAlert(self.enable, True)
+        return cmdArgs
             
     
@@ -1,6 +1,6 @@
 from .InterfaceDevice import InterfaceDevice
 from .NetworkManager import NetworkManager
-from playground.common.os import isPidAlive, getCmdOutput
+from playground.common.os import isPidAlive
 
 from playground.network.protocols.vsockets import VNICPromiscuousControl 
 from playground.network.protocols.spmp import SPMPClientProtocol
@@ -16,6 +16,9 @@ class VnicDevice(InterfaceDevice):
 
     def _buildLaunchCommand(self, pidFile, statusFile, vnicAddress, connAddress, connPort):
         cmdArgs = [self.LAUNCH_SCRIPT, "--pidfile", pidFile, "--statusfile", statusFile, vnicAddress, connAddress, connPort]
+        unixSocketPath = self._getUnixSocketPath()
+        if unixSocketPath:
+            cmdArgs += ["--unix-socket", unixSocketPath]
 
         return cmdArgs
     
@@ -58,10 +61,7 @@ class VnicDevice(InterfaceDevice):
             raise Exception(error)
         return result
             
-    def _launch(self, timeout=30):
-        if not self.dependenciesEnabled():
-            return
-        
+    def _launchCommand(self):
         # convert from string name to managed class
         connectedToDeviceName = self.connectedTo()
         connectedToDevice = self._pnms.getDevice(connectedToDeviceName)
@@ -79,12 +79,5 @@ class VnicDevice(InterfaceDevice):
         
         portFile, pidFile, lockFile = self._getDeviceRunFiles()
         
-        cmdArgs = self._buildLaunchCommand(pidFile, portFile, vnicAddress, connAddress, str(connPort))
-        getCmdOutput(*cmdArgs)
-        
-        running = self._waitUntilRunning(timeout=timeout)
-        if not running:
-            self._shutdown()
-        else:
-            self._pnms.postAlert(self.enable, True)
+        return self._buildLaunchCommand(pidFile, portFile, vnicAddress, connAddress, str(connPort))
         
\ No newline at end of file
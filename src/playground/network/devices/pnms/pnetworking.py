@@ -2,7 +2,7 @@
 from playground.network.devices.pnms import NetworkManager, DeviceStatusOutputProcessor, RoutesStatusOutputProcessor
 from playground import Configure
 
-import sys, traceback, argparse, io
+import sys, traceback, argparse, io, shlex
 
 class SimplifiedUsageFormatter(argparse.HelpFormatter):
     """
@@ -15,6 +15,9 @@ class SimplifiedUsageFormatter(argparse.HelpFormatter):
         return super().add_usage(usage, actions, group, prefix="")
 
 class PnetworkingInterface:
+    # commands that only change the configuration. A topology file can use these.
+    TOPOLOGY_COMMANDS = ["add", "remove", "config"]
+    
     def initialize_subcommand_help(self):
         subcmd_help = {}
         subcmd_help["initialize"]=(
@@ -122,6 +125,17 @@ there will be no answer.""").format(
             usage=self.subcommand_usage('query')
         )
         
+        subcmd_help["topology"] = ("""
+\t{usage}
+
+Command 'topology' applies a file of pnetworking commands, one
+per line ({commands}). Blank lines and lines starting with # are
+skipped. The configuration is written once, after the last
+command. If any command fails, none of the changes are saved.""").format(
+            usage=self.subcommand_usage('topology'),
+            commands=", ".join(self.TOPOLOGY_COMMANDS)
+        )
+        
         return subcmd_help
 
     def __init__(self, stdoutFunction=print, stderrFunction=print, failFunction=sys.exit):
@@ -163,6 +177,26 @@ there will be no answer.""").format(
         else:
             self._error("{} could not launch.".format(deviceName))
     
+    def on_handler(self):
+        for device in self._manager.on():
+            self._error("{} could not launch.".format(device.name()))
+    
+    def topology_handler(self, args):
+        commands = []
+        with open(args.file) as f:
+            for lineNumber, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"): continue
+                commandArgs = self._topargs.parse_args(shlex.split(line))
+                if commandArgs.subcommand not in self.TOPOLOGY_COMMANDS:
+                    raise Exception("{} line {}: '{}' is not allowed in a topology file".format(args.file, lineNumber, commandArgs.subcommand))
+                commands.append(commandArgs)
+                
+        with self._manager.batch():
+            for commandArgs in commands:
+                commandArgs.func(commandArgs)
+        self._write("Applied {} commands from {}.".format(len(commands), args.file))
+    
     def status_handler(self, args):
         if not self._currentPath:
             self._write("\nPNetworking not yet configured. Must initialize first.")
@@ -231,7 +265,7 @@ commands:
         
         on_parser = commands.add_parser("on", add_help=False, formatter_class=sub_formatter)
         on_parser.set_defaults(
-            func=lambda args: self._manager.on()
+            func=lambda args: self.on_handler()
         )
         
         off_parser = commands.add_parser("off", add_help=False, formatter_class=sub_formatter)
@@ -289,6 +323,10 @@ commands:
             func=lambda args: self._write(RoutesStatusOutputProcessor().process)(initialize_manager())
         )
         
+        topology_parser = commands.add_parser('topology', add_help=False, formatter_class=sub_formatter)
+        topology_parser.add_argument('file',type=str)
+        topology_parser.set_defaults(func=self.topology_handler)
+        
         status_parser = commands.add_parser('status', add_help=False, formatter_class=sub_formatter)
         status_parser.add_argument('device',nargs='?', default=None)
         status_parser.set_defaults(func=self.status_handler)
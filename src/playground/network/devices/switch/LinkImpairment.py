@@ -0,0 +1,338 @@
+'''
+Per-link impairment engine for the unreliable switch.
+'''
+
+from playground.network.common import StackingTransport
+import asyncio, heapq, logging, math, random
+
+logger = logging.getLogger(__name__)
+
+class ImpairmentProfile:
+    """
+    The set of impairments applied to a link. Settings are addressed
+    by the same names used over SPMP (e.g., "loss", "latency").
+
+    Rates are probabilities between 0 and 1. Times are in seconds.
+    Bandwidth is in bytes per second (0 is unlimited) and burst is
+    the token bucket depth in bytes.
+    """
+    SETTINGS = {
+        # SPMP name              (attribute,           type,  default)
+        "bit-error-rate":       ("bitErrorRate",       float, 1.0/(100*1024*8)),
+        "loss":                 ("lossRate",           float, 0.0),
+        "duplicate":            ("duplicateRate",      float, 0.0),
+        "reorder":              ("reorderRate",        float, 0.0),
+        "latency":              ("latency",            float, 0.0),
+        "jitter":               ("jitter",             float, 0.0),
+        "jitter-distribution":  ("jitterDistribution", str,   "uniform"),
+        "delay-rate":           ("delayRate",          float, 0.01),
+        "delay":                ("delay",              float, 1.0),
+        "bandwidth":            ("bandwidth",          int,   0),
+        "burst":                ("burst",              int,   64*1024),
+    }
+
+    JITTER_DISTRIBUTIONS = ["uniform", "normal", "exponential"]
+
+    def __init__(self, **settings):
+        for name in self.SETTINGS:
+            attribute, settingType, default = self.SETTINGS[name]
+            setattr(self, attribute, default)
+        self.version = 0
+        for name in settings:
+            self.set(name, settings[name])
+
+    def set(self, name, value):
+        if name not in self.SETTINGS:
+            raise Exception("Unknown impairment setting {}".format(name))
+        attribute, settingType, default = self.SETTINGS[name]
+        value = settingType(value)
+        if name == "jitter-distribution" and value not in self.JITTER_DISTRIBUTIONS:
+            raise Exception("Unknown jitter distribution {}".format(value))
+        if settingType != str and value < 0:
+            raise Exception("Impairment setting {} cannot be negative".format(name))
+        setattr(self, attribute, value)
+
+        # transports watch the version to know when cached values are stale
+        self.version += 1
+
+    def get(self, name):
+        if name not in self.SETTINGS:
+            raise Exception("Unknown impairment setting {}".format(name))
+        return getattr(self, self.SETTINGS[name][0])
+
+    def copy(self):
+        profile = ImpairmentProfile()
+        for name in self.SETTINGS:
+            profile.set(name, self.get(name))
+        return profile
+
+    def __str__(self):
+        return ", ".join("{}={}".format(name, self.get(name)) for name in sorted(self.SETTINGS))
+
+class ImpairmentTransport(StackingTransport):
+    """
+    Applies an ImpairmentProfile to everything written to a link.
+    Each write is treated as one packet.
+
+    All randomness comes from the rng passed in, so two runs with
+    the same seed make the same decisions. Bit errors are found by
+    sampling the gap to the next bad bit (geometric distribution),
+    so the cost is per error rather than per byte, and only packets
+    that are actually corrupted are copied (once, into a bytearray).
+    Delayed packets wait in a single heap per link serviced by one
+    timer handle, rather than one call_later per packet.
+    """
+
+    # How long a packet selected for reordering waits for another packet
+    # to overtake it before it is sent anyway.
+    REORDER_HOLD = 0.1
+
+    def __init__(self, lowerTransport, profile, rng=None, loop=None):
+        super().__init__(lowerTransport)
+        self._profile = profile
+        self._profileVersion = None
+        self._rng = rng or random.Random()
+        self._loop = loop or asyncio.get_event_loop()
+        self._queue = []
+        self._queueCount = 0
+        self._timer = None
+        self._timerDeadline = None
+        self._held = None
+        self._linkFree = 0.0
+        self.stats = {
+            "packets":    0,
+            "bytes":      0,
+            "dropped":    0,
+            "corrupted":  0,
+            "bitErrors":  0,
+            "duplicated": 0,
+            "reordered":  0,
+            "delayed":    0,
+        }
+        self._refreshProfile()
+
+    def profile(self):
+        return self._profile
+
+    def setProfile(self, profile):
+        self._profile = profile
+        self._refreshProfile()
+
+    def _refreshProfile(self):
+        p = self._profile
+        self._profileVersion = p.version
+        if p.bitErrorRate <= 0:
+            self._logNoError = None
+        elif p.bitErrorRate >= 1:
+            self._logNoError = 0.0
+        else:
+            self._logNoError = math.log1p(-p.bitErrorRate)
+        self._bitsToNextError = self._nextErrorGap()
+
+    def _nextErrorGap(self):
+        if self._logNoError is None:
+            return math.inf
+        if self._logNoError == 0.0:
+            return 0
+        # geometric distribution: number of good bits before the next bad one
+        return int(math.log(1.0 - self._rng.random()) / self._logNoError)
+
+    def _corrupt(self, data):
+        bitCount = len(data) * 8
+        if self._bitsToNextError >= bitCount:
+            self._bitsToNextError -= bitCount
+            return data
+
+        corrupted = bytearray(data)
+        errors = 0
+        bitIndex = self._bitsToNextError
+        while bitIndex < bitCount:
+            corrupted[bitIndex >> 3] ^= (0x80 >> (bitIndex & 7))
+            errors += 1
+            bitIndex += self._nextErrorGap() + 1
+        self._bitsToNextError = bitIndex - bitCount
+
+        self.stats["corrupted"] += 1
+        self.stats["bitErrors"] += errors
+        return corrupted
+
+    def _jitter(self):
+        p, rng = self._profile, self._rng
+        if p.jitterDistribution == "normal":
+            return rng.gauss(0.0, p.jitter)
+        elif p.jitterDistribution == "exponential":
+            return rng.expovariate(1.0/p.jitter)
+        return rng.uniform(-p.jitter, p.jitter)
+
+    def _sendDelay(self, now, size):
+        p, rng = self._profile, self._rng
+        delay = p.latency
+        if p.jitter:
+            delay += self._jitter()
+        if p.delayRate and rng.random() < p.delayRate:
+            delay += p.delay
+            self.stats["delayed"] += 1
+        if p.bandwidth:
+            # Token bucket expressed as a virtual "link free" time. A
+            # full bucket is the same as the link having been free
+            # for burst/bandwidth seconds.
+            self._linkFree = max(self._linkFree, now - (p.burst / p.bandwidth)) + (size / p.bandwidth)
+            delay = max(delay, self._linkFree - now)
+        return max(delay, 0.0)
+
+    def write(self, data):
+        if self._profile.version != self._profileVersion:
+            self._refreshProfile()
+        p, rng = self._profile, self._rng
+
+        self.stats["packets"] += 1
+        self.stats["bytes"] += len(data)
+
+        if p.lossRate and rng.random() < p.lossRate:
+            self.stats["dropped"] += 1
+            return
+
+        data = self._corrupt(data)
+
+        copies = 1
+        if p.duplicateRate and rng.random() < p.duplicateRate:
+            self.stats["duplicated"] += 1
+            copies = 2
+
+        now = self._loop.time()
+        for i in range(copies):
+            if self._held is None and p.reorderRate and rng.random() < p.reorderRate:
+                # hold this packet until the next one has been sent.
+                self.stats["reordered"] += 1
+                self._held = self._enqueue(now + self.REORDER_HOLD, data)
+                continue
+
+            delay = self._sendDelay(now, len(data))
+            if delay == 0.0 and self._held is None:
+                self._rawWrite(data)
+            else:
+                self._enqueue(now + delay, data)
+
+            if self._held is not None:
+                # release the held packet right behind this one
+                heldData = self._held[2]
+                self._held[2] = None
+                self._held = None
+                self._enqueue(now + delay, heldData)
+
+    def _enqueue(self, deadline, data):
+        # entries are lists so a held packet can be cancelled in place
+        self._queueCount += 1
+        entry = [deadline, self._queueCount, data]
+        heapq.heappush(self._queue, entry)
+        if self._timerDeadline is None or deadline < self._timerDeadline:
+            self._scheduleTimer(deadline)
+        return entry
+
+    def _scheduleTimer(self, deadline):
+        if self._timer:
+            self._timer.cancel()
+        self._timerDeadline = deadline
+        self._timer = self._loop.call_later(max(deadline - self._loop.time(), 0), self._drain)
+
+    def _drain(self):
+        self._timer = None
+        self._timerDeadline = None
+        now = self._loop.time()
+        ready = []
+        while self._queue and self._queue[0][0] <= now:
+            entry = heapq.heappop(self._queue)
+            if entry is self._held:
+                self._held = None
+            if entry[2] is not None:
+                ready.append(entry[2])
+        if ready:
+            self._rawWrite(*ready)
+        if self._queue:
+            self._scheduleTimer(self._queue[0][0])
+
+    def _rawWrite(self, *packets):
+        try:
+            if len(packets) == 1:
+                self.lowerTransport().write(packets[0])
+            else:
+                self.lowerTransport().writelines(packets)
+        except Exception as e:
+            logger.info("Could not write data lower because {}".format(e))
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+            self._timerDeadline = None
+        self._queue = []
+        self._held = None
+        return super().close()
+
+def basicUnitTest():
+    from playground.network.testing import MockTransportToStorageStream as MockTransport
+    import io
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def run(profile, packets, seed):
+        sink = io.BytesIO()
+        transport = ImpairmentTransport(MockTransport(sink), profile, random.Random(seed), loop)
+        for packet in packets:
+            transport.write(packet)
+        loop.run_until_complete(asyncio.sleep(.05))
+        return transport, sink.getvalue()
+
+    packets = [bytes([i])*1000 for i in range(100)]
+    original = b"".join(packets)
+
+    # no impairments: everything goes straight through
+    clean = ImpairmentProfile(**{"bit-error-rate":0, "delay-rate":0})
+    transport, output = run(clean, packets, 1)
+    assert output == original
+
+    # corruption is reproducible with the same seed and the length is unchanged
+    noisy = ImpairmentProfile(**{"bit-error-rate":.001, "delay-rate":0})
+    transport1, output1 = run(noisy, packets, 2)
+    transport2, output2 = run(noisy, packets, 2)
+    assert output1 == output2
+    assert len(output1) == len(original) and output1 != original
+    assert transport1.stats["bitErrors"] > 0
+
+    # loss drops whole packets
+    lossy = ImpairmentProfile(**{"bit-error-rate":0, "delay-rate":0, "loss":.5})
+    transport, output = run(lossy, packets, 3)
+    assert len(output) == 1000*(100-transport.stats["dropped"])
+    assert 0 < transport.stats["dropped"] < 100
+
+    # duplication and reordering do not lose anything
+    messy = ImpairmentProfile(**{"bit-error-rate":0, "delay-rate":0, "duplicate":.1, "reorder":.1})
+    transport, output = run(messy, packets, 4)
+    assert len(output) == 1000*(100+transport.stats["duplicated"])
+    assert transport.stats["reordered"] > 0 and output != original
+
+    # latency holds everything until the timer fires
+    slow = ImpairmentProfile(**{"bit-error-rate":0, "delay-rate":0, "latency":.01, "jitter":.005})
+    sink = io.BytesIO()
+    transport = ImpairmentTransport(MockTransport(sink), slow, random.Random(5), loop)
+    transport.write(b"delayed")
+    assert sink.getvalue() == b""
+    loop.run_until_complete(asyncio.sleep(.05))
+    assert sink.getvalue() == b"delayed"
+
+    # bandwidth limits: 10k bytes/sec with a 1k burst
+    capped = ImpairmentProfile(**{"bit-error-rate":0, "delay-rate":0, "bandwidth":10000, "burst":1000})
+    sink = io.BytesIO()
+    transport = ImpairmentTransport(MockTransport(sink), capped, random.Random(6), loop)
+    for packet in packets[:3]:
+        transport.write(packet)
+    assert len(sink.getvalue()) == 1000
+    loop.run_until_complete(asyncio.sleep(.25))
+    assert len(sink.getvalue()) == 3000
+
+    loop.close()
+
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic Unit Test completed successfully")
@@ -6,95 +6,163 @@ Original File Created on Aug 20, 2013
 @author: sethjn
 '''
 
-from playground.network.common import StackingTransport
 from .Switch import Switch
-import random, asyncio, logging
+from .LinkImpairment import ImpairmentProfile, ImpairmentTransport
+import random, logging
 
 logger = logging.getLogger(__name__)
 
-class ConstantErrorTransport(StackingTransport):
+class UnreliableSwitch(Switch):
     """
-    This isn't really a stacking transport. 
-    However, a basic stacking transport just writes
-    everything to the lower layer. And that's mostly 
-    what we want.
-    
-    Why doesn't asyncio have a better basic transport class? 
-    
-    By default, 1 error every 100k
+    A switch that impairs the links it writes to. Every link gets
+    its own ImpairmentTransport and its own random stream derived
+    from the switch seed and the link's address, so a run can be
+    reproduced by reusing the seed.
+
+    Links use the default profile unless a profile has been set
+    for their address.
     """
+    DEFAULT_PROFILE_KEY = "default"
     
-    ErrorHorizon = 100*1024
-    ErrorsPerHorizon = 1
+    # Old style error rates were expressed as errors per horizon bytes
+    DEFAULT_ERROR_HORIZON = 100*1024
     
-    def __init__(self, *args, **kargs):
-        super().__init__(*args, **kargs)
-        self.byteIndex = 0
+    def __init__(self, seed=None):
+        super().__init__()
+        if seed == None:
+            seed = random.getrandbits(32)
+        self._seed = seed
+        self._defaultProfile = ImpairmentProfile()
+        self._linkProfiles = {}
+        self._linkSeedCounts = {}
+        self._errorHorizon = self.DEFAULT_ERROR_HORIZON
         
-        self.resetBytesToCorrupt()
+    def getSeed(self):
+        return self._seed
         
-    def resetBytesToCorrupt(self):
-        self.bytesToCorrupt = []
-        for i in range(self.ErrorsPerHorizon):
-            nextBadByte = random.randint(0, self.ErrorHorizon)
-            if nextBadByte not in self.bytesToCorrupt:
-                self.bytesToCorrupt.append(nextBadByte)
-        self.bytesToCorrupt.sort()
-        self.curSettings = (self.ErrorsPerHorizon, self.ErrorHorizon)
-    
-    
-    def write(self, data):
-        if self.curSettings != (self.ErrorsPerHorizon, self.ErrorHorizon):
-            self.resetBytesToCorrupt()
-        dataRange = len(data) + self.byteIndex
-        while self.bytesToCorrupt and self.bytesToCorrupt[0] < dataRange:
-            nextByte = self.bytesToCorrupt.pop(0)
-            relativeByte = nextByte - self.byteIndex
-            data = data[:relativeByte] + bytes([data[relativeByte] ^ 0xFF]) + data[relativeByte+1:]
-        self.byteIndex += len(data)
-        if self.byteIndex > self.ErrorHorizon:
-            self.byteIndex = 0
-            self.resetBytesToCorrupt()
-        self.lowerTransport().write(data)
+    def setSeed(self, seed):
+        """
+        Only affects links registered after the change.
+        """
+        self._seed = seed
+        self._linkSeedCounts = {}
         
-class DelayTransport(StackingTransport):
-    """
-    Will occasionally (about every 100 transmissions), delay
-    sending by 1 second.
-    """
-    Rate = .01
-    Delay = 1.0
-    
-    def write(self, data):
-        if random.random() < self.Rate:
-            asyncio.get_event_loop().call_later(self.Delay, self.raw_write, data)
-        else:
-            self.raw_write(data)
+    def _linkRandom(self, address):
+        # Several links can share one address. Give each its own stream.
+        count = self._linkSeedCounts.get(address, 0)
+        self._linkSeedCounts[address] = count + 1
+        return random.Random("{}/{}/{}".format(self._seed, address, count))
+        
+    def getProfile(self, address=DEFAULT_PROFILE_KEY):
+        return self._linkProfiles.get(address, self._defaultProfile)
+        
+    def setImpairment(self, address, setting, value):
+        if address == self.DEFAULT_PROFILE_KEY:
+            self._defaultProfile.set(setting, value)
+            return
+        if address not in self._linkProfiles:
+            self._linkProfiles[address] = self._defaultProfile.copy()
+            self._updateLinks(address)
+        self._linkProfiles[address].set(setting, value)
+        
+    def clearImpairment(self, address):
+        if address in self._linkProfiles:
+            del self._linkProfiles[address]
+            self._updateLinks(address)
             
-    def raw_write(self, data):
-        try:
-            self.lowerTransport().write(data)
-        except Exception as e:
-            logger.info("Could not write data lower because {}".format(e))
+    def getImpairment(self, address=DEFAULT_PROFILE_KEY):
+        return str(self.getProfile(address))
+        
+    def _updateLinks(self, address):
+        profile = self.getProfile(address)
+        for protocol in self._addressToLinks.get(address, []):
+            if isinstance(protocol.transport, ImpairmentTransport):
+                protocol.transport.setProfile(profile)
+                
+    def getLinkStats(self):
+        stats = {}
+        for protocol, address in self._linkToAddress.items():
+            if isinstance(protocol.transport, ImpairmentTransport):
+                linkStats = stats.setdefault(address, {})
+                for key, value in protocol.transport.stats.items():
+                    linkStats[key] = linkStats.get(key, 0) + value
+        return stats
         
-class UnreliableSwitch(Switch):      
     def setErrorRate(self, rate, horizon):
-        ConstantErrorTransport.ErrorHorizon = horizon
-        ConstantErrorTransport.ErrorsPerHorizon = rate
+        """
+        rate errors per horizon bytes. The horizon must be positive;
+        for no errors, set a rate of 0.
+        """
+        if horizon <= 0:
+            raise Exception("Error rate horizon must be a positive number of bytes. Got {}".format(horizon))
+        self._errorHorizon = horizon
+        self._defaultProfile.set("bit-error-rate", rate/(horizon*8.0))
         
-    def getDelayRate(self):
-        return DelayTransport.Rate, DelayTransport.Delay
-    
     def getErrorRate(self):
-        return ConstantErrorTransport.ErrorsPerHorizon, ConstantErrorTransport.ErrorHorizon
+        rate = self._defaultProfile.get("bit-error-rate")*self._errorHorizon*8
+        return rate, self._errorHorizon
+        
+    def getDelayRate(self):
+        return self._defaultProfile.get("delay-rate"), self._defaultProfile.get("delay")
         
     def setDelayRate(self, rate, delay):
-        DelayTransport.Rate = rate
-        DelayTransport.Delay = delay
+        self._defaultProfile.set("delay-rate", rate)
+        self._defaultProfile.set("delay", delay)
         
     def registerLink(self, address, protocol):
-        protocol.transport = DelayTransport(ConstantErrorTransport(protocol.transport))
         super().registerLink(address, protocol)
+        if self._linkToAddress.get(protocol, None) != address:
+            # bad address; the switch dropped it
+            return
+        profile = self.getProfile(address)
+        if isinstance(protocol.transport, ImpairmentTransport):
+            # re-announcements (e.g., promiscuous mode) must not stack transports
+            protocol.transport.setProfile(profile)
+        else:
+            protocol.transport = ImpairmentTransport(protocol.transport, profile, self._linkRandom(address))
 
-        
+def basicUnitTest():
+    from playground.network.testing import MockTransportToStorageStream as MockTransport
+    import asyncio, io
+    
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    
+    s = UnreliableSwitch(seed=1)
+    p1 = s.ProtocolFactory()
+    p2 = s.ProtocolFactory()
+    p1.connection_made(MockTransport(io.BytesIO()))
+    p2.connection_made(MockTransport(io.BytesIO()))
+    s.registerLink("1.1.1.1", p1)
+    s.registerLink("2.2.2.2", p2)
+    assert isinstance(p1.transport, ImpairmentTransport)
+    assert p1.transport.profile() is s.getProfile()
+    
+    # re-announcing does not stack another transport
+    s.registerLink("1.1.1.1", p1)
+    assert not isinstance(p1.transport.lowerTransport(), ImpairmentTransport)
+    
+    # per-link settings only touch that link
+    s.setImpairment("1.1.1.1", "loss", 1.0)
+    assert p1.transport.profile().get("loss") == 1.0
+    assert p2.transport.profile().get("loss") == 0.0
+    p1.transport.write(b"dropped")
+    assert p1.transport.lowerTransport().sink.getvalue() == b""
+    assert s.getLinkStats()["1.1.1.1"]["dropped"] == 1
+    
+    s.clearImpairment("1.1.1.1")
+    assert p1.transport.profile() is s.getProfile()
+    
+    s.setErrorRate(1, 1024)
+    assert s.getErrorRate() == (1, 1024)
+    for horizon in [0, -1]:
+        rejected = False
+        try:
+            s.setErrorRate(1, horizon)
+        except Exception:
+            rejected = True
+        assert rejected
+    assert s.getErrorRate() == (1, 1024)
     
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic Unit Test completed successfully")
@@ -0,0 +1,492 @@
+'''
+Packet capture for the VNIC.
+
+Every packet the VNIC demuxes is offered to PacketCapture. Each
+capture session may have a filter, which is checked before anything
+else; a packet that no session wants is never serialized. A wanted
+packet is serialized once, as a framed WirePacket, into a ring
+shared by all sessions. Sessions read the ring at their own pace.
+A session that falls more than the ring's capacity behind (e.g.,
+a dump connection that stopped reading) loses the oldest records,
+which are counted in its "lost" stat.
+
+Capture file format (integers are big endian):
+
+    file header  8 bytes   b"PGCAP", version (uint8, currently 1),
+                           reserved (uint16, 0)
+    each record  12 bytes  timestamp (float64, seconds since the epoch),
+                           frame length (uint32)
+                 n bytes   the framed WirePacket, exactly as it is
+                           sent to dump connections
+
+ReadCaptureFile iterates over the (timestamp, WirePacket) records
+of a capture file.
+'''
+
+from playground.network.protocols.switching import WireFragmenter
+from playground.network.protocols.packets.switching_packets import WirePacket
+from collections import deque, OrderedDict
+import asyncio, logging, mmap, struct, time
+
+logger = logging.getLogger(__name__)
+
+FILE_MAGIC     = b"PGCAP"
+FILE_VERSION   = 1
+FILE_HEADER    = struct.Struct("!5sBH")
+RECORD_HEADER  = struct.Struct("!dI")
+
+class CaptureFilter:
+    """
+    A BPF-like filter on packet addresses and ports. An expression
+    is primitives joined by "and" and "or" ("and" binds tighter).
+    Each primitive may be preceded by "not":
+
+        [src|dst] host ADDRESS     (trailing parts may be *, as in 1.1.*.*)
+        [src|dst] port PORT
+
+    Without src or dst, either side can match. For example,
+    "host 1.1.1.1 and port 101 or src host 2.*.*.*".
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self._alternatives = self._parse(expression.split())
+
+    def _parse(self, tokens):
+        alternatives = [[]]
+        position = 0
+        while True:
+            test, position = self._parsePrimitive(tokens, position)
+            alternatives[-1].append(test)
+            if position == len(tokens):
+                return alternatives
+            if tokens[position] == "or":
+                alternatives.append([])
+            elif tokens[position] != "and":
+                raise Exception("Expected 'and' or 'or' in filter, got {}".format(tokens[position]))
+            position += 1
+
+    def _parsePrimitive(self, tokens, position):
+        negate = direction = None
+        if position < len(tokens) and tokens[position] == "not":
+            negate = True
+            position += 1
+        if position < len(tokens) and tokens[position] in ("src", "dst"):
+            direction = tokens[position]
+            position += 1
+        if position+1 >= len(tokens):
+            raise Exception("Incomplete filter expression {}".format(self.expression))
+        kind, value = tokens[position], tokens[position+1]
+        if kind == "host":
+            match = self._addressMatch(value)
+            source = lambda s, sp, d, dp: match(s)
+            destination = lambda s, sp, d, dp: match(d)
+        elif kind == "port":
+            port = int(value)
+            source = lambda s, sp, d, dp: sp == port
+            destination = lambda s, sp, d, dp: dp == port
+        else:
+            raise Exception("Unknown filter primitive {}".format(kind))
+
+        if direction == "src":
+            test = source
+        elif direction == "dst":
+            test = destination
+        else:
+            test = lambda s, sp, d, dp: source(s, sp, d, dp) or destination(s, sp, d, dp)
+        if negate:
+            positive = test
+            test = lambda s, sp, d, dp: not positive(s, sp, d, dp)
+        return test, position+2
+
+    def _addressMatch(self, pattern):
+        parts = pattern.split(".")
+        if "*" not in parts:
+            return lambda address: address == pattern
+        wildcard = parts.index("*")
+        if any(part != "*" for part in parts[wildcard:]):
+            raise Exception("Only trailing parts of an address may be *: {}".format(pattern))
+        prefix = wildcard and ".".join(parts[:wildcard])+"." or ""
+        return lambda address: address.startswith(prefix)
+
+    def matches(self, source, sourcePort, destination, destinationPort):
+        for conjunction in self._alternatives:
+            for test in conjunction:
+                if not test(source, sourcePort, destination, destinationPort):
+                    break
+            else:
+                return True
+        return False
+
+    def __str__(self):
+        return self.expression
+
+class CaptureSession:
+    """
+    Base class for something that receives captured packets.
+    Subclasses implement deliver(records), where records is a list
+    of (timestamp, frame).
+    """
+    def __init__(self, filter=None):
+        self.setFilter(filter)
+        self.paused = False
+        self.stats = {
+            "packets": 0,
+            "bytes":   0,
+            "lost":    0,
+        }
+        # set by PacketCapture
+        self.bit = 0
+        self.cursor = 0
+        self.capture = None
+
+    def setFilter(self, filter):
+        if isinstance(filter, str):
+            filter = filter.strip() and CaptureFilter(filter) or None
+        self.filter = filter
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.capture and self.capture.drain(self)
+
+    def deliver(self, records):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class TransportCaptureSession(CaptureSession):
+    """
+    Sends captured frames to a transport (a dump connection).
+    """
+    def __init__(self, transport, filter=None):
+        super().__init__(filter)
+        self.transport = transport
+
+    def deliver(self, records):
+        self.transport.writelines([frame for timestamp, frame in records])
+
+    def __str__(self):
+        return "dump to {}".format(self.transport.get_extra_info("peername"))
+
+class FileCaptureSession(CaptureSession):
+    """
+    Writes captured packets to a capture file (see the module
+    documentation for the format).
+
+    Records are batched and written once batchSize bytes are waiting
+    or flushInterval seconds after the first one. With mmapSize, the
+    file is instead preallocated to that size and memory mapped, so
+    each record is a memory copy. When the mapping is full, further
+    records are lost. The file is truncated to its contents on close.
+    """
+    BATCH_SIZE     = 64*1024
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, filter=None, mmapSize=None, batchSize=None, flushInterval=None):
+        super().__init__(filter)
+        self._path = path
+        self._batchSize = batchSize or self.BATCH_SIZE
+        self._flushInterval = flushInterval or self.FLUSH_INTERVAL
+        self._batch = []
+        self._batched = 0
+        self._flushTimer = None
+        self._map = None
+        self._file = open(path, "wb+")
+        header = FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, 0)
+        if mmapSize:
+            if mmapSize < len(header):
+                raise Exception("Capture file size {} is too small".format(mmapSize))
+            self._file.truncate(mmapSize)
+            self._map = mmap.mmap(self._file.fileno(), mmapSize)
+            self._map[:len(header)] = header
+            self._position = len(header)
+        else:
+            self._file.write(header)
+
+    def path(self):
+        return self._path
+
+    def deliver(self, records):
+        if self._map is not None:
+            self._mapRecords(records)
+            return
+        for timestamp, frame in records:
+            self._batch.append(RECORD_HEADER.pack(timestamp, len(frame)))
+            self._batch.append(frame)
+            self._batched += RECORD_HEADER.size + len(frame)
+        if self._batched >= self._batchSize:
+            self.flush()
+        elif self._flushTimer is None:
+            self._flushTimer = asyncio.get_event_loop().call_later(self._flushInterval, self.flush)
+
+    def _mapRecords(self, records):
+        recordMap, position = self._map, self._position
+        for timestamp, frame in records:
+            end = position + RECORD_HEADER.size + len(frame)
+            if end > len(recordMap):
+                self.stats["lost"] += 1
+                continue
+            RECORD_HEADER.pack_into(recordMap, position, timestamp, len(frame))
+            recordMap[position+RECORD_HEADER.size:end] = frame
+            position = end
+        self._position = position
+
+    def flush(self):
+        if self._flushTimer:
+            self._flushTimer.cancel()
+            self._flushTimer = None
+        if self._batch and self._file:
+            self._file.writelines(self._batch)
+            self._file.flush()
+        self._batch = []
+        self._batched = 0
+
+    def close(self):
+        if not self._file: return
+        if self._map is not None:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.truncate(self._position)
+        else:
+            self.flush()
+        self._file.close()
+        self._file = None
+
+    def __str__(self):
+        return "capture to {}".format(self._path)
+
+class PacketCapture:
+    """
+    The capture sessions of one VNIC and the ring of serialized
+    packets they share. Records are (sequence, mask, timestamp,
+    frame); mask has the bit of each session that wants the record.
+    """
+    RING_CAPACITY      = 4*1024*1024
+    MAX_FLOW_TEMPLATES = 16*1024
+
+    def __init__(self, capacity=None, clock=time.time):
+        self._capacity = capacity or self.RING_CAPACITY
+        self._clock = clock
+        self._ring = deque()
+        self._ringSize = 0
+        self._nextSequence = 0
+        self._sessions = []
+
+        # per flow serializers, least recently used first
+        self._framers = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def sessions(self):
+        return list(self._sessions)
+
+    def addSession(self, session):
+        usedBits = 0
+        for other in self._sessions:
+            usedBits |= other.bit
+        bit = 1
+        while bit & usedBits:
+            bit <<= 1
+        session.bit = bit
+        session.cursor = self._nextSequence
+        session.capture = self
+        self._sessions.append(session)
+
+    def removeSession(self, session):
+        if session not in self._sessions: return
+        self._sessions.remove(session)
+        session.capture = None
+        session.close()
+        self._trim()
+
+    def _framer(self, source, sourcePort, destination, destinationPort):
+        flow = (source, sourcePort, destination, destinationPort)
+        framer = self._framers.get(flow)
+        if framer is None:
+            framer = WireFragmenter(source, sourcePort, destination, destinationPort)
+            self._framers[flow] = framer
+            if len(self._framers) > self.MAX_FLOW_TEMPLATES:
+                self._framers.popitem(last=False)
+        else:
+            self._framers.move_to_end(flow)
+        return framer
+
+    def capture(self, source, sourcePort, destination, destinationPort, data):
+        mask = 0
+        for session in self._sessions:
+            if session.filter is None or session.filter.matches(source, sourcePort, destination, destinationPort):
+                mask |= session.bit
+        if not mask: return
+
+        frame = self._framer(source, sourcePort, destination, destinationPort).frame(data)
+        sequence = self._nextSequence
+        self._ring.append((sequence, mask, self._clock(), frame))
+        self._nextSequence += 1
+        self._ringSize += len(frame)
+        while self._ringSize > self._capacity:
+            self._evict()
+
+        for session in self._sessions:
+            if session.bit & mask:
+                session.paused or self._drain(session)
+            elif session.cursor == sequence:
+                # nothing new for this session; it is still caught up
+                session.cursor = self._nextSequence
+        self._trim()
+
+    def drain(self, session):
+        """
+        Delivers the records session has not seen yet.
+        """
+        self._drain(session)
+        self._trim()
+
+    def _drain(self, session):
+        if not self._ring or session.cursor == self._nextSequence:
+            session.cursor = self._nextSequence
+            return
+        firstSequence = self._ring[0][0]
+        records = []
+        size = 0
+        for index in range(max(session.cursor - firstSequence, 0), len(self._ring)):
+            sequence, mask, timestamp, frame = self._ring[index]
+            if mask & session.bit:
+                records.append((timestamp, frame))
+                size += len(frame)
+        session.cursor = self._nextSequence
+        if records:
+            session.stats["packets"] += len(records)
+            session.stats["bytes"] += size
+            try:
+                session.deliver(records)
+            except Exception as e:
+                logger.info("Could not deliver captured packets to {} because {}".format(session, e))
+
+    def _evict(self):
+        sequence, mask, timestamp, frame = self._ring.popleft()
+        self._ringSize -= len(frame)
+        for session in self._sessions:
+            if session.bit & mask and session.cursor <= sequence:
+                session.stats["lost"] += 1
+
+    def _trim(self):
+        # drop records every session has already seen
+        cursor = min((session.cursor for session in self._sessions), default=self._nextSequence)
+        while self._ring and self._ring[0][0] < cursor:
+            self._ringSize -= len(self._ring.popleft()[3])
+
+    def status(self):
+        status = {
+            "sessions":  len(self._sessions),
+            "ring-bytes":self._ringSize,
+            "ring-size": self._capacity,
+        }
+        for session in self._sessions:
+            status[str(session)] = ", ".join("{}={}".format(k, session.stats[k]) for k in session.stats)
+        return status
+
+def ReadCaptureFile(path):
+    """
+    Yields (timestamp, WirePacket) for each record in a capture file.
+    """
+    with open(path, "rb") as captureFile:
+        magic, version, reserved = FILE_HEADER.unpack(captureFile.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise Exception("{} is not a version {} capture file".format(path, FILE_VERSION))
+        while True:
+            header = captureFile.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, frameSize = RECORD_HEADER.unpack(header)
+            deserializer = WirePacket.Deserializer()
+            deserializer.update(captureFile.read(frameSize))
+            for packet in deserializer.nextPackets():
+                yield timestamp, packet
+
+def basicUnitTest():
+    import io, os, tempfile
+    from playground.network.testing import MockTransportToStorageStream as MockTransport
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # filters
+    f = CaptureFilter("host 1.1.1.1 and port 101 or src host 2.2.*.*")
+    assert f.matches("1.1.1.1", 101, "3.3.3.3", 5000)
+    assert f.matches("3.3.3.3", 5000, "1.1.1.1", 101)
+    assert not f.matches("1.1.1.1", 102, "3.3.3.3", 5000)
+    assert f.matches("2.2.9.9", 1, "3.3.3.3", 2)
+    assert not f.matches("3.3.3.3", 2, "2.2.9.9", 1)
+    f = CaptureFilter("not dst port 80")
+    assert f.matches("1.1.1.1", 80, "2.2.2.2", 81)
+    assert not f.matches("1.1.1.1", 81, "2.2.2.2", 80)
+    for bad in ["host", "host 1.*.1.1", "port 1 xor port 2", "net 1.1.1.1"]:
+        try:
+            CaptureFilter(bad)
+            assert False
+        except Exception as e:
+            assert not isinstance(e, AssertionError)
+
+    def frames(data):
+        deserializer = WirePacket.Deserializer()
+        deserializer.update(data)
+        return [packet.data for packet in deserializer.nextPackets()]
+
+    # packets are serialized once and shared; filters apply first
+    capture = PacketCapture(capacity=200, clock=lambda: 1000.0)
+    everything = TransportCaptureSession(MockTransport(io.BytesIO()))
+    onlyPort2 = TransportCaptureSession(MockTransport(io.BytesIO()), "port 2")
+    capture.addSession(everything)
+    capture.addSession(onlyPort2)
+    capture.capture("1.1.1.1", 1, "2.2.2.2", 1000, b"one")
+    capture.capture("1.1.1.1", 2, "2.2.2.2", 1000, b"two")
+    assert frames(everything.transport.sink.getvalue()) == [b"one", b"two"]
+    assert frames(onlyPort2.transport.sink.getvalue()) == [b"two"]
+    assert len(capture._ring) == 0
+
+    # a paused session catches up from the ring, losing what was evicted
+    onlyPort2.pause()
+    for i in range(10):
+        capture.capture("1.1.1.1", 2, "2.2.2.2", 1000, bytes([i])*10)
+    assert len(frames(everything.transport.sink.getvalue())) == 12
+    assert onlyPort2.stats["lost"] > 0 and capture._ringSize <= 200
+    onlyPort2.resume()
+    received = frames(onlyPort2.transport.sink.getvalue())
+    assert received[-1] == bytes([9])*10
+    assert len(received) == 1 + 10 - onlyPort2.stats["lost"]
+    assert len(capture._ring) == 0
+
+    capture.removeSession(everything)
+    capture.removeSession(onlyPort2)
+    capture.capture("1.1.1.1", 2, "2.2.2.2", 1000, b"nobody")
+    assert len(capture._ring) == 0
+
+    # capture files, batched and memory mapped
+    directory = tempfile.mkdtemp()
+    for mmapSize in [None, 200]:
+        path = os.path.join(directory, "capture{}.pgcap".format(mmapSize))
+        session = FileCaptureSession(path, "dst host 2.2.2.2", mmapSize=mmapSize)
+        capture.addSession(session)
+        for i in range(5):
+            capture.capture("1.1.1.1", 1, "2.2.2.2", 1000, bytes([i])*20)
+            capture.capture("1.1.1.1", 1, "3.3.3.3", 1000, b"filtered")
+        capture.removeSession(session)
+        records = list(ReadCaptureFile(path))
+        assert all(timestamp == 1000.0 for timestamp, packet in records)
+        if mmapSize:
+            assert len(records) < 5 and session.stats["lost"] == 5 - len(records)
+        else:
+            assert len(records) == 5
+        assert [packet.data for timestamp, packet in records] == [bytes([i])*20 for i in range(len(records))]
+        os.unlink(path)
+    os.rmdir(directory)
+    loop.close()
+
+if __name__=="__main__":
+    basicUnitTest()
+    print("Basic Unit Test completed successfully")
@@ -6,42 +6,277 @@ from playground.common import CustomConstant as Constant
 from playground.network.protocols.vsockets import VNICSocketControlProtocol
 from playground.network.protocols.switching import PlaygroundSwitchTxProtocol
 from playground.network.protocols.packets.switching_packets import WirePacket, FramedPacketType
+from .PacketCapture import PacketCapture, TransportCaptureSession, FileCaptureSession
 from playground.network.common import PortKey
 from playground.network.common import PlaygroundAddress, PlaygroundAddressBlock
 
 from asyncio import Protocol
-import io, logging
+from collections import deque
+import asyncio, logging, time
 
 logger = logging.getLogger(__name__)
         
 class ConnectionData: 
-        
-    def __init__(self, portKey, control):
+    """
+    Routes data for one connection to its spawned transport. Until
+    the reverse connection is up, data waits in a backlog bounded
+    by maxBacklog bytes. Beyond that, data is dropped unless a
+    pressure callback is given. Then pressure(self, True) is called
+    so the sender can be pushed back, and up to twice maxBacklog is
+    kept. pressure(self, False) is called when the backlog is
+    flushed or the connection is closed.
+    
+    onBacklog, if set, is called (once) when data is first held.
+    """
+    MAX_BACKLOG = 1024*1024
+    
+    def __init__(self, portKey, control, maxBacklog=None, pressure=None):
         self.portKey = portKey
-        self.writer = io.BytesIO()
+        self.writer = None
         self.control = control
+        self._backlog = deque()
+        self._backlogSize = 0
+        self._maxBacklog = maxBacklog or self.MAX_BACKLOG
+        self._pressure = pressure
+        self._pushingBack = False
+        self.dropped = 0
+        self.onBacklog = None
+        
+    def backlogSize(self):
+        return self._backlogSize
+        
+    def takeBacklog(self):
+        data = b"".join(self._backlog)
+        self._backlog.clear()
+        self._backlogSize = 0
+        return data
         
     def setProtocol(self, protocol):
-        backlog = self.writer.getvalue()
-        if len(backlog) > 0:
-            protocol.transport.write(backlog)
-        self.writer = protocol.transport
+        transport = protocol.transport
+        if self._backlog:
+            transport.writelines(self._backlog)
+            self._backlog.clear()
+            self._backlogSize = 0
+        self.writer = transport
+        self._releasePressure()
         
     def write(self, data):
-        self.writer.write(data)
+        if self.writer is not None:
+            self.writer.write(data)
+            return
+        size = len(data)
+        if self._backlogSize + size > self._maxBacklog:
+            if self._pressure is None or self._backlogSize + size > 2*self._maxBacklog:
+                self.dropped += size
+                logger.debug("{} backlog full. Dropping {} bytes".format(self.portKey, size))
+                return
+            if not self._pushingBack:
+                self._pushingBack = True
+                self._pressure(self, True)
+        self._backlog.append(bytes(data))
+        self._backlogSize += size
+        if self.onBacklog:
+            onBacklog, self.onBacklog = self.onBacklog, None
+            onBacklog()
+        
+    def _releasePressure(self):
+        if self._pushingBack:
+            self._pushingBack = False
+            self._pressure(self, False)
     
     def close(self):
         try:
             self.writer and self.writer.close()
         except:
             pass
+        self._backlog.clear()
+        self._backlogSize = 0
+        self._releasePressure()
         self.control.spawnedConnectionClosed(self.portKey)
+        
+class AddressInterner:
+    """
+    Maps playground address strings to small integers so that
+    connection keys can be a single int. Ids are reference counted
+    and reused once no connection refers to the address.
+    """
+    def __init__(self):
+        self._ids = {}
+        self._refs = {}
+        self._free = []
+        self._nextId = 0
+        
+    def __len__(self):
+        return len(self._ids)
+        
+    def lookup(self, address):
+        return self._ids.get(address)
+        
+    def acquire(self, address):
+        addressId = self._ids.get(address)
+        if addressId is None:
+            if self._free:
+                addressId = self._free.pop()
+            else:
+                addressId = self._nextId
+                self._nextId += 1
+            self._ids[address] = addressId
+            self._refs[address] = 0
+        self._refs[address] += 1
+        return addressId
+        
+    def release(self, address):
+        self._refs[address] -= 1
+        if self._refs[address] == 0:
+            del self._refs[address]
+            self._free.append(self._ids.pop(address))
+            
+class PortAllocator:
+    """
+    Hands out ephemeral ports from [start, end) in O(1). A bytearray
+    records the state of every port in the range and free ports wait
+    in a FIFO, so the least recently used port is handed out first.
+    
+    Released ports are quarantined for reuseDelay seconds (like TCP's
+    TIME_WAIT) before going back in the FIFO, so late packets for an
+    old connection are not delivered to a new one. Ports outside the
+    range are not managed here.
+    """
+    FREE, IN_USE, QUARANTINED = 0, 1, 2
+    
+    def __init__(self, start=2000, end=(2**16)-1, reuseDelay=30.0, clock=time.monotonic):
+        if not (0 < start < end <= 2**16):
+            raise Exception("Invalid port range {}-{}".format(start, end))
+        self._start = start
+        self._end = end
+        self._reuseDelay = reuseDelay
+        self._clock = clock
+        self._state = bytearray(end-start)
+        
+        # the free FIFO can hold stale entries for ports reserved
+        # explicitly (see reserve); they are skipped when popped.
+        # _queued marks ports with an entry in the FIFO, so a port that
+        # is reserved and released over and over is only queued once.
+        self._free = deque(range(start, end))
+        self._queued = bytearray(b"\x01"*(end-start))
+        self._freeCount = end-start
+        
+        # released ports in release order, with the time they were released
+        self._quarantine = deque()
+        self._releaseTimes = {}
+        self._quarantineCount = 0
+        
+        self.stats = {
+            "allocations": 0,
+            "releases":    0,
+            "failures":    0,
+        }
+        
+    def range(self):
+        return (self._start, self._end)
+        
+    def reuseDelay(self):
+        return self._reuseDelay
+        
+    def setReuseDelay(self, reuseDelay):
+        if reuseDelay < 0:
+            raise Exception("Port reuse delay cannot be negative")
+        self._reuseDelay = reuseDelay
+        
+    def inRange(self, port):
+        return self._start <= port < self._end
+        
+    def _enqueueFree(self, port):
+        index = port - self._start
+        self._state[index] = self.FREE
+        self._freeCount += 1
+        if not self._queued[index]:
+            self._queued[index] = 1
+            self._free.append(port)
+            
+    def _expireQuarantine(self):
+        if not self._quarantine: return
+        expired = self._clock() - self._reuseDelay
+        while self._quarantine and self._quarantine[0][0] <= expired:
+            releaseTime, port = self._quarantine.popleft()
+            index = port - self._start
+            # a quarantined port can be reserved (and released again)
+            # before it expires. Only the newest release counts.
+            if self._state[index] == self.QUARANTINED and releaseTime == self._releaseTimes.get(port):
+                del self._releaseTimes[port]
+                self._quarantineCount -= 1
+                self._enqueueFree(port)
+                
+    def allocate(self):
+        """
+        Returns a free port, or None if every port in the range is in
+        use or quarantined.
+        """
+        self._expireQuarantine()
+        while self._free:
+            port = self._free.popleft()
+            index = port - self._start
+            self._queued[index] = 0
+            if self._state[index] != self.FREE: continue
+            self._state[index] = self.IN_USE
+            self._freeCount -= 1
+            self.stats["allocations"] += 1
+            return port
+        self.stats["failures"] += 1
+        return None
+        
+    def reserve(self, port):
+        """
+        Claims a specific port (e.g., for a listener). Quarantined
+        ports can be reserved explicitly. Returns False if the port
+        is already in use.
+        """
+        if not self.inRange(port): return True
+        index = port - self._start
+        state = self._state[index]
+        if state == self.IN_USE: return False
+        if state == self.FREE:
+            self._freeCount -= 1
+        else:
+            self._releaseTimes.pop(port, None)
+            self._quarantineCount -= 1
+        self._state[index] = self.IN_USE
+        return True
+        
+    def release(self, port):
+        if not self.inRange(port): return
+        index = port - self._start
+        if self._state[index] != self.IN_USE: return
+        self.stats["releases"] += 1
+        if self._reuseDelay <= 0:
+            self._enqueueFree(port)
+            return
+        releaseTime = self._clock()
+        self._state[index] = self.QUARANTINED
+        self._releaseTimes[port] = releaseTime
+        self._quarantine.append((releaseTime, port))
+        self._quarantineCount += 1
+        
+    def status(self):
+        self._expireQuarantine()
+        status = {
+            "range":       "{}-{}".format(self._start, self._end),
+            "in-use":      (self._end - self._start) - self._freeCount - self._quarantineCount,
+            "free":        self._freeCount,
+            "quarantined": self._quarantineCount,
+            "reuse-delay": self._reuseDelay,
+        }
+        status.update(self.stats)
+        return status
             
 class VNIC:
     _STARTING_SRC_PORT = 2000
     _MAX_PORT          = (2**16)-1
 
-    def __init__(self, playgroundAddress):
+    _PORT_REUSE_DELAY  = 30.0
+
+    def __init__(self, playgroundAddress, incrementalDelivery=False, portRange=None, portReuseDelay=None,
+                 maxBacklog=None, backlogPushback=False, coalesceBytes=None):
         self._address = PlaygroundAddress.FromString(playgroundAddress)
         logger.info("{} just started up".format(self))
         
@@ -50,17 +285,75 @@ class VNIC:
         # a connection is tied to the port.
         self._ports = {}
         self._connections = {}
-        self._dumps = set([])
-        self._freePorts = self._freePortsGenerator()
+        
+        # demux table: compact int key (see _demuxKey) -> ConnectionData,
+        # plus the last flow demuxed, which is usually the next one too.
+        self._addresses = AddressInterner()
+        self._demuxTable = {}
+        self._lastDemux = None
+        
+        # packet capture. Dump connections (protocol -> session) and capture
+        # files (path -> session). self._capture is None when neither is active.
+        self._dumps = {}
+        self._captureFiles = {}
+        self._capture = None
+        
+        # ephemeral ports for outbound connections. portRange is (start, end),
+        # end exclusive. Closed ports are not reused for portReuseDelay seconds.
+        if portRange is None: 
+            portRange = (self._STARTING_SRC_PORT, self._MAX_PORT)
+        if portReuseDelay is None:
+            portReuseDelay = self._PORT_REUSE_DELAY
+        self._portAllocator = PortAllocator(portRange[0], portRange[1], portReuseDelay)
+        
         self._linkTx = None#PlaygroundSwitchTxProtocol(self, self.address())
         self._connectedToNetwork = False
         self._promiscuousMode = None
+        self._mtu = None
+        
+        # deliver large messages to connections in order as they arrive,
+        # rather than after the whole message has been reassembled.
+        self._incrementalDelivery = incrementalDelivery
+        
+        # data for a connection whose reverse connection is not up yet is
+        # held up to maxBacklog bytes. Past that it is dropped or, with
+        # backlogPushback, reading from the switch is paused until the
+        # backlog drains.
+        self._maxBacklog = maxBacklog
+        self._backlogPushback = backlogPushback
+        self._pushingBack = set([])
+        
+        # small outbound writes to the same connection within one loop
+        # iteration are sent as one packet, up to coalesceBytes. Off when
+        # coalesceBytes is 0 or None. Connections can opt out per write.
+        self._coalesceBytes = coalesceBytes
+        self._pendingWrites = {}
+        self._flushHandle = None
+        
+    def portAllocator(self):
+        return self._portAllocator
         
-    def _freePortsGenerator(self):
-        while True:
-            for i in range(self._STARTING_SRC_PORT, self._MAX_PORT):
-                if i in self._ports: continue
-                yield i
+    def _newConnectionData(self, portKey, control):
+        pressure = self._backlogPressure if self._backlogPushback else None
+        return ConnectionData(portKey, control, self._maxBacklog, pressure)
+        
+    def _backlogPressure(self, connectionData, pushBack):
+        wasPushingBack = bool(self._pushingBack)
+        if pushBack:
+            self._pushingBack.add(connectionData)
+        else:
+            self._pushingBack.discard(connectionData)
+        if wasPushingBack == bool(self._pushingBack): return
+        if not self._linkTx or not self._linkTx.transport: return
+        try:
+            if self._pushingBack:
+                logger.debug("{} backlog full. Pausing switch link".format(self))
+                self._linkTx.transport.pause_reading()
+            else:
+                logger.debug("{} backlogs drained. Resuming switch link".format(self))
+                self._linkTx.transport.resume_reading()
+        except Exception as e:
+            logger.debug("{} could not pause or resume the switch link because {}".format(self, e))
                 
     def promiscuousLevel(self):
         if self._promiscuousMode == None: return 0
@@ -91,6 +384,24 @@ class VNIC:
             listeningBlock = listeningBlock.getParentBlock()
         self._linkTx.changeRegisteredAddress(str(listeningBlock))
         
+    def mtu(self):
+        if self._mtu == None:
+            return PlaygroundSwitchTxProtocol.MAX_MSG_SIZE
+        return self._mtu
+        
+    def setMtu(self, mtu):
+        """
+        Set the largest amount of data sent to the switch in one
+        packet. Larger writes are fragmented. None restores the default.
+        """
+        if mtu != None:
+            mtu = int(mtu)
+            if mtu <= 0:
+                raise Exception("Invalid MTU {}".format(mtu))
+        self._mtu = mtu
+        if self._linkTx:
+            self._linkTx.setMtu(self._mtu)
+        
     def address(self):
         return self._address
         
@@ -100,7 +411,8 @@ class VNIC:
     def switchConnectionFactory(self):
         if self._linkTx and self._linkTx.transport:
             self._linkTx.transport.close()
-        self._linkTx = PlaygroundSwitchTxProtocol(self, self.address())
+        self._linkTx = PlaygroundSwitchTxProtocol(self, self.address(), mtu=self._mtu,
+                                                  incrementalDelivery=self._incrementalDelivery)
         return self._linkTx
         
     def controlConnectionFactory(self):
@@ -123,58 +435,126 @@ class VNIC:
         self._connectedToNetwork = False
         self._linkTx = None
         
-    def demux(self, source, sourcePort, destination, destinationPort, data):
-        logger.debug("{} received {} bytes of data from {}:{} for {}:{}".format(self, len(data), source, sourcePort, destination, destinationPort))
-        for dumper in self._dumps:
-            dumpPacket = WirePacket(source=source, sourcePort=sourcePort,
-                                    destination=destination, destinationPort=destinationPort,
-                                    data=data)
-            dumper.transport.write(dumpPacket.__serialize__())
-                
-        remotePortKey = PortKey(source, sourcePort, destination, destinationPort)
+    def _demuxKey(self, remote, remotePort, local, localPort):
+        """
+        A single int for the 4-tuple, or None if either address has
+        no connections. Ports are 16 bits; address ids fit in 24.
+        """
+        remoteId = self._addresses.lookup(remote)
+        localId = self._addresses.lookup(local)
+        if remoteId is None or localId is None:
+            return None
+        return (((remoteId << 16) | remotePort) << 40) | (localId << 16) | localPort
+        
+    def _addConnection(self, portKey, connectionData):
+        self._connections[portKey] = connectionData
+        # connection port keys are local -> remote
+        self._addresses.acquire(portKey.source)
+        self._addresses.acquire(portKey.destination)
+        demuxKey = self._demuxKey(portKey.destination, portKey.destinationPort, portKey.source, portKey.sourcePort)
+        self._demuxTable[demuxKey] = connectionData
         
-        # this portkey is backwards. The source is from the remote machine
-        # but our ports have the remote machine being the destination. 
-        # So, invert:
+    def _removeConnection(self, portKey):
+        connectionData = self._connections.pop(portKey)
+        demuxKey = self._demuxKey(portKey.destination, portKey.destinationPort, portKey.source, portKey.sourcePort)
+        del self._demuxTable[demuxKey]
+        self._addresses.release(portKey.source)
+        self._addresses.release(portKey.destination)
+        if self._lastDemux is not None and self._lastDemux[4] is connectionData:
+            self._lastDemux = None
+        return connectionData
         
-        localPortKey = remotePortKey.inverseKey()
+    def demux(self, source, sourcePort, destination, destinationPort, data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("{} received {} bytes of data from {}:{} for {}:{}".format(self, len(data), source, sourcePort, destination, destinationPort))
+        capture = self._capture
+        if capture is not None:
+            capture.capture(source, sourcePort, destination, destinationPort, data)
+            
+        # The packet's source is the remote side of our connection.
+        last = self._lastDemux
+        if (last is not None and sourcePort == last[1] and destinationPort == last[3] and
+                source == last[0] and destination == last[2]):
+            last[4].write(data)
+            return
         
-        # Check if the full port key is already in connections. If so, we're all done
-        if localPortKey in self._connections:
-            self._connections[localPortKey].write(data)
+        connectionData = self._demuxTable.get(self._demuxKey(source, sourcePort, destination, destinationPort))
+        if connectionData is not None:
+            self._lastDemux = (source, sourcePort, destination, destinationPort, connectionData)
+            connectionData.write(data)
             return
         
-        # If there's no port key in connections, check for listening port.
-        listeningPort = localPortKey.sourcePort
+        # If there's no connection, check for listening port.
+        listeningPort = destinationPort
         if listeningPort in self._ports and self._ports[listeningPort].isListener():
             # We have a new connection. Spawn.
             # use a controlled port so that if the listening port is closed,
             # all of the spawned ports are closed.
-            self._connections[localPortKey] = ConnectionData(localPortKey, self._ports[listeningPort])
-            self._connections[localPortKey].write(data)
+            localPortKey = PortKey(destination, destinationPort, source, sourcePort)
+            connectionData = self._newConnectionData(localPortKey, self._ports[listeningPort])
+            self._addConnection(localPortKey, connectionData)
+            connectionData.write(data)
             self._ports[listeningPort].spawnConnection(localPortKey)
             
         else:
             pass # drop? Fail silently?
     
+    def demuxAbort(self, source, sourcePort, destination, destinationPort):
+        """
+        A message was dropped after part of it was delivered (see
+        FragmentReassembler). The connection has lost data in the middle
+        of its stream and can't recover, so close it.
+        """
+        connectionData = self._demuxTable.get(self._demuxKey(source, sourcePort, destination, destinationPort))
+        if connectionData is not None:
+            logger.info("{} aborting {}: a partly delivered message was dropped".format(self, connectionData.portKey))
+            self.closeConnection(connectionData.portKey)
+    
     ### End Dmux Methods ###
     
     def spawnConnection(self, portKey, protocol):
         self._connections[portKey].setProtocol(protocol)
         
+    def awaitFirstData(self, portKey, callback, timeout):
+        """
+        For a connection not yet spawned, wait up to timeout seconds
+        for data from the remote side. Then call callback with the data
+        held so far (b"" if none). That data is taken from the
+        connection, so it is not also written to the spawned protocol.
+        """
+        connData = self._connections.get(portKey, None)
+        if connData is None:
+            callback(b"")
+            return
+        
+        def firstData():
+            # runs once: from the timer or the first data, whichever is first
+            connData.onBacklog = None
+            timer.cancel()
+            callback(connData.takeBacklog())
+            
+        timer = asyncio.get_event_loop().call_later(timeout, firstData)
+        if connData.backlogSize():
+            firstData()
+        else:
+            connData.onBacklog = firstData
+        
     def createOutboundSocket(self, control, destination, destinationPort):
-        port = next(self._freePorts)
+        port = self._portAllocator.allocate()
+        if port is None:
+            logger.error("{} has no free ports".format(self))
+            return None
         
         self._ports[port] = control
         
         portKey = PortKey(str(self._address), port, destination, destinationPort)
-        self._connections[portKey] = ConnectionData(portKey, control)
+        self._addConnection(portKey, self._newConnectionData(portKey, control))
         control.spawnConnection(portKey)
         
         return port
         
     def createInboundSocket(self, control, requestedPort):
-        if requestedPort in self._ports:
+        if requestedPort in self._ports or not self._portAllocator.reserve(requestedPort):
             # port already in use
             return None
             
@@ -183,10 +563,11 @@ class VNIC:
         
     def closeConnection(self, portKey):
         logger.debug("{} asked to close {}".format(self, portKey))
+        if portKey in self._pendingWrites:
+            self._flushWrites(portKey)
         if portKey in self._connections:
             logger.debug("{} found connection {}".format(self, portKey))
-            connData = self._connections[portKey]
-            del self._connections[portKey]
+            connData = self._removeConnection(portKey)
             
             connData.close()
             logger.debug("{} closed {} ".format(self, connData))
@@ -195,6 +576,7 @@ class VNIC:
         if port in self._ports:
             control = self._ports[port]
             del self._ports[port]
+            self._portAllocator.release(port)
             control.close()
             
     """
@@ -204,18 +586,105 @@ class VNIC:
         for pk in portKeys:
             self.closePort(pk)"""
             
-    def write(self, portKey, data):
+    def coalesceBytes(self):
+        return self._coalesceBytes
+        
+    def setCoalesceBytes(self, coalesceBytes):
+        self._coalesceBytes = coalesceBytes
+        if not coalesceBytes:
+            self._flushAllWrites()
+        
+    def write(self, portKey, data, coalesce=True):
         logger.debug("VNIC sending message for port key {}".format(portKey))
         if not self._linkTx or not self._linkTx.transport:
             return
+        if self._pendingWrites and portKey in self._pendingWrites:
+            pending = self._pendingWrites[portKey]
+            pending[0].append(data)
+            pending[1] += len(data)
+            if pending[1] >= self._coalesceBytes or not coalesce:
+                self._flushWrites(portKey)
+        elif coalesce and self._coalesceBytes and len(data) < self._coalesceBytes:
+            self._pendingWrites[portKey] = [[data], len(data)]
+            if self._flushHandle is None:
+                self._flushHandle = asyncio.get_event_loop().call_soon(self._flushAllWrites)
+        else:
+            self._linkTx.write(portKey.source, portKey.sourcePort, portKey.destination, portKey.destinationPort, data)
+        
+    def _flushWrites(self, portKey):
+        chunks, size = self._pendingWrites.pop(portKey)
+        if not self._linkTx or not self._linkTx.transport:
+            return
+        data = len(chunks) == 1 and chunks[0] or b"".join(chunks)
         self._linkTx.write(portKey.source, portKey.sourcePort, portKey.destination, portKey.destinationPort, data)
         
-    def startDump(self, protocol):
-        self._dumps.add(protocol)
+    def _flushAllWrites(self):
+        if self._flushHandle:
+            self._flushHandle.cancel()
+            self._flushHandle = None
+        for portKey in list(self._pendingWrites.keys()):
+            self._flushWrites(portKey)
+        
+    async def writeStream(self, portKey, stream, totalSize=None):
+        """
+        Send one message read from stream as it is produced. See
+        PlaygroundSwitchTxProtocol.writeStream.
+        """
+        logger.debug("VNIC streaming message for port key {}".format(portKey))
+        if not self._linkTx or not self._linkTx.transport:
+            raise Exception("{} not connected to network".format(self))
+        if portKey in self._pendingWrites:
+            self._flushWrites(portKey)
+        return await self._linkTx.writeStream(portKey.source, portKey.sourcePort, 
+                                              portKey.destination, portKey.destinationPort, 
+                                              stream, totalSize)
+        
+    def _addCaptureSession(self, session):
+        if self._capture is None:
+            self._capture = PacketCapture()
+        self._capture.addSession(session)
+        
+    def _removeCaptureSession(self, session):
+        self._capture.removeSession(session)
+        if not len(self._capture):
+            self._capture = None
+            
+    def startDump(self, protocol, filter=None):
+        """
+        Sends every packet received (matching filter, if given) to
+        protocol's transport. Returns the capture session.
+        """
+        if protocol in self._dumps:
+            return self._dumps[protocol]
+        session = TransportCaptureSession(protocol.transport, filter)
+        self._dumps[protocol] = session
+        self._addCaptureSession(session)
+        return session
         
     def stopDump(self, protocol):
         if protocol in self._dumps:
-            self._dumps.remove(protocol)
+            self._removeCaptureSession(self._dumps.pop(protocol))
+            
+    def startCapture(self, path, filter=None, mmapSize=None):
+        """
+        Writes every packet received (matching filter, if given) to
+        a capture file. See PacketCapture for the format.
+        """
+        if path in self._captureFiles:
+            raise Exception("Already capturing to {}".format(path))
+        session = FileCaptureSession(path, filter, mmapSize)
+        self._captureFiles[path] = session
+        self._addCaptureSession(session)
+        return session
+        
+    def stopCapture(self, path):
+        if path in self._captureFiles:
+            self._removeCaptureSession(self._captureFiles.pop(path))
+            
+    def captureStatus(self):
+        if self._capture is None:
+            return {"sessions": 0}
+        return self._capture.status()
             
     def __repr__(self):
         return "VNIC ({})".format(self._address)
@@ -226,10 +695,46 @@ def basicUnitTest():
     from playground.network.protocols.packets.vsocket_packets import    VNICSocketOpenPacket,           \
                                                                         VNICSocketOpenResponsePacket,   \
                                                                         VNICStartDumpPacket,            \
+                                                                        VNICDumpFilterPacket,           \
                                                                         PacketType
     from playground.network.protocols.packets.switching_packets import WirePacket
     import io, asyncio
     
+    # port allocation: FIFO reuse, quarantine, explicit reservation
+    now = [0.0]
+    allocator = PortAllocator(100, 104, reuseDelay=10, clock=lambda: now[0])
+    ports = [allocator.allocate() for i in range(4)]
+    assert ports == [100, 101, 102, 103]
+    assert allocator.allocate() == None
+    allocator.release(101)
+    assert allocator.allocate() == None
+    assert allocator.status()["quarantined"] == 1
+    now[0] = 10.0
+    assert allocator.allocate() == 101
+    allocator.release(102)
+    assert allocator.reserve(102)
+    assert not allocator.reserve(102)
+    allocator.release(102)
+    now[0] = 25.0
+    status = allocator.status()
+    assert status["free"] == 1 and status["in-use"] == 3 and status["quarantined"] == 0
+    assert allocator.allocate() == 102
+    
+    # a listener binding and closing the same port doesn't grow the FIFO
+    allocator = PortAllocator(100, 104, reuseDelay=10, clock=lambda: now[0])
+    for i in range(50):
+        assert allocator.reserve(103)
+        allocator.release(103)
+        now[0] += 20.0
+        allocator.status()
+    assert len(allocator._free) == 4
+    allocator.setReuseDelay(0)
+    for i in range(50):
+        assert allocator.reserve(102)
+        allocator.release(102)
+    assert len(allocator._free) == 4
+    assert [allocator.allocate() for i in range(5)] == [100, 101, 102, 103, None]
+    
     vnic1 = VNIC("1.1.1.1")
     assert vnic1.address() == "1.1.1.1"
 
@@ -257,7 +762,7 @@ def basicUnitTest():
     loop.setTransportFactory(transportFactory)
     asyncio.set_event_loop(loop)
     
-    openPacket = VNICSocketOpenPacket(callbackAddress="192.168.0.2", callbackPort=9091)
+    openPacket = VNICSocketOpenPacket(ConnectionId=1, callbackAddress="192.168.0.2", callbackPort=9091)
     openPacket.connectData = openPacket.SocketConnectData(destination="2.2.2.2", destinationPort=100)
     control.data_received(openPacket.__serialize__())
     
@@ -281,7 +786,12 @@ def basicUnitTest():
     
     assert socketTransport.sink.getvalue()==txPacket1.data
     
-    listenPacket = VNICSocketOpenPacket(callbackAddress="192.168.0.2", callbackPort=9092)
+    # a second packet on the same flow takes the last-hit path
+    assert vnic1._lastDemux[:4] == ("2.2.2.2", 100, "1.1.1.1", responsePackets[0].port)
+    linkTx.data_received(txPacket1.__serialize__())
+    assert socketTransport.sink.getvalue()==txPacket1.data*2
+    
+    listenPacket = VNICSocketOpenPacket(ConnectionId=1, callbackAddress="192.168.0.2", callbackPort=9092)
     listenPacket.listenData = listenPacket.SocketListenData(sourcePort=666)
     
     control2 = vnic1.controlConnectionFactory()
@@ -307,6 +817,8 @@ def basicUnitTest():
     
     socket2Transport = transportFactory.transports[("192.168.0.2",9092)]
     assert socket2Transport.sink.getvalue()==txPacket2.data
+    assert len(vnic1._demuxTable) == 2
+    assert len(vnic1._addresses) == 2
     
     txPacket3 = WirePacket(source="1.1.1.1", sourcePort=666, destination="2.2.2.2", destinationPort=100, data=b"response1")
     socket2Transport.protocol.data_received(txPacket3.__serialize__())
@@ -327,6 +839,12 @@ def basicUnitTest():
     assert len(dumpPackets) == 1
     assert dumpPackets[0].data == txPacket4.data
     
+    # a filter on the dump connection is applied before serializing
+    dumper.data_received(VNICDumpFilterPacket(filter="dst port 301").__serialize__())
+    linkTx.data_received(txPacket4.__serialize__())
+    assert dumperTransport.sink.getvalue() == txPacket4.__serialize__()
+    dumper.data_received(VNICDumpFilterPacket(filter="").__serialize__())
+    
     # set "myProtocol" so that closing the transport closes
     # the protocol (connection_lost). Check that no further
     # messages are sent to the protocol
@@ -342,6 +860,71 @@ def basicUnitTest():
     dumpPackets = list(deserializer.nextPackets())
     assert len(dumpPackets) == 0
     
+    # backlogs before the reverse connection is up are bounded
+    class NoSpawnControl:
+        def spawnConnection(self, portKey): pass
+        def spawnedConnectionClosed(self, portKey): pass
+        def isListener(self): return False
+    class SinkProtocol:
+        def __init__(self):
+            self.transport = MockTransport(io.BytesIO())
+            
+    for pushback in [False, True]:
+        vnic2 = VNIC("1.1.1.2", maxBacklog=100, backlogPushback=pushback)
+        link2Transport = MockTransport(io.BytesIO())
+        vnic2.switchConnectionFactory().connection_made(link2Transport)
+        port = vnic2.createOutboundSocket(NoSpawnControl(), "2.2.2.2", 100)
+        for i in range(30):
+            vnic2.demux("2.2.2.2", 100, "1.1.1.2", port, b"0123456789")
+        portKey = PortKey("1.1.1.2", port, "2.2.2.2", 100)
+        connectionData = vnic2._connections[portKey]
+        if pushback:
+            assert connectionData.backlogSize() == 200 and connectionData.dropped == 100
+            assert not link2Transport.reading
+        else:
+            assert connectionData.backlogSize() == 100 and connectionData.dropped == 200
+            assert link2Transport.reading
+        sink = SinkProtocol()
+        vnic2.spawnConnection(portKey, sink)
+        assert connectionData.backlogSize() == 0
+        assert sink.transport.sink.getvalue() == b"0123456789"*(20 if pushback else 10)
+        assert link2Transport.reading
+        
+    # a partly delivered message that is dropped closes its connection
+    vnic2.demuxAbort("2.2.2.2", 100, "1.1.1.2", port)
+    assert portKey not in vnic2._connections and sink.transport.closed
+    vnic2.demuxAbort("2.2.2.2", 100, "1.1.1.2", port)
+    
+    # small writes to a connection are coalesced until the end of the loop iteration
+    vnic3 = VNIC("1.1.1.3", coalesceBytes=100)
+    link3Transport = MockTransport(io.BytesIO())
+    vnic3.switchConnectionFactory().connection_made(link3Transport)
+    announceLength = len(link3Transport.sink.getvalue())
+    announceCount = link3Transport.writeCount
+    portKey = PortKey("1.1.1.3", 2000, "2.2.2.2", 100)
+    otherKey = PortKey("1.1.1.3", 2001, "2.2.2.2", 100)
+    for i in range(5):
+        vnic3.write(portKey, b"small")
+    vnic3.write(otherKey, b"other")
+    assert link3Transport.writeCount == announceCount
+    loop.advanceClock(0)
+    assert link3Transport.writeCount == announceCount+2
+    
+    def wireData():
+        deserializer = WirePacket.Deserializer()
+        deserializer.update(link3Transport.sink.getvalue()[announceLength:])
+        return [packet.data for packet in deserializer.nextPackets()]
+    assert wireData() == [b"small"*5, b"other"]
+    
+    # reaching coalesceBytes, or a write that opts out, flushes immediately (in order)
+    vnic3.write(portKey, b"x"*60)
+    vnic3.write(portKey, b"y"*60)
+    assert wireData()[-1] == b"x"*60+b"y"*60
+    vnic3.write(portKey, b"queued")
+    vnic3.write(portKey, b"urgent", coalesce=False)
+    assert wireData()[-1] == b"queuedurgent"
+    assert link3Transport.writeCount == announceCount+4
+    
 if __name__=="__main__":
     basicUnitTest()
     print("Basic Unit Test Successful.")
@@ -1,2 +1,8 @@
 from .VNIC import VNIC
-from . import connect
\ No newline at end of file
+import importlib
+
+def __getattr__(name):
+    # connect (the client side, with the PNMS behind it) is imported on first use
+    if name != "connect":
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    return importlib.import_module(".connect", __name__)
@@ -2,11 +2,11 @@ from playground import Configure
 from playground.network.common import PlaygroundAddress, StackingProtocol
 from playground.network.packet.PacketDefinitionRegistration import PacketDefinitionSilo
 from playground.network.common.Protocol import ProtocolObservation
-from playground.network.protocols.vsockets import VNICSocketControlClientProtocol, VNICCallbackProtocol
+from playground.asyncio_lib import KeyedWaiters
+from playground.network.protocols.vsockets import VNICSocketControlClientProtocol, VNICCallbackProtocol, UNIX_CALLBACK_PREFIX
 from playground.network.devices.pnms import NetworkManager
-from playground.asyncio_lib import SimpleCondition
 import playground
-import asyncio, os, sys, importlib, traceback, logging, time
+import asyncio, atexit, collections, os, sys, importlib, json, traceback, logging, time
 from concurrent.futures import TimeoutError
 
 logger = logging.getLogger(__name__)
@@ -21,18 +21,19 @@ class ConnectionMadeObserver:
     it shuts down bad, whole process probably goes bad
     """
     def __init__(self):
-        self.protocols = {}
+        self.protocols = {} # protocol -> connected
+        self._waiters = KeyedWaiters()
         
     def watch(self, protocol):
         """
-        For a given protocol, setup a condition to
-        wait for connection made
+        For a given protocol, start watching
+        for connection made
         """
         ProtocolObservation.Listen(protocol, self)
-        self.protocols[protocol] = SimpleCondition()
+        self.protocols[protocol] = False
         
     def connected(self, protocol):
-        return self.protocols[protocol] == "connected"
+        return self.protocols[protocol]
         
     def release(self, protocol):
         if not protocol in self.protocols: return
@@ -41,24 +42,18 @@ class ConnectionMadeObserver:
         
     def __call__(self, protocol, event, *args):
         if protocol in self.protocols and event == ProtocolObservation.EVENT_CONNECTION_MADE:
-            if self.protocols[protocol] == "connected":
-                # we're already done.
-                return
-            condition = self.protocols[protocol]
-            self.protocols[protocol] = "connected"
-            condition.notify()
+            self.protocols[protocol] = True
+            self._waiters.resolve(protocol, True)
             
     async def awaitConnection(self, protocol):
         # if we don't have the protocol, or it's already done, don't wait.
-        if self.protocols.get(protocol, None) != "connected":
-            condition = self.protocols[protocol]
-        
-            # wait for the connection to be made
-            await condition.awaitCondition(lambda: self.protocols[protocol] == "connected")
-        
-        # at this point, we're connected. clean up and return
-        self.release(protocol)
-        return
+        try:
+            if self.protocols.get(protocol, True) == False:
+                # wait for the connection to be made
+                await self._waiters.wait(protocol)
+        finally:
+            # connected (or given up on). clean up and return
+            self.release(protocol)
 connectionMadeObserver = ConnectionMadeObserver()
 
 class CallbackService:
@@ -71,15 +66,18 @@ class CallbackService:
         self._connectionBackptr = {} # Reverse of connectionSpawn
         self._protocolStack = protocolStack
         
-        # asyncio condition
-        self._conditionConnections = SimpleCondition()
+        # keyed by connectionId, resolved in buildStack
+        self._connectionWaiters = KeyedWaiters()
         
     def location(self):
         return (self._callbackAddress, self._callbackPort)
     
     def tryToBuildStack(self, spawnTcpPort):
         if spawnTcpPort in self._connectionData and spawnTcpPort in self._dataProtocols:
-            connectionType = self._connectionData[spawnTcpPort][1]
+            connectionType, applicationProtocol = self._connectionData[spawnTcpPort][1:3]
+            if not applicationProtocol:
+                # pre-spawned. Not built until claimed.
+                return
             if connectionType == "listen":
                 stackFactory = self._protocolStack[1]
             else:
@@ -91,13 +89,26 @@ class CallbackService:
         self._dataProtocols[spawnTcpPort] = dataProtocol
         self.tryToBuildStack(spawnTcpPort)
         
-    def completeCallback(self, connectionId, connectionType, applicationProtocol, spawnTcpPort, source, sourcePort, destination, destinationPort):
+    def completeCallback(self, connectionId, connectionType, applicationProtocol, spawnTcpPort, source, sourcePort, destination, destinationPort,
+                            initialData=None):
         logger.debug("Callback service setting up callback for connectionID {}, spawn port {}".format(connectionId, spawnTcpPort))
-        self._connectionData[spawnTcpPort] = (connectionId, connectionType, applicationProtocol, source, sourcePort, destination, destinationPort)
+        self._connectionData[spawnTcpPort] = (connectionId, connectionType, applicationProtocol, source, sourcePort, destination, destinationPort,
+                                              initialData)
+        self.tryToBuildStack(spawnTcpPort)
+            
+    def claimCallback(self, spawnTcpPort, applicationProtocolFactory):
+        """
+        Attach an application protocol to a callback completed without
+        one. Returns False if the connection has closed in the meantime.
+        """
+        if not spawnTcpPort in self._connectionData: return False
+        connectionData = self._connectionData[spawnTcpPort]
+        self._connectionData[spawnTcpPort] = connectionData[:2] + (applicationProtocolFactory(),) + connectionData[3:]
         self.tryToBuildStack(spawnTcpPort)
+        return True
             
     def buildStack(self, stackFactory, spawnTcpPort):
-        connectionId, connectionType, applicationProtocol, source, sourcePort, destination, destinationPort = self._connectionData[spawnTcpPort]
+        connectionId, connectionType, applicationProtocol, source, sourcePort, destination, destinationPort, initialData = self._connectionData[spawnTcpPort]
         
         connectionMadeObserver.watch(applicationProtocol)
         
@@ -111,7 +122,8 @@ class CallbackService:
         logger.debug("Connection made on spawned port {} for stack {} {}:{} -> {}:{}".format(spawnTcpPort, stackString, source, sourcePort, destination, destinationPort))
         self._dataProtocols[spawnTcpPort].setPlaygroundConnectionInfo(stackProtocol, applicationProtocol, 
                                                                       source, sourcePort, 
-                                                                      destination, destinationPort)
+                                                                      destination, destinationPort,
+                                                                      initialData)
         
         self._connectionSpawn[connectionId] = self._connectionSpawn.get(connectionId, []) + [self._dataProtocols[spawnTcpPort]]
         self._connectionBackptr[self._dataProtocols[spawnTcpPort]] = connectionId
@@ -122,7 +134,7 @@ class CallbackService:
         del self._connectionData[spawnTcpPort]
 
         # notify that a new connection is received
-        self._conditionConnections.notify()
+        self._connectionWaiters.resolve(connectionId, self._connectionSpawn[connectionId])
         
     def dataConnectionClosed(self, dataProtocol, spawnTcpPort):
         logger.debug("Connection closed for spawned port {}".format(spawnTcpPort))
@@ -143,8 +155,8 @@ class CallbackService:
             self._connectionSpawn[connectionId] = []
         
         # now wait for the list to be big enough
-        predicate = lambda: len(self._connectionSpawn[connectionId]) >= n
-        await self._conditionConnections.awaitCondition(predicate)
+        if len(self._connectionSpawn[connectionId]) < n:
+            return await self._connectionWaiters.wait(connectionId, lambda connections: len(connections) >= n)
         return self._connectionSpawn[connectionId]  
         
     def getConnections(self, connectionId):
@@ -197,8 +209,72 @@ class PlaygroundServer:
             return sockets
         return super().__getattribute__(attr)
         
+class ConnectionPool:
+    """
+    Idle, pre-spawned connections to one destination. A slot is a
+    connection the VNIC has opened and called back on but that has
+    no application protocol yet (see VNICSocketControlClientProtocol.claim).
+    take() claims one; fill() opens slots in the background up to
+    size. Slots unused for idleTimeout seconds are closed.
+    
+    openSlot is a coroutine function returning (controlProtocol, connectionId).
+    """
+    def __init__(self, size, idleTimeout, openSlot):
+        self._size = size
+        self._idleTimeout = idleTimeout
+        self._openSlot = openSlot
+        self._idle = collections.deque()
+        self._opening = 0
+        
+        # (vnicName, location) for the destination, once looked up
+        self.route = None
+        
+    def idleCount(self):
+        return len(self._idle)
+        
+    def take(self, applicationProtocolFactory, noDelay=False):
+        # most recently used first, so spare slots age out
+        while self._idle:
+            slot = self._idle.pop()
+            controlProtocol, connectionId, expiration = slot
+            expiration.cancel()
+            if controlProtocol.claim(connectionId, applicationProtocolFactory, noDelay):
+                return controlProtocol, connectionId
+        return None
+        
+    def fill(self):
+        for i in range(self._size - len(self._idle) - self._opening):
+            self._opening += 1
+            asyncio.ensure_future(self._open())
+            
+    async def _open(self):
+        try:
+            controlProtocol, connectionId = await self._openSlot()
+        except Exception as e:
+            logger.debug("Could not pre-spawn pooled connection. {}".format(e))
+            return
+        finally:
+            self._opening -= 1
+        slot = [controlProtocol, connectionId, None]
+        slot[2] = asyncio.get_event_loop().call_later(self._idleTimeout, self._expire, slot)
+        self._idle.append(slot)
+        
+    def _expire(self, slot):
+        controlProtocol, connectionId, expiration = slot
+        logger.debug("Pooled connection {} idle for {} seconds. Closing.".format(connectionId, self._idleTimeout))
+        self._idle.remove(slot)
+        controlProtocol.discard(connectionId)
+        
 class PlaygroundConnector:
-    def __init__(self, vnicService=None, protocolStack=None, callbackAddress="127.0.0.1", callbackPort=0):
+    # sun_path is 108 bytes on Linux, including the terminating null
+    UNIX_PATH_MAX = 107
+    
+    # every playground connection is a callback connection to us. Bursts
+    # of them overflow the default listen backlog of 100 and stall in SYN retries.
+    CALLBACK_BACKLOG = 1024
+    
+    def __init__(self, vnicService=None, protocolStack=None, callbackAddress="127.0.0.1", callbackPort=0, multiplexed=False,
+                    unixSockets=False, poolSize=0, poolIdleTimeout=30.0):
         if isinstance(protocolStack, tuple):
             if len(protocolStack) != 2: 
                 raise Exception("Protocol Stack is a factory or a factory pair")
@@ -208,14 +284,27 @@ class PlaygroundConnector:
         self._vnicService = vnicService
         self._callbackService = CallbackService(callbackAddress, callbackPort, self._stack)
         self._vnicConnections = {}
+        
+        # carry connection data over the VNIC control connection instead of
+        # a callback connection per playground connection (if the VNIC supports it)
+        self._multiplexed = multiplexed
+        
+        # use unix domain sockets for the control and callback connections
+        # when the VNIC advertises one. Otherwise, TCP on localhost.
+        self._unixSockets = unixSockets
+        
+        # keep poolSize pre-spawned connections per (destination, port)
+        # that has been connected to. 0 disables pooling.
+        self._poolSize = poolSize
+        self._poolIdleTimeout = poolIdleTimeout
+        self._pools = {}
         self._ready = False
+        self._callbackStartup = None
         self._trace = traceback.extract_stack()
         self._module = self._trace[-2].filename
         
         if not vnicService:
             self._vnicService = StandardVnicService()
-            
-        self._protocolReadyCondition = SimpleCondition()
         
     def getClientStackFactory(self):
         return self._stack[0]
@@ -227,24 +316,98 @@ class PlaygroundConnector:
         return self._module
         
     async def create_callback_service(self, factory):
+        unixPath = self._unixSockets and self._unixCallbackPath()
+        if unixPath:
+            if os.path.exists(unixPath):
+                os.unlink(unixPath)
+            await asyncio.get_event_loop().create_unix_server(factory, path=unixPath, backlog=self.CALLBACK_BACKLOG)
+            atexit.register(lambda: os.path.exists(unixPath) and os.unlink(unixPath))
+            self._callbackService._callbackAddress = UNIX_CALLBACK_PREFIX + unixPath
+            self._callbackService._callbackPort = 0
+            self._ready = True
+            return
         callbackAddress, callbackPort = self._callbackService.location()
-        coro = asyncio.get_event_loop().create_server(factory, host=callbackAddress, port=callbackPort)
+        coro = asyncio.get_event_loop().create_server(factory, host=callbackAddress, port=callbackPort,
+                                                        backlog=self.CALLBACK_BACKLOG)
         server = await coro
         servingPort = server.sockets[0].getsockname()[1]
         self._callbackService._callbackPort = servingPort
         self._ready = True
         
-    async def create_playground_connection(self, protocolFactory, destination, destinationPort, vnicName="default", cbPort=0, timeout=60):
-        startTime = time.time()
+    async def _startCallbackService(self):
+        """
+        Start the callback service once. Concurrent callers share the
+        same startup; if it fails, the next caller tries again.
+        """
+        if self._ready: return
+        if not self._callbackStartup:
+            factory = lambda: VNICCallbackProtocol(self._callbackService)
+            self._callbackStartup = asyncio.ensure_future(self.create_callback_service(factory))
+        startup = self._callbackStartup
+        try:
+            await asyncio.shield(startup)
+        except Exception:
+            if self._callbackStartup is startup:
+                self._callbackStartup = None
+            raise
+        
+    def _unixCallbackPath(self):
+        socketDirectory = self._vnicService.getUnixSocketDirectory()
+        if not socketDirectory: return None
+        path = os.path.join(socketDirectory, "callback_{}_{}.sock".format(os.getpid(), id(self)))
+        if len(path.encode()) > self.UNIX_PATH_MAX: 
+            logger.debug("Unix socket path {} too long. Using TCP callbacks.".format(path))
+            return None
+        return path
         
-        logger.info("Create playground connection to {}:{}".format(destination, destinationPort))
-        if not self._ready:
-            await self.create_callback_service(lambda: VNICCallbackProtocol(self._callbackService))#.buildConnectDataProtocol)
-        if destination == "localhost":
-            destination = self._vnicService.getVnicPlaygroundAddress(self._vnicService.getDefaultVnic())
-        if not isinstance(destination, PlaygroundAddress):
-            destination = PlaygroundAddress.FromString(destination)
-            
+    async def _connectControlProtocol(self, controlProtocol, vnicName, location):
+        unixPath = self._unixSockets and self._vnicService.getVnicUnixLocation(vnicName)
+        if unixPath:
+            return await asyncio.get_event_loop().create_unix_connection(lambda: controlProtocol, unixPath)
+        vnicAddr, vnicPort = location
+        return await asyncio.get_event_loop().create_connection(lambda: controlProtocol, vnicAddr, vnicPort)
+        
+    async def _openControlProtocol(self, vnicName, location):
+        controlProtocol = VNICSocketControlClientProtocol(self._callbackService, multiplexed=self._multiplexed)
+        try:
+            res = await self._connectControlProtocol(controlProtocol, vnicName, location)
+        except Exception:
+            # let the next caller try again
+            del self._vnicConnections[location]
+            raise
+        logger.info("Control protocol connected. {}".format(res))
+        self._vnicConnections[location] = controlProtocol
+        return controlProtocol
+        
+    async def _getControlProtocol(self, vnicName, location):
+        """
+        Get the control protocol for the VNIC at location. While it
+        is connecting, _vnicConnections holds the connecting task and
+        every caller awaits that same task.
+        """
+        connection = self._vnicConnections.get(location, None)
+        if connection is None:
+            logger.info("No control conenction to VNIC {} yet. Connecting".format(location))
+            connection = asyncio.ensure_future(self._openControlProtocol(vnicName, location))
+            self._vnicConnections[location] = connection
+        if isinstance(connection, asyncio.Future):
+            logger.debug("Waiting to connect for {}".format(location))
+            connection = await asyncio.shield(connection)
+        logger.debug("Ready to proceed for {}".format(location))
+        return connection
+        
+    def _getPool(self, destination, destinationPort):
+        key = (str(destination), destinationPort)
+        if not key in self._pools:
+            async def openSlot():
+                vnicName, location = self._pools[key].route
+                controlProtocol = await self._getControlProtocol(vnicName, location)
+                connectionId, port = await controlProtocol.connect(destination, destinationPort, None)
+                return controlProtocol, connectionId
+            self._pools[key] = ConnectionPool(self._poolSize, self._poolIdleTimeout, openSlot)
+        return self._pools[key]
+        
+    def _route(self, destination, destinationPort, vnicName):
         if vnicName == "default":
             vnicName = self._vnicService.getVnicByDestination(destination, destinationPort)
         if not vnicName:
@@ -252,30 +415,58 @@ class PlaygroundConnector:
         location = self._vnicService.getVnicTcpLocation(vnicName)
         if not location:
             raise Exception("Playground network not ready. Could not find interface to connect to {}:{}".format(destination, destinationPort))
-        vnicAddr, vnicPort = location
-        if not location in self._vnicConnections:
-            self._vnicConnections[location] = "CONNECTING"
-            logger.info("No control conenction to VNIC {} yet. Connecting".format(location))
-            controlProtocol = VNICSocketControlClientProtocol(self._callbackService)
-            coro = asyncio.get_event_loop().create_connection(lambda: controlProtocol, vnicAddr, vnicPort)
-            res = await coro
-            logger.info("Control protocol connected. {}".format(res))
-            self._vnicConnections[location] = controlProtocol
-        while self._vnicConnections[location] == "CONNECTING":
-            # another co-routing is rying to make the connection
-            logger.debug("Waiting to connect for {}".format(location))
-            await asyncio.sleep(0.5)
-        logger.debug("Ready to proceed for {}".format(location))
+        return vnicName, location
+        
+    async def create_playground_connection(self, protocolFactory, destination, destinationPort, vnicName="default", cbPort=0, timeout=60, noDelay=False,
+                                            initialData=None, awaitResponse=None):
+        """
+        initialData is sent with the request to open the connection
+        (so it skips the protocol stack; only for connectors with none).
+        With awaitResponse, the VNIC holds the connection up to that many
+        seconds for the first response and sends it with the connection.
+        """
+        startTime = time.time()
+        
+        logger.info("Create playground connection to {}:{}".format(destination, destinationPort))
+        if initialData and self._stack[0]:
+            raise Exception("Initial data cannot be sent through a protocol stack")
+        await self._startCallbackService()
+        if destination == "localhost":
+            destination = self._vnicService.getVnicPlaygroundAddress(self._vnicService.getDefaultVnic())
+        if not isinstance(destination, PlaygroundAddress):
+            destination = PlaygroundAddress.FromString(destination)
+        
+        # pooled connections are already open; they can't carry initial data
+        pool = (self._poolSize and vnicName == "default" and not (initialData or awaitResponse) 
+                and self._getPool(destination, destinationPort))
+        if pool:
+            if not pool.route:
+                pool.route = self._route(destination, destinationPort, vnicName)
+            vnicName, location = pool.route
+        else:
+            vnicName, location = self._route(destination, destinationPort, vnicName)
+        try:
+            controlProtocol = await self._getControlProtocol(vnicName, location)
+        except Exception:
+            # the VNIC may have moved. Look the route up again next time.
+            if pool: pool.route = None
+            raise
 
         controlTime = time.time()
-        controlProtocol = self._vnicConnections[location]
-        future = controlProtocol.connect(destination, destinationPort, protocolFactory)
-        logger.debug("Awaiting outbound connection to complete")
-        try:
-            connectionId, port = await asyncio.wait_for(future, timeout)
-            logger.debug("Connection complete. Outbound port is {} for connection {}".format(port, connectionId))
-        except TimeoutError:
-            raise Exception("Could not connect to {}:{} in {} seconds.".format(destination, destinationPort, timeout))
+        pooled = pool and pool.take(protocolFactory, noDelay)
+        if pooled:
+            controlProtocol, connectionId = pooled
+            logger.debug("Using pre-spawned connection {} to {}:{}".format(connectionId, destination, destinationPort))
+        else:
+            future = controlProtocol.connect(destination, destinationPort, protocolFactory, noDelay, initialData, awaitResponse)
+            logger.debug("Awaiting outbound connection to complete")
+            try:
+                connectionId, port = await asyncio.wait_for(future, timeout)
+                logger.debug("Connection complete. Outbound port is {} for connection {}".format(port, connectionId))
+            except TimeoutError:
+                raise Exception("Could not connect to {}:{} in {} seconds.".format(destination, destinationPort, timeout))
+        # top the pool back up in the background
+        pool and pool.fill()
         callbackTime = time.time()
         logger.debug("Complete playground connection. Total Time: {} (Control {}, callback {})".format(callbackTime-startTime,
                                                                                                        controlTime-startTime, 
@@ -304,10 +495,8 @@ class PlaygroundConnector:
             
         return playgroundProtocol.transport, playgroundProtocol
         
-    async def create_playground_server(self, protocolFactory, port, host="default", vnicName="default", cbPort=0):
-        if not self._ready:
-            await self.create_callback_service(lambda: VNICCallbackProtocol(self._callbackService))
-            #await self.create_callback_service(self._callbackService.buildListenDataProtocol)
+    async def create_playground_server(self, protocolFactory, port, host="default", vnicName="default", cbPort=0, noDelay=False):
+        await self._startCallbackService()
             
         # find the address to host on.
         if host == "default" or host == "localhost":
@@ -330,22 +519,9 @@ class PlaygroundConnector:
             raise Exception("Invalid VNIC address and/or port")
         
         logger.info("vnic connections {}".format(self._vnicConnections))
-        if not location in self._vnicConnections:
-            logger.info("No control conenction to VNIC {} yet. Connecting".format(location))
-            controlProtocol = VNICSocketControlClientProtocol(self._callbackService)
-            coro = asyncio.get_event_loop().create_connection(lambda: controlProtocol, vnicAddr, vnicPort)
-            res = await coro
-            logger.info("Control protocol connected. res={}".format(res))
-            self._vnicConnections[location] = controlProtocol
-        while self._vnicConnections[location] == "CONNECTING":
-            # another co-routing is rying to make the connection
-            logger.debug("Waiting to connect for {}".format(location))
-            await asyncio.sleep(0.5)
-        logger.debug("Ready to proceed for {}".format(location))
-        
-        controlProtocol = self._vnicConnections[location]
+        controlProtocol = await self._getControlProtocol(vnic, location)
         logger.info("For vnic {}, location {}, got controlProtocol {}, transport {}".format(vnic, location, controlProtocol, controlProtocol.transport))
-        future = controlProtocol.listen(port, protocolFactory)
+        future = controlProtocol.listen(port, protocolFactory, noDelay)
         logger.debug("Awaiting listening to port {} to complete".format(port))
         try:
             connectionId, port = await asyncio.wait_for(future, 30.0)
@@ -387,28 +563,37 @@ class StandardVnicService:
             self.deviceManager.loadConfiguration()
         except:
             # todo. Check that this is a can't find config exception
-            self.deviceManaer = None
+            self.deviceManager = None
+        
+        # (config version, {vnic address: device name})
+        self._addressIndex = None
         
     def getDefaultVnic(self):
         if not self.deviceManager:
             return None
+        self.deviceManager.reloadIfChanged()
         return self.deviceManager.routing().getDefaultRoute()
         
     def getVnicByDestination(self, destination, destinationPort):
         if not self.deviceManager:
             return None
+        self.deviceManager.reloadIfChanged()
         return self.deviceManager.routing().getRoutingDevice(destination)
         
     def getVnicByLocalAddress(self, vnicAddress):
         if not self.deviceManager:
             return None
-        for deviceName in self.deviceManager.deviceInfo().devices():
-            deviceType = self.deviceManager.deviceInfo().lookupDeviceType(deviceName)
-            if deviceType == "vnic":
-                device = self.deviceManager.getDevice(deviceName)
-                if device.address() == vnicAddress:
-                    return deviceName
-        return None
+        self.deviceManager.reloadIfChanged()
+        version = self.deviceManager.configVersion()
+        if self._addressIndex is None or self._addressIndex[0] != version:
+            addresses = {}
+            for deviceName in self.deviceManager.deviceInfo().devices():
+                deviceType = self.deviceManager.deviceInfo().lookupDeviceType(deviceName)
+                if deviceType == "vnic":
+                    device = self.deviceManager.getDevice(deviceName)
+                    addresses.setdefault(device.address(), deviceName)
+            self._addressIndex = (version, addresses)
+        return self._addressIndex[1].get(str(vnicAddress), None)
         
     def getVnicPlaygroundAddress(self, vnicName):
         if not vnicName: return None
@@ -423,12 +608,37 @@ class StandardVnicService:
         device = self.deviceManager.getDevice(vnicName)
         if device: return device.tcpLocation()
         return None
+        
+    def getVnicUnixLocation(self, vnicName):
+        if not vnicName: return None
+        device = self.deviceManager.getDevice(vnicName)
+        if device: return device.unixLocation()
+        return None
+        
+    def getUnixSocketDirectory(self):
+        if not self.deviceManager or not self.deviceManager.location():
+            return None
+        return os.path.dirname(self.deviceManager.location())
 
 class NoSuchPlaygroundConnector(Exception):
     def __init__(self, connectorName):
         super().__init__("No such playground connector {}".format(connectorName))
 
 class PlaygroundConnectorService:
+    """
+    Connectors come from the packages in <config>/connectors. A package
+    registers its connectors (setConnector) when it is imported.
+    
+    Importing all of them is slow when many are installed. Instead, a
+    manifest (connectors/.manifest.json) records the connector names each
+    package registered, keyed by the package's file mtimes. getConnector
+    imports the package the manifest says provides the name, or failing
+    that, the packages that are new or changed since the manifest was
+    written. A package that failed to import is only retried once it
+    changes.
+    """
+    MANIFEST_FILE    = ".manifest.json"
+    MANIFEST_VERSION = 1
     
     @classmethod
     def InitializeConfigModule(cls, location, overwrite=False):
@@ -442,48 +652,35 @@ class PlaygroundConnectorService:
         self._connectors.update(self._default_connectors)
         self._loaded = False
         self._autoLoading = False
+        
+        # {module name: {"key": [mtime, file count], "connectors": [names], "error": message or None}}
+        self._manifest = None
+        self._modules = None
+        self._imported = set()
+        self._registering = None
     
     def reloadConnectors(self, force=False):
+        """
+        Import every connector package (again, if force). Not needed
+        before getConnector, which imports packages as needed.
+        """
         if self._loaded and not force: return
         
-        self._connectors = {}#
-        self._connectors.update(self._default_connectors)
-        #{"default":PlaygroundConnector()}
-        
-        configPath = Configure.CurrentPath()
-        connectorsLocation = os.path.join(configPath, "connectors")
-        connectorsInitPath = os.path.join(connectorsLocation, "__init__.py")
-        
-        oldPath = sys.path
-        if configPath not in sys.path:
-            sys.path.insert(0, configPath)
-        if not os.path.exists(connectorsInitPath):
-            with open(connectorsInitPath, "w+") as f:
-                f.write("#dummy init for connectors module")
-                
-        self._autoLoading = True
-        for pathName in os.listdir(connectorsLocation):
-            try:
-                pathName = os.path.join(connectorsLocation, pathName)
-                moduleName = os.path.basename(pathName)
-                if os.path.exists(os.path.join(pathName, "__init__.py")) or os.path.exists(os.path.join(pathName, "__init__.pyc")):
-                    dottedName = "connectors.{}".format(moduleName)
-                    with PacketDefinitionSilo():
-                        if dottedName in sys.modules:
-                            #TODO: Test if this even works.
-                            importlib.reload(sys.modules[dottedName])
-                        else:
-                            importlib.import_module(dottedName)
-            except Exception as e:
-                print("WARNING: could not load auto connector",pathName,"because",e)
-        self._autoLoading = False
-        sys.path = oldPath
+        if force:
+            self._connectors = {}
+            self._connectors.update(self._default_connectors)
+            self._manifest = None
+            self._imported = set()
+        self._indexConnectors()
+        for moduleName in sorted(self._modules):
+            if moduleName not in self._imported:
+                self._importConnectorModule(moduleName)
+        self._saveManifest()
         self._loaded = True
-        #    print("Loading module {}".format(pathName))
-        #    self._loadConnectorModule(os.path.join(connectorLocation, pathName))
     
     def getConnector(self, connectorName="default"):
-        self.reloadConnectors()
+        if connectorName not in self._connectors:
+            self._loadConnectorProvider(connectorName)
         if connectorName not in self._connectors:
             raise NoSuchPlaygroundConnector(connectorName)
         return self._connectors[connectorName]
@@ -491,30 +688,131 @@ class PlaygroundConnectorService:
     def setConnector(self, connectorName, connector):
         if not self._autoLoading:
             self._default_connectors[connectorName] = connector
+        else:
+            self._registering.append(connectorName)
         self._connectors[connectorName] = connector
+        
+    def _loadConnectorProvider(self, connectorName):
+        self._indexConnectors()
+        providers, unindexed = [], []
+        for moduleName in sorted(self._modules):
+            if moduleName in self._imported: continue
+            entry = self._manifest.get(moduleName, None)
+            if entry is None or entry["key"] != self._modules[moduleName]:
+                # new or changed. Could provide anything.
+                unindexed.append(moduleName)
+            elif connectorName in entry["connectors"]:
+                providers.append(moduleName)
+        if not providers and not unindexed: return
+        
+        for moduleName in providers + unindexed:
+            self._importConnectorModule(moduleName)
+            if connectorName in self._connectors: break
+        self._saveManifest()
+        
+    def _connectorsLocation(self):
+        return os.path.join(Configure.CurrentPath(), "connectors")
+        
+    def _indexConnectors(self):
+        if self._manifest is not None: return
+        
+        self._modules = {}
+        connectorsLocation = self._connectorsLocation()
+        if os.path.exists(connectorsLocation):
+            for moduleName in os.listdir(connectorsLocation):
+                pathName = os.path.join(connectorsLocation, moduleName)
+                if os.path.exists(os.path.join(pathName, "__init__.py")) or os.path.exists(os.path.join(pathName, "__init__.pyc")):
+                    self._modules[moduleName] = self._moduleKey(pathName)
+        self._manifest = {}
+        for moduleName, entry in self._loadManifest().items():
+            if moduleName in self._modules:
+                self._manifest[moduleName] = entry
+                
+    def _moduleKey(self, pathName):
+        # files only. Directory mtimes change when __pycache__ is written.
+        mtime, fileCount = 0, 0
+        for dirPath, dirNames, fileNames in os.walk(pathName):
+            if "__pycache__" in dirNames:
+                dirNames.remove("__pycache__")
+            for fileName in fileNames:
+                mtime = max(mtime, os.stat(os.path.join(dirPath, fileName)).st_mtime_ns)
+                fileCount += 1
+        return [mtime, fileCount]
+        
+    def _loadManifest(self):
+        try:
+            with open(os.path.join(self._connectorsLocation(), self.MANIFEST_FILE)) as f:
+                manifest = json.load(f)
+            if manifest.get("version") == self.MANIFEST_VERSION:
+                return manifest["modules"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+        
+    def _saveManifest(self):
+        manifestPath = os.path.join(self._connectorsLocation(), self.MANIFEST_FILE)
+        tmpPath = "{}.{}".format(manifestPath, os.getpid())
+        try:
+            with open(tmpPath, "w") as f:
+                json.dump({"version":self.MANIFEST_VERSION, "modules":self._manifest}, f)
+            os.replace(tmpPath, manifestPath)
+        except OSError:
+            # e.g., no write access. Just import more next time.
+            pass
+        
+    def _importConnectorModule(self, moduleName):
+        configPath = Configure.CurrentPath()
+        connectorsInitPath = os.path.join(configPath, "connectors", "__init__.py")
+        if configPath not in sys.path:
+            sys.path.insert(0, configPath)
+        if not os.path.exists(connectorsInitPath):
+            with open(connectorsInitPath, "w+") as f:
+                f.write("#dummy init for connectors module")
+                
+        # a connector package might get another connector while importing
+        outerAutoLoading, outerRegistering = self._autoLoading, self._registering
+        self._autoLoading, self._registering = True, []
+        self._imported.add(moduleName)
+        error = None
+        try:
+            dottedName = "connectors.{}".format(moduleName)
+            with PacketDefinitionSilo():
+                if dottedName in sys.modules:
+                    #TODO: Test if this even works.
+                    importlib.reload(sys.modules[dottedName])
+                else:
+                    importlib.import_module(dottedName)
+        except Exception as e:
+            error = str(e)
+            print("WARNING: could not load auto connector",moduleName,"because",e)
+        finally:
+            registered = self._registering
+            self._autoLoading, self._registering = outerAutoLoading, outerRegistering
+        self._manifest[moduleName] = {"key": self._modules[moduleName], "connectors": registered, "error": error}
+            
 ConnectorService = PlaygroundConnectorService()
 
 
 #Asyncio Like Adapter Interface
-def create_server(protocol_factory, host=None, port=None, family=None, *args, **kargs):
+def create_server(protocol_factory, host=None, port=None, family=None, *args, no_delay=False, **kargs):
     if host == None: host = "default"
     if port == None: raise Exception("Playground create_server cannot have a None port")
     if args or kargs:
-        raise Exception("Playground's create_server does not support any arguments other than host, port, and family")
+        raise Exception("Playground's create_server does not support any arguments other than host, port, family, and no_delay")
     if family == None and host is not None and "://" in host:
         family, host = host.split("://")
     elif family == None:
         family = "default"
-    return playground.getConnector(family).create_playground_server(protocol_factory, host=host, port=port)
+    return playground.getConnector(family).create_playground_server(protocol_factory, host=host, port=port, noDelay=no_delay)
     
-def create_connection(protocol_factory, host, port, family=None, *args, **kargs):
+def create_connection(protocol_factory, host, port, family=None, *args, no_delay=False, **kargs):
     if args or kargs:
-        raise Exception("Playground's create_connection does not support any arguments other than host, port, and family")
+        raise Exception("Playground's create_connection does not support any arguments other than host, port, family, and no_delay")
     if family == None and host is not None and "://" in host:
         family, host = host.split("://")
     elif family == None:
         family = "default"
-    return playground.getConnector(family).create_playground_connection(protocol_factory, host, port)
+    return playground.getConnector(family).create_playground_connection(protocol_factory, host, port, noDelay=no_delay)
     
 def raw_vnic_connection(protocolFactory, vnicName="default"):
     return playground.getConnector("default").raw_vnic_connection(protocolFactory, vnicName)
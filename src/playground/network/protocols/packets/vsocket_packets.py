@@ -13,13 +13,23 @@ class VNICSocketControlPacket(PacketType):
     DEFINITION_VERSION    = "1.0"
 
 class VNICSocketOpenPacket(VNICSocketControlPacket):
+    """
+    Opens a connect or listen socket. A connect may carry
+    initialData, which the VNIC sends as soon as the port is
+    allocated, ahead of the callback. With awaitResponse (in
+    milliseconds), the VNIC holds the spawned notification until
+    the first data from the remote side arrives, or that time
+    passes, and carries that data in the notification.
+    """
     DEFINITION_IDENTIFIER = "vsockets.VNICSocketOpenPacket"
     DEFINITION_VERSION    = "1.0"
     
     class SocketConnectData(PacketFields):
         FIELDS = [
             ("destination", STRING),
-            ("destinationPort", UINT16)
+            ("destinationPort", UINT16),
+            ("initialData", BUFFER({Optional:True})),
+            ("awaitResponse", UINT16({Optional:True}))
         ]
         
     class SocketListenData(PacketFields):
@@ -48,6 +58,20 @@ class VNICSocketClosePacket(VNICSocketControlPacket):
     
     FIELDS = [("ConnectionId", UINT32)]
 
+class VNICSocketOptionPacket(VNICSocketControlPacket):
+    """
+    Sets options on an open (or opening) socket. noDelay turns off
+    coalescing of small writes for the socket's connections, for
+    latency sensitive protocols.
+    """
+    DEFINITION_IDENTIFIER = "vsockets.VNICSocketOptionPacket"
+    DEFINITION_VERSION    = "1.0"
+    
+    FIELDS = [
+        ("ConnectionId", UINT32),
+        ("noDelay", UINT8({Optional:True}))
+    ]
+
 class VNICSocketOpenResponsePacket(VNICSocketControlPacket):
     DEFINITION_IDENTIFIER = "vsockets.VNICSocketOpenResponsePacket"
     DEFINITION_VERSION    = "1.0"
@@ -70,7 +94,61 @@ class VNICConnectionSpawnedPacket(VNICSocketControlPacket):
         ("source", STRING),
         ("sourcePort", UINT16),
         ("destination", STRING),
-        ("destinationPort", UINT16)
+        ("destinationPort", UINT16),
+        ("initialData", BUFFER({Optional:True}))
+    ]
+    
+class VNICMultiplexPacket(VNICSocketControlPacket):
+    """
+    Sent by a client to ask that connections opened over this
+    control connection be carried over it as channels, rather
+    than as callback connections. The VNIC acknowledges with its
+    own VNICMultiplexPacket. Window is the number of bytes the
+    sender will accept per channel before granting more credit.
+    
+    A VNIC that does not support multiplexing ignores the request
+    and keeps using callback connections.
+    """
+    DEFINITION_IDENTIFIER = "vsockets.VNICMultiplexPacket"
+    DEFINITION_VERSION    = "1.0"
+    FIELDS = [
+        ("window", UINT32)
+    ]
+    
+class VNICChannelSpawnedPacket(VNICSocketControlPacket):
+    DEFINITION_IDENTIFIER = "vsockets.VNICChannelSpawnedPacket"
+    DEFINITION_VERSION    = "1.0"
+    FIELDS = [
+        ("ConnectionId", UINT32),
+        ("channel", UINT32),
+        ("source", STRING),
+        ("sourcePort", UINT16),
+        ("destination", STRING),
+        ("destinationPort", UINT16),
+        ("initialData", BUFFER({Optional:True}))
+    ]
+    
+class VNICChannelDataPacket(VNICSocketControlPacket):
+    DEFINITION_IDENTIFIER = "vsockets.VNICChannelDataPacket"
+    DEFINITION_VERSION    = "1.0"
+    FIELDS = [
+        ("channel", UINT32),
+        ("data", BUFFER)
+    ]
+    
+class VNICChannelCreditPacket(VNICSocketControlPacket):
+    DEFINITION_IDENTIFIER = "vsockets.VNICChannelCreditPacket"
+    DEFINITION_VERSION    = "1.0"
+    FIELDS = [
+        ("channel", UINT32),
+        ("credit", UINT32)
+    ]
+    
+class VNICChannelClosePacket(VNICSocketControlPacket):
+    DEFINITION_IDENTIFIER = "vsockets.VNICChannelClosePacket"
+    DEFINITION_VERSION    = "1.0"
+    FIELDS = [
+        ("channel", UINT32)
     ]
     
 class VNICStartDumpPacket(VNICSocketControlPacket):
@@ -81,6 +159,17 @@ class VNICStopDumpPacket(VNICSocketControlPacket):
     DEFINITION_IDENTIFIER = "vsockets.VNICStopDumpPacket"
     DEFINITION_VERSION    = "1.0"
     
+class VNICDumpFilterPacket(VNICSocketControlPacket):
+    """
+    Sets the filter for a dump connection, e.g. "host 1.1.1.1 and
+    port 101" (see PacketCapture.CaptureFilter). An empty filter
+    dumps everything.
+    """
+    DEFINITION_IDENTIFIER = "vsockets.VNICDumpFilterPacket"
+    DEFINITION_VERSION    = "1.0"
+    
+    FIELDS = [("filter", STRING)]
+    
 class VNICPromiscuousLevelPacket(VNICSocketControlPacket):
     """
     This packet is both a getter/setter packet that can be
@@ -101,7 +190,7 @@ class VNICPromiscuousLevelPacket(VNICSocketControlPacket):
                 ("get",UINT8({Optional:True}))]
     
 def basicUnitTest():
-    v1 = VNICSocketOpenPacket(callbackAddress="1.1.1.1", callbackPort=80)
+    v1 = VNICSocketOpenPacket(ConnectionId=1, callbackAddress="1.1.1.1", callbackPort=80)
     connectData = v1.SocketConnectData(destination="2.2.2.2",destinationPort=1000)
     v1.connectData = connectData
     
@@ -109,7 +198,7 @@ def basicUnitTest():
     v1a = VNICSocketOpenPacket.Deserialize(v1.__serialize__())
     assert v1 == v1a
     
-    v2 = VNICSocketOpenResponsePacket()
+    v2 = VNICSocketOpenResponsePacket(ConnectionId=1)
     v2.port = 666
     v2.errorCode = 1
     v2.errorMessage = "test failure"
@@ -118,7 +207,7 @@ def basicUnitTest():
     assert v2 == v2a
     assert v2a.isFailure()
     
-    v3 = VNICConnectionSpawnedPacket()
+    v3 = VNICConnectionSpawnedPacket(ConnectionId=1)
     v3.spawnTcpPort=555
     v3.source="0.0.0.0"
     v3.sourcePort=999
@@ -128,6 +217,14 @@ def basicUnitTest():
     v3a = VNICConnectionSpawnedPacket.Deserialize(v3.__serialize__())
     assert v3 == v3a
     
+    v4 = VNICChannelDataPacket(channel=7, data=b"channel data")
+    v4a = VNICChannelDataPacket.Deserialize(v4.__serialize__())
+    assert v4 == v4a
+    
+    v5 = VNICSocketOptionPacket(ConnectionId=1, noDelay=1)
+    v5a = VNICSocketOptionPacket.Deserialize(v5.__serialize__())
+    assert v5 == v5a and v5a.noDelay == 1
+    
 if __name__ == "__main__":
     basicUnitTest()
     print("Basic unit test completed successfully.")
@@ -6,7 +6,7 @@ Created on Aug 20, 2013
 
 import random
 from .packets.management import SPMPPacket, PacketType, FramedSPMPWrapper, FramedPacketType
-from playground.asyncio_lib import SimpleCondition
+from playground.asyncio_lib import KeyedWaiters
 from playground.network.common import StackingTransport
 
 from asyncio import Protocol
@@ -33,8 +33,7 @@ class LocalAccessSecurityPolicy:
 class SPMPClientProtocol(Protocol):
     def __init__(self, security=None, framed=False):
         self._security = security
-        self._responses = {}
-        self._responseCondition = SimpleCondition()
+        self._responseWaiters = KeyedWaiters()
         
         self._deserializer = SPMPPacket.Deserializer()
         self._framed = framed
@@ -51,8 +50,7 @@ class SPMPClientProtocol(Protocol):
             result, error = packet.result, packet.error
             if error == packet.UNSET:
                 error = None
-            self._responses[packet.requestId] = (result, error)
-            self._responseCondition.notify()
+            self._responseWaiters.resolve(packet.requestId, (result, error))
         
     async def query(self, cmd, *args):
         request = SPMPPacket()
@@ -62,10 +60,9 @@ class SPMPClientProtocol(Protocol):
         request.result = ""
         self._security and self._security.addSecurityParameters(self, request)
         
+        response = self._responseWaiters.wait(request.requestId)
         self.transport.write(request.__serialize__())
-        
-        cond = await self._responseCondition.awaitCondition(lambda: request.requestId in self._responses)
-        return self._responses[request.requestId]
+        return await response
 
 class SPMPServerProtocol(Protocol):
     def __init__(self, device, apiMap, security=None, framed=False):
@@ -138,6 +135,12 @@ class HiddenSPMPServerProtocol(SPMPServerProtocol):
         super().connection_lost(reason)
         self._mainProtocol.connection_lost(reason)
         
+    def pause_writing(self):
+        self._mainProtocol.pause_writing()
+        
+    def resume_writing(self):
+        self._mainProtocol.resume_writing()
+        
 class FramedTransport(StackingTransport):
     def write(self, data):
         framedPacket = FramedSPMPWrapper(spmpPacket=data)
@@ -6,10 +6,11 @@ Created on Aug 20, 2013
 
 import random
 from .packets.switching_packets import AnnounceLinkPacket, WirePacket, FramedPacketType
-from playground.common import Timer, Minutes, Seconds
+from playground.network.packet.encoders.PacketFramingStream import PacketFramingStreamAdapter
+from playground.common import Minutes
 
 from asyncio import Protocol
-import io, logging
+import asyncio, bisect, collections, heapq, io, logging, struct, zlib
 
 logger = logging.getLogger(__name__)
 
@@ -54,47 +55,426 @@ class PlaygroundSwitchRxProtocol(Protocol):
                 self._switch.handleExtensionPacket(self, packet)
             #errReporter.error("Unexpected message received", exception=NetworkError.UnexpectedPacket(packet))
             
-class PlaygroundSwitchTxProtocol(Protocol):
-    MAX_MSG_SIZE = 2**16
-    
-    class FragStorage:
-        def __init__(self, fragId, totalSize, parentContainer):
-            self._fragId = fragId
-            self._totalSize = totalSize
-            self._parentContainer = parentContainer
-            self._received = 0
-            self._bufferStream = io.BytesIO()
-            self._offsetsReceived = set([])
-            self._cleanUpTimer = Timer(Minutes(5), self._removeFromParentContainer)
-            self._cleanUpTimer.start()
-            
-        def _removeFromParentContainer(self):
-            if self._fragId in self._parentContainer:
-                del self._parentContainer[self._fragId]
-            
-        def insert(self, fragOffset, fragData):
-            if fragOffset in self._offsetsReceived: return
-            self._offsetsReceived.add(fragOffset)
-            self._bufferStream.seek(fragOffset)
-            self._bufferStream.write(fragData)
-            self._received += len(fragData)
-            self._cleanUpTimer.extend(Minutes(5))
-            
-        def isComplete(self):
-            return self._received == self._totalSize
+class FragStorage:
+    """
+    Reassembly buffer for one fragmented message. The buffer is
+    preallocated to the full message size and coverage is tracked
+    as a sorted list of non-overlapping [start, end) intervals, so
+    duplicate or overlapping fragments never double count.
+    """
+    def __init__(self, fragId, totalSize):
+        self._fragId = fragId
+        self._totalSize = totalSize
+        self._buffer = bytearray(totalSize)
+        self._starts = []
+        self._ends = []
+        self._received = 0
+        
+    def totalSize(self):
+        return self._totalSize
+        
+    def memoryUsed(self):
+        return self._totalSize
+        
+    def insert(self, fragOffset, fragData):
+        """
+        Returns the number of new bytes covered by this fragment.
+        Fragments that fall outside the message are rejected.
+        """
+        fragEnd = fragOffset + len(fragData)
+        if fragOffset < 0 or fragEnd > self._totalSize:
+            raise ValueError("Fragment [{}, {}) outside message of size {}".format(fragOffset, fragEnd, self._totalSize))
+        if fragEnd == fragOffset:
+            return 0
+        
+        # find every interval that touches [fragOffset, fragEnd)
+        first = bisect.bisect_left(self._ends, fragOffset)
+        last = bisect.bisect_right(self._starts, fragEnd)
+        
+        newStart, newEnd = fragOffset, fragEnd
+        alreadyCovered = 0
+        for i in range(first, last):
+            alreadyCovered += max(0, min(self._ends[i], fragEnd) - max(self._starts[i], fragOffset))
+            newStart = min(newStart, self._starts[i])
+            newEnd = max(newEnd, self._ends[i])
+        newBytes = (fragEnd - fragOffset) - alreadyCovered
+        if newBytes == 0:
+            return 0
+        
+        self._buffer[fragOffset:fragEnd] = fragData
+        self._starts[first:last] = [newStart]
+        self._ends[first:last] = [newEnd]
+        self._received += newBytes
+        return newBytes
+        
+    def contiguousBytes(self):
+        """
+        Number of bytes available from the start of the message
+        """
+        if self._starts and self._starts[0] == 0:
+            return self._ends[0]
+        return 0
+        
+    def isComplete(self):
+        return self._received == self._totalSize
+        
+    def getData(self):
+        return bytes(self._buffer)
+        
+class StreamFragStorage:
+    """
+    Reassembly state for one message that is delivered in order as
+    it arrives, rather than all at once. Data contiguous with what
+    has already been delivered is handed off immediately; only
+    fragments that arrive ahead of a gap are held, so memory is
+    bounded by the amount of reordering rather than the message size.
+    """
+    def __init__(self, fragId, totalSize):
+        self._fragId = fragId
+        self._totalSize = totalSize
+        self._delivered = 0
+        self._ready = []
+        
+        # out of order fragments: offset -> data, with a heap of offsets
+        self._pending = {}
+        self._pendingOffsets = []
+        self._pendingBytes = 0
+        
+    def totalSize(self):
+        return self._totalSize
+        
+    def memoryUsed(self):
+        return self._pendingBytes
+        
+    def insert(self, fragOffset, fragData):
+        """
+        Returns the number of new bytes this fragment contributes.
+        Fragments that fall outside the message are rejected.
+        """
+        fragEnd = fragOffset + len(fragData)
+        if fragOffset < 0 or fragEnd > self._totalSize:
+            raise ValueError("Fragment [{}, {}) outside message of size {}".format(fragOffset, fragEnd, self._totalSize))
+        before = self._delivered + self._pendingBytes
+        if fragEnd <= self._delivered:
+            return 0
+        
+        if fragOffset <= self._delivered:
+            self._deliver(fragOffset, fragData)
+            while self._pendingOffsets and self._pendingOffsets[0] <= self._delivered:
+                offset = heapq.heappop(self._pendingOffsets)
+                data = self._pending.pop(offset)
+                self._pendingBytes -= len(data)
+                if offset + len(data) > self._delivered:
+                    self._deliver(offset, data)
+        elif len(fragData) > len(self._pending.get(fragOffset, b"")):
+            if fragOffset in self._pending:
+                self._pendingBytes -= len(self._pending[fragOffset])
+            else:
+                heapq.heappush(self._pendingOffsets, fragOffset)
+            self._pending[fragOffset] = fragData
+            self._pendingBytes += len(fragData)
+        return self._delivered + self._pendingBytes - before
+        
+    def _deliver(self, offset, data):
+        skip = self._delivered - offset
+        self._ready.append(data[skip:] if skip else data)
+        self._delivered = offset + len(data)
+        
+    def contiguousBytes(self):
+        return self._delivered
+        
+    def isComplete(self):
+        return self._delivered == self._totalSize
+        
+    def takeData(self):
+        """
+        Returns the data that has become contiguous since the last
+        call, or None.
+        """
+        if not self._ready:
+            return None
+        data = b"".join(self._ready)
+        self._ready = []
+        return data
             
-        def getData(self):
-            return self._bufferStream.getvalue()
+class FragmentReassembler:
+    """
+    Holds every incomplete message for one link.
+    
+    Memory is bounded: buffers are allocated at their full size when
+    the first fragment arrives, and if the total would exceed
+    maxMemory, the least recently active messages are evicted first.
+    Incomplete messages with no activity for `timeout` seconds are
+    dropped by a single sweeper shared by all messages, instead of a
+    timer per message.
+    
+    In incremental mode, messages are delivered in order as they
+    arrive (see StreamFragStorage) and only out of order fragments
+    count against maxMemory. A message that is evicted or expires
+    after part of it was delivered can't be completed, so onAbort(key)
+    is called and the consumer should give up on it (the VNIC closes
+    the connection). The fragment that triggers an eviction never
+    evicts its own message unless that message alone is over budget.
+    Then nothing more of it is returned.
+    
+    Keys of dropped (evicted or expired) messages are remembered until
+    `timeout` seconds pass without a fragment for them. Late fragments
+    are discarded, rather than buffered as a new message that could
+    never complete.
+    """
+    MAX_MEMORY     = 64*1024*1024
+    TIMEOUT        = Minutes(5).seconds()
+    SWEEP_INTERVAL = 10
+    
+    def __init__(self, maxMemory=None, timeout=None, incremental=False, onAbort=None):
+        self._maxMemory = maxMemory or self.MAX_MEMORY
+        self._timeout = timeout or self.TIMEOUT
+        self._incremental = incremental
+        self._onAbort = onAbort
+        self._loop = None
+        
+        # key -> [FragStorage, last activity]. Ordered least recently active first.
+        self._messages = collections.OrderedDict()
+        self._memory = 0
+        # dropped key -> last activity, in the same order
+        self._dropped = collections.OrderedDict()
+        self._sweeper = None
+        self.stats = {"completed":0, "evicted":0, "expired":0, "aborted":0, "rejected":0, "discarded":0,
+                      "duplicateBytes":0}
+        
+    def memoryUsed(self):
+        return self._memory
+        
+    def __len__(self):
+        return len(self._messages)
+        
+    def incremental(self):
+        return self._incremental
+    
+    def insert(self, key, totalSize, fragOffset, fragData):
+        """
+        Adds a fragment. Returns the complete message when this
+        fragment finishes it, otherwise None. In incremental mode,
+        returns whatever data became contiguous, otherwise None.
+        """
+        if key in self._dropped:
+            self._dropped[key] = self._loop.time()
+            self._dropped.move_to_end(key)
+            self.stats["discarded"] += 1
+            return None
+        if key in self._messages:
+            record = self._messages[key]
+            storage = record[0]
+            if storage.totalSize() != totalSize:
+                self.stats["rejected"] += 1
+                return None
+            self._messages.move_to_end(key)
+        elif self._incremental:
+            storage = StreamFragStorage(key, totalSize)
+            record = [storage, None]
+            self._messages[key] = record
+            self._startSweeper()
+        else:
+            if totalSize > self._maxMemory:
+                self.stats["rejected"] += 1
+                return None
+            while self._memory + totalSize > self._maxMemory:
+                self._drop(next(iter(self._messages)), "evicted")
+            storage = FragStorage(key, totalSize)
+            record = [storage, None]
+            self._messages[key] = record
+            self._memory += storage.memoryUsed()
+            self._startSweeper()
+        record[1] = self._loop.time()
+        
+        memoryBefore = storage.memoryUsed()
+        try:
+            newBytes = storage.insert(fragOffset, fragData)
+        except ValueError:
+            self.stats["rejected"] += 1
+            return None
+        self._memory += storage.memoryUsed() - memoryBefore
+        self.stats["duplicateBytes"] += len(fragData) - newBytes
+        
+        if self._incremental:
+            data = storage.takeData()
+            if storage.isComplete():
+                self._remove(key)
+                self.stats["completed"] += 1
+            else:
+                # held fragments can grow; evict the least recently active.
+                # This message is the most recently active, so it goes last.
+                while self._memory > self._maxMemory:
+                    evictKey = next(iter(self._messages))
+                    if evictKey == key:
+                        # the caller never sees data, so only earlier deliveries count
+                        self._drop(key, "evicted", undelivered=len(data or b""))
+                        return None
+                    self._drop(evictKey, "evicted")
+            return data
+        
+        if not storage.isComplete():
+            return None
+        
+        self._remove(key)
+        self.stats["completed"] += 1
+        return storage.getData()
+        
+    def _remove(self, key):
+        storage, lastActivity = self._messages.pop(key)
+        self._memory -= storage.memoryUsed()
+        return storage, lastActivity
+        
+    def _drop(self, key, reason, undelivered=0):
+        storage, lastActivity = self._remove(key)
+        self.stats[reason] += 1
+        self._dropped[key] = self._loop.time()
+        if self._incremental and storage.contiguousBytes() > undelivered:
+            self.stats["aborted"] += 1
+            if self._onAbort:
+                self._onAbort(key)
+        
+    def _startSweeper(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        if self._sweeper is None:
+            self._sweeper = self._loop.call_later(self.SWEEP_INTERVAL, self._sweep)
+        
+    def _sweep(self):
+        self._sweeper = None
+        expiration = self._loop.time() - self._timeout
+        # least recently active first, so stop at the first live message
+        while self._messages:
+            key = next(iter(self._messages))
+            if self._messages[key][1] > expiration:
+                break
+            self._drop(key, "expired")
+        while self._dropped and next(iter(self._dropped.values())) <= expiration:
+            self._dropped.popitem(last=False)
+        if self._messages or self._dropped:
+            self._startSweeper()
             
-        def cleanup(self):
-            self._cleanUpTimer.expire()
-            return self.getData()
+    def clear(self):
+        self._messages.clear()
+        self._dropped.clear()
+        self._memory = 0
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+class WireFragmenter:
+    """
+    Produces the framed WirePackets for one fragmented message
+    without copying the payload.
+    
+    A WirePacket with fragData set and empty data is serialized
+    once. Every fragment of the message shares that header except
+    for the frame size and checksum, the packet length, the
+    fragment offset, and the data length, which are patched in
+    place. The payload is never copied; each fragment is a
+    memoryview slice of the original data.
+    
+    With no fragId, the template has no fragData and frame()
+    serializes whole, unfragmented packets for the flow.
+    """
+    FRAME_PREFIX_SIZE = PacketFramingStreamAdapter.PREFIX_SIZE
+    FRAME_SUFFIX_SIZE = PacketFramingStreamAdapter.SUFFIX_SIZE
+    MAGIC             = PacketFramingStreamAdapter.MAGIC
+    REV_MAGIC         = PacketFramingStreamAdapter.REV_MAGIC
+    
+    # The data field is last: tag (!H) then length (!Q). The fragment
+    # offset (!Q) is the last field of fragData, immediately before it.
+    DATA_LENGTH_SIZE     = 8
+    DATA_TAG_SIZE        = 2
+    OFFSET_SIZE          = 8
+    
+    LENGTH_CHECK_MASK    = 0xFFFFFFFFFFFFFFFF
+    
+    def __init__(self, source, sourcePort, destination, destinationPort, fragId=None, totalSize=None):
+        template = WirePacket(source          = source,
+                              sourcePort      = sourcePort,
+                              destination     = destination,
+                              destinationPort = destinationPort,
+                              data            = b"")
+        if fragId is not None:
+            template.fragData = WirePacket.FragmentData(fragId=fragId, totalSize=totalSize, offset=0)
+        serialized = template.__serialize__()
+        self._header = serialized[:-self.FRAME_SUFFIX_SIZE]
+        self._packetSize = len(self._header) - self.FRAME_PREFIX_SIZE
+        self._dataLengthPosition = len(self._header) - self.DATA_LENGTH_SIZE
+        self._offsetPosition = self._dataLengthPosition - self.DATA_TAG_SIZE - self.OFFSET_SIZE
+        self._magicCheck = zlib.adler32(self.MAGIC)
+        
+    def fragments(self, data, mtu, offset=0):
+        """
+        Returns a list of buffers that, written in order, are the
+        serialized fragments of data, at most mtu bytes of data each.
+        The data is placed at offset within the message.
+        """
+        view = memoryview(data)
+        buffers = []
+        for start in range(0, len(view), mtu):
+            chunk = view[start:start+mtu]
+            header, suffix = self._frameParts(len(chunk))
+            struct.pack_into("!Q", header, self._offsetPosition, offset+start)
+            buffers.append(header)
+            buffers.append(chunk)
+            buffers.append(suffix)
+        return buffers
+        
+    def frame(self, data):
+        """
+        Returns the serialized, unfragmented WirePacket carrying data.
+        Only for fragmenters created without a fragId.
+        """
+        header, suffix = self._frameParts(len(data))
+        return b"".join((header, data, suffix))
+        
+    def _frameParts(self, dataSize):
+        packetSize = self._packetSize + dataSize
+        sizeBytes = struct.pack("!I", packetSize)
+        
+        header = bytearray(self._header)
+        struct.pack_into("!4sI", header, 4, sizeBytes, zlib.adler32(sizeBytes, self._magicCheck))
+        struct.pack_into("!QQ", header, self.FRAME_PREFIX_SIZE, packetSize, packetSize^self.LENGTH_CHECK_MASK)
+        struct.pack_into("!Q", header, self._dataLengthPosition, dataSize)
+        
+        suffixCheck = zlib.adler32(self.REV_MAGIC, zlib.adler32(sizeBytes))
+        return header, struct.pack("!I4s4s", suffixCheck, sizeBytes, self.REV_MAGIC)
+        
+async def _readChunks(stream, size):
+    """
+    Iterates over the data in a file-like object (including one with
+    a coroutine read, like asyncio.StreamReader), an async iterator,
+    or an ordinary iterator of bytes.
+    """
+    if hasattr(stream, "read"):
+        while True:
+            chunk = stream.read(size)
+            if asyncio.iscoroutine(chunk):
+                chunk = await chunk
+            if not chunk:
+                return
+            yield chunk
+    elif hasattr(stream, "__aiter__"):
+        async for chunk in stream:
+            yield chunk
+    else:
+        for chunk in stream:
+            yield chunk
+
+class PlaygroundSwitchTxProtocol(Protocol):
+    MAX_MSG_SIZE = 2**16
     
-    def __init__(self, demuxer, address):
+    def __init__(self, demuxer, address, maxReassemblyMemory=None, mtu=None, incrementalDelivery=False):
         self._demuxer = demuxer
         self._address = address
+        self._mtu = None
+        self.setMtu(mtu)
         self._deserializer = WirePacket.Deserializer()
-        self._fragStorage = {}
+        self._fragStorage = FragmentReassembler(maxMemory=maxReassemblyMemory, incremental=incrementalDelivery,
+                                                onAbort=self._fragmentsAborted)
+        self._writable = None
         self.transport = None
         
     def connection_made(self, transport):
@@ -107,32 +487,97 @@ class PlaygroundSwitchTxProtocol(Protocol):
         announceLinkPacket = AnnounceLinkPacket(address=self._address)
         self.transport.write(announceLinkPacket.__serialize__())
         
-    def write(self, source, sourcePort, destination, destinationPort, data):
-        wirePacket = WirePacket(source          = source,
-                                sourcePort      = sourcePort,
-                                destination     = destination,
-                                destinationPort = destinationPort)
+    def mtu(self):
+        return self._mtu
+        
+    def setMtu(self, mtu):
+        """
+        Set the largest amount of data sent in a single WirePacket.
+        Larger writes are fragmented. None restores the default.
+        """
+        if mtu == None:
+            mtu = self.MAX_MSG_SIZE
+        mtu = int(mtu)
+        if mtu <= 0:
+            raise Exception("Invalid MTU {}".format(mtu))
+        self._mtu = mtu
         
-        if len(data) <= self.MAX_MSG_SIZE:
-            wirePacket.data = data
+    def write(self, source, sourcePort, destination, destinationPort, data):
+        if len(data) <= self._mtu:
+            wirePacket = WirePacket(source          = source,
+                                    sourcePort      = sourcePort,
+                                    destination     = destination,
+                                    destinationPort = destinationPort,
+                                    data            = data)
             self.transport.write(wirePacket.__serialize__())
             return
         
-        fragData = WirePacket.FragmentData()
-        fragData.fragId = random.getrandbits(32)
-        fragData.totalSize = len(data)
-        offset = 0
+        fragmenter = WireFragmenter(source, sourcePort, destination, destinationPort,
+                                    random.getrandbits(32), len(data))
+        self.transport.writelines(fragmenter.fragments(data, self._mtu))
+        
+    async def writeStream(self, source, sourcePort, destination, destinationPort, stream, totalSize=None):
+        """
+        Send one message whose data comes from stream: a file-like
+        object, an async iterator, or an iterator of bytes. Fragments
+        are sent as soon as a full MTU of data is available, and the
+        send waits whenever the transport asks to pause, so only about
+        one fragment is held in memory regardless of the message size.
         
-        while data:
-            fragData.offset = offset
-            wirePacket.fragData = fragData
-            wirePacket.data = data[:self.MAX_MSG_SIZE]
+        Every fragment carries the total size, so totalSize is required
+        unless stream is a seekable file. Other writes to the same
+        connection should not be interleaved with a stream.
+        """
+        if totalSize == None:
+            if not (hasattr(stream, "seekable") and stream.seekable()):
+                raise Exception("Total size required for a stream that is not seekable")
+            position = stream.tell()
+            totalSize = stream.seek(0, io.SEEK_END) - position
+            stream.seek(position)
             
-            data = data[self.MAX_MSG_SIZE:]
-            offset += len(wirePacket.data)
+        fragmenter = WireFragmenter(source, sourcePort, destination, destinationPort,
+                                    random.getrandbits(32), totalSize)
+        offset = 0
+        chunks, buffered = [], 0
+        async for chunk in _readChunks(stream, self._mtu):
+            chunks.append(chunk)
+            buffered += len(chunk)
+            if buffered < self._mtu:
+                continue
+            # join (copy) only when a fragment spans chunks; the
+            # transport may still hold views of the data, so never reuse it.
+            if len(chunks) == 1 and isinstance(chunks[0], bytes):
+                data = memoryview(chunks[0])
+            else:
+                data = memoryview(b"".join(chunks))
+            sendable = buffered - (buffered % self._mtu)
+            offset = await self._writeFragments(fragmenter, data[:sendable], offset, totalSize)
+            chunks = [bytes(data[sendable:])]
+            buffered -= sendable
+        if buffered or offset == 0:
+            offset = await self._writeFragments(fragmenter, b"".join(chunks), offset, totalSize)
+        if offset != totalSize:
+            raise Exception("Stream produced {} bytes but total size was {}".format(offset, totalSize))
+        return offset
+        
+    async def _writeFragments(self, fragmenter, data, offset, totalSize):
+        if offset + len(data) > totalSize:
+            raise Exception("Stream produced more than total size {}".format(totalSize))
+        while self._writable:
+            await self._writable
+        if not self.transport:
+            raise Exception("Link closed while streaming")
+        self.transport.writelines(fragmenter.fragments(data, self._mtu, offset))
+        return offset + len(data)
+        
+    def pause_writing(self):
+        if not self._writable:
+            self._writable = asyncio.get_event_loop().create_future()
             
-            # transmit packet
-            self.transport.write(wirePacket.__serialize__())
+    def resume_writing(self):
+        if self._writable:
+            self._writable.set_result(True)
+            self._writable = None
 
     def data_received(self, data):
         try:
@@ -142,15 +587,14 @@ class PlaygroundSwitchTxProtocol(Protocol):
     
     def _data_received(self, data):
         self._deserializer.update(data)
-        demuxData = None
         for wirePacket in self._deserializer.nextPackets():
             if wirePacket.isFragment():
                 fragData = wirePacket.fragData
-                if not fragData.fragId in self._fragStorage:
-                    self._fragStorage[fragData.fragId] = self.FragStorage(fragData.fragId, fragData.totalSize, self._fragStorage)
-                self._fragStorage[fragData.fragId].insert(fragData.offset, wirePacket.data)
-                if self._fragStorage[fragData.fragId].isComplete():
-                    demuxData = self._fragStorage[fragData.fragId].cleanup()
+                # fragment ids are only unique per sender. The destination identifies
+                # the connection if the message is aborted.
+                fragKey = (wirePacket.source, wirePacket.sourcePort, wirePacket.destination, wirePacket.destinationPort,
+                           fragData.fragId)
+                demuxData = self._fragStorage.insert(fragKey, fragData.totalSize, fragData.offset, wirePacket.data)
             else:
                 demuxData = wirePacket.data
                 
@@ -159,8 +603,15 @@ class PlaygroundSwitchTxProtocol(Protocol):
                                     wirePacket.destination, wirePacket.destinationPort,
                                     demuxData)
                                     
+    def _fragmentsAborted(self, fragKey):
+        # part of the message was delivered (incremental mode). The demuxer must give up on it.
+        source, sourcePort, destination, destinationPort, fragId = fragKey
+        self._demuxer.demuxAbort(source, sourcePort, destination, destinationPort)
+                                    
     def connection_lost(self, reason=None):
         self.transport = None
+        self._fragStorage.clear()
+        self.resume_writing()
         self._demuxer.connectionLost()
                                     
 
@@ -187,8 +638,11 @@ def basicUnitTest():
     class MockClient:
         def __init__(self):
             self.results = []
+            self.aborted = []
         def demux(self, source, sourcePort, destination, destinationPort, data):
             self.results.append((source, sourcePort, destination, destinationPort, data))
+        def demuxAbort(self, source, sourcePort, destination, destinationPort):
+            self.aborted.append((source, sourcePort, destination, destinationPort))
         def connectionMade(self):
             pass
         def connectionLost(self):
@@ -245,12 +699,153 @@ def basicUnitTest():
     
     curWriteCount = c3Transport.writeCount
     c3Tx.write("2.2.2.2", 1000, "1.1.1.1", 80, largeData)
-    # should have written twice (two fragments)
-    assert c3Transport.writeCount == (curWriteCount + 2)
+    # both fragments should go out in a single writelines
+    assert c3Transport.writeCount == (curWriteCount + 1)
     
     print("client 1 results count {}, len data {}, original len{}.".format(len(client1.results), len(client1.results[1][-1]), len(largeData)))
     assert client1.results[1][-1] == largeData
     
+    # streaming sends from a file and from an async iterator
+    streamLoop = asyncio.new_event_loop()
+    asyncio.set_event_loop(streamLoop)
+    sent = streamLoop.run_until_complete(c3Tx.writeStream("2.2.2.2", 1000, "1.1.1.1", 80, io.BytesIO(largeData)))
+    assert sent == len(largeData)
+    assert client1.results[-1][-1] == largeData
+    
+    async def produce():
+        for i in range(0, len(largeData), 5000):
+            yield largeData[i:i+5000]
+    coro = c3Tx.writeStream("2.2.2.2", 1000, "1.1.1.1", 80, produce(), totalSize=len(largeData))
+    streamLoop.run_until_complete(coro)
+    assert client1.results[-1][-1] == largeData
+    resultCount = len(client1.results)
+    
+    # incremental delivery hands over contiguous data as it arrives
+    client4 = MockClient()
+    c4Tx = PlaygroundSwitchTxProtocol(client4, "4.4.4.4", incrementalDelivery=True)
+    rx4 = PlaygroundSwitchRxProtocol(switch)
+    c4Transport, rx4Transport = MockTransport.CreateTransportPair(c4Tx, rx4)
+    rx4.connection_made(rx4Transport)
+    c4Tx.connection_made(c4Transport)
+    c3Tx.setMtu(1000)
+    streamLoop.run_until_complete(c3Tx.writeStream("2.2.2.2", 1000, "4.4.4.4", 80, io.BytesIO(largeData)))
+    deliveries = [result[-1] for result in client4.results]
+    assert len(deliveries) == (len(largeData)+999)//1000
+    assert b"".join(deliveries) == largeData
+    c3Tx.setMtu(None)
+    
+    # out of order fragments are held until the gap is filled
+    reassembler = FragmentReassembler(incremental=True)
+    message = bytes(range(100))
+    assert reassembler.insert("s", 100, 0, message[:20]) == message[:20]
+    assert reassembler.insert("s", 100, 50, message[50:]) == None
+    assert reassembler.insert("s", 100, 30, message[30:50]) == None
+    assert reassembler.memoryUsed() == 70
+    assert reassembler.insert("s", 100, 10, message[10:40]) == message[20:]
+    assert reassembler.memoryUsed() == 0 and len(reassembler) == 0
+    assert reassembler.stats["completed"] == 1
+    
+    # evicting a partly delivered message aborts it. Its late fragments are discarded.
+    aborted = []
+    reassembler = FragmentReassembler(maxMemory=100, incremental=True, onAbort=aborted.append)
+    assert reassembler.insert("p", 100, 0, message[:10]) == message[:10]
+    assert reassembler.insert("q", 200, 100, bytes(60)) == None
+    # p is over budget and most recently active, so q (nothing delivered yet) goes quietly
+    assert reassembler.insert("p", 100, 50, message[50:]) == None
+    assert aborted == [] and reassembler.stats["evicted"] == 1
+    assert reassembler.insert("r", 200, 100, bytes(60)) == None
+    assert aborted == ["p"] and reassembler.stats["aborted"] == 1
+    assert reassembler.insert("p", 100, 10, message[10:50]) == None
+    assert reassembler.insert("q", 200, 0, bytes(100)) == None
+    assert reassembler.stats["discarded"] == 2 and len(reassembler) == 1 and reassembler.memoryUsed() == 60
+    # a message over budget by itself is aborted by its own fragment
+    assert reassembler.insert("s", 300, 0, bytes(10)) == bytes(10)
+    assert reassembler.insert("s", 300, 100, bytes(150)) == None
+    assert aborted == ["p", "s"] and len(reassembler) == 0 and reassembler.memoryUsed() == 0
+    
+    # the demuxer hears about aborted messages
+    client5 = MockClient()
+    c5Tx = PlaygroundSwitchTxProtocol(client5, "5.5.5.5", maxReassemblyMemory=1500, incrementalDelivery=True)
+    buffers = WireFragmenter("2.2.2.2", 1000, "5.5.5.5", 80, 77, len(largeData)).fragments(largeData, 1000)
+    c5Tx.data_received(b"".join(buffers[:3]))
+    assert client5.results[-1][-1] == largeData[:1000]
+    c5Tx.data_received(b"".join(buffers[6:12]))
+    assert client5.aborted == [("2.2.2.2", 1000, "5.5.5.5", 80)]
+    c5Tx.data_received(b"".join(buffers[3:6]))
+    assert len(client5.results) == 1
+    
+    # a smaller MTU fragments more; the patched headers match a full serialization
+    c3Tx.setMtu(1000)
+    c3Tx.write("2.2.2.2", 1000, "1.1.1.1", 80, largeData)
+    assert client1.results[-1][-1] == largeData
+    c3Tx.setMtu(None)
+    assert c3Tx.mtu() == PlaygroundSwitchTxProtocol.MAX_MSG_SIZE
+    
+    fragmenter = WireFragmenter("2.2.2.2", 1000, "1.1.1.1", 80, 1234, len(largeData))
+    buffers = fragmenter.fragments(largeData, 1000)
+    assert len(buffers) == 3*((len(largeData)+999)//1000)
+    for i in range(0, len(buffers), 3):
+        offset = (i//3)*1000
+        fragData = WirePacket.FragmentData(fragId=1234, totalSize=len(largeData), offset=offset)
+        expected = WirePacket(source="2.2.2.2", sourcePort=1000, destination="1.1.1.1", destinationPort=80,
+                              fragData=fragData, data=largeData[offset:offset+1000])
+        assert b"".join(buffers[i:i+3]) == expected.__serialize__()
+        
+    # whole packets, as used for packet capture
+    framer = WireFragmenter("2.2.2.2", 1000, "1.1.1.1", 80)
+    for data in [b"", b"short", largeData]:
+        expected = WirePacket(source="2.2.2.2", sourcePort=1000, destination="1.1.1.1", destinationPort=80, data=data)
+        assert framer.frame(data) == expected.__serialize__()
+    
+    # overlapping, duplicate, and out of order fragments
+    reassembler = FragmentReassembler(maxMemory=250)
+    message = bytes(range(100))
+    assert reassembler.insert("a", 100, 50, message[50:]) == None
+    assert reassembler.insert("a", 100, 50, message[50:]) == None
+    assert reassembler.insert("a", 100, 20, message[20:70]) == None
+    assert reassembler.stats["duplicateBytes"] == 70
+    assert reassembler.insert("a", 100, 0, message[:30]) == message
+    assert len(reassembler) == 0 and reassembler.memoryUsed() == 0
+    
+    # fragments outside the message, and mismatched sizes, are rejected
+    assert reassembler.insert("b", 100, 90, message[:20]) == None
+    assert reassembler.insert("b", 200, 0, message[:20]) == None
+    assert reassembler.stats["rejected"] == 2
+    
+    # the memory budget evicts the least recently active message
+    assert reassembler.insert("c", 100, 0, message[:10]) == None
+    assert reassembler.insert("b", 100, 0, message[:10]) == None
+    assert reassembler.insert("d", 100, 0, message[:10]) == None
+    assert reassembler.stats["evicted"] == 1
+    assert reassembler.memoryUsed() == 200
+    assert reassembler.insert("b", 100, 10, message[10:]) == message
+    assert reassembler.insert("c", 100, 10, message[10:]) == None
+    
+    # incomplete messages expire
+    from playground.asyncio_lib.testing import TestLoopEx
+    testLoop = TestLoopEx()
+    asyncio.set_event_loop(testLoop)
+    reassembler = FragmentReassembler(timeout=30)
+    reassembler.insert("e", 100, 0, message[:10])
+    testLoop.advanceClock(20)
+    reassembler.insert("f", 100, 0, message[:10])
+    testLoop.advanceClock(20)
+    assert len(reassembler) == 1
+    testLoop.advanceClock(20)
+    assert len(reassembler) == 0
+    assert reassembler.stats["expired"] == 2
+    
+    aborted = []
+    reassembler = FragmentReassembler(timeout=30, incremental=True, onAbort=aborted.append)
+    assert reassembler.insert("g", 100, 0, message[:10]) == message[:10]
+    testLoop.advanceClock(40)
+    assert aborted == ["g"] and reassembler.stats["expired"] == 1
+    assert reassembler.insert("g", 100, 10, message[10:]) == None
+    assert reassembler.stats["discarded"] == 1
+    # the dropped key is forgotten after the timeout
+    testLoop.advanceClock(40)
+    assert reassembler.insert("g", 100, 0, message) == message
+    
     c1Transport.close()
     assert c1Tx.transport == None
     assert rx1Transport.closed
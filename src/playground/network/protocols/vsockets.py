@@ -4,21 +4,56 @@ from playground.network.protocols.packets.vsocket_packets import VNICSocketOpenP
                                                                     VNICConnectionSpawnedPacket,    \
                                                                     VNICStartDumpPacket,            \
                                                                     VNICStopDumpPacket,             \
+                                                                    VNICDumpFilterPacket,           \
                                                                     VNICSocketControlPacket,        \
                                                                     VNICSocketClosePacket,          \
+                                                                    VNICSocketOptionPacket,         \
                                                                     VNICPromiscuousLevelPacket,     \
+                                                                    VNICMultiplexPacket,            \
+                                                                    VNICChannelSpawnedPacket,       \
+                                                                    VNICChannelDataPacket,          \
+                                                                    VNICChannelCreditPacket,        \
+                                                                    VNICChannelClosePacket,         \
                                                                     PacketType
 from playground.network.protocols.packets.switching_packets import WirePacket
+from playground.network.packet import FIELD_NOT_SET
 from playground.network.common import StackingProtocol, StackingTransport
 from playground.network.common import PortKey
 from playground.common import CustomConstant as Constant
 
 
-from asyncio import Protocol
-import asyncio, logging, random
+from asyncio import Protocol, Transport
+import asyncio, collections, logging, random, socket, struct
 from asyncio.futures import Future
 logger = logging.getLogger(__name__)
 
+# A callback address with this prefix is the path of a unix domain socket.
+UNIX_CALLBACK_PREFIX = "unix:"
+
+def UnixSpawnKey(source, sourcePort, destination, destinationPort):
+    """
+    Unix domain callback connections have no local port to identify
+    them, so the VNIC starts each one with a header carrying this key.
+    The client computes the same key from the VNICConnectionSpawnedPacket.
+    """
+    return "{}:{}->{}:{}".format(source, sourcePort, destination, destinationPort)
+    
+def EncodeSpawnHeader(spawnKey):
+    keyBytes = spawnKey.encode()
+    return struct.pack("!H", len(keyBytes)) + keyBytes
+    
+def DecodeSpawnHeader(buf):
+    """
+    Returns (spawnKey, remaining data), or (None, buf) if the header
+    is not complete yet.
+    """
+    if len(buf) < 2:
+        return None, buf
+    keyLength, = struct.unpack_from("!H", buf)
+    if len(buf) < 2 + keyLength:
+        return None, buf
+    return buf[2:2+keyLength].decode(), buf[2+keyLength:]
+
 class SocketControl:
     SOCKET_TYPE_CONNECT = Constant(strValue="Outbound Connection Socket")
     SOCKET_TYPE_LISTEN  = Constant(strValue="Inbound Listening Socket")
@@ -32,10 +67,25 @@ class SocketControl:
         self._controlProtocol = controlProtocol
         self._spawnedConnectionKeys = set([])
         self._closed = False
+        self._noDelay = False
+        self._awaitResponse = None
         
     def connectionId(self):
         return self._connectionId
         
+    def noDelay(self):
+        return self._noDelay
+        
+    def setNoDelay(self, noDelay):
+        self._noDelay = noDelay
+        
+    def setAwaitResponse(self, timeout):
+        """
+        Hold the spawned notification up to timeout seconds for the
+        first data from the remote side, and send it along.
+        """
+        self._awaitResponse = timeout
+        
     def setPort(self, port):
         self._port = port
         
@@ -93,11 +143,23 @@ class SocketControl:
         if self._type == self.SOCKET_TYPE_CONNECT and len(self._spawnedConnectionKeys) != 0:
             raise Exception("Duplicate Connection on Outbound Connect!")
         
+        if self._controlProtocol.multiplexed():
+            # no reverse connection. The data goes over the control connection.
+            # Still spawn on the next loop iteration, so that the socket open
+            # response is sent first, just as with a reverse connection.
+            logger.debug("{} spawning channel on portkey {}".format(self.device(), portIndex))
+            asyncio.get_event_loop().call_soon(self._spawnChannel, portIndex)
+            return
+        
         logger.debug("{} spwaning connection on portkey {}. Callback={}:{}".format(self.device(), portIndex, self._callbackAddr, self._callbackPort))
         # create the reverse connection to complete opening the socket
         loop = asyncio.get_event_loop()
-        coro = loop.create_connection(lambda: ReverseOutboundSocketProtocol(self, portIndex), 
-                                      self._callbackAddr, self._callbackPort)
+        if self._isUnixCallback():
+            coro = loop.create_unix_connection(lambda: ReverseOutboundSocketProtocol(self, portIndex),
+                                               self._callbackAddr[len(UNIX_CALLBACK_PREFIX):])
+        else:
+            coro = loop.create_connection(lambda: ReverseOutboundSocketProtocol(self, portIndex), 
+                                          self._callbackAddr, self._callbackPort)
         futureConnection = asyncio.get_event_loop().create_task(coro)
         futureConnection.add_done_callback(self._spawnFinished)
     
@@ -112,13 +174,52 @@ class SocketControl:
         else:
             transport, protocol = futureConnection.result()
             
-            self._spawnedConnectionKeys.add(protocol._portKey)
-            self.device().spawnConnection(protocol._portKey, protocol)
+            if self._isUnixCallback():
+                # identify the connection before any data is written
+                portKey = protocol._portKey
+                transport.write(EncodeSpawnHeader(UnixSpawnKey(portKey.source, portKey.sourcePort,
+                                                               portKey.destination, portKey.destinationPort)))
+                reverseConnectionLocalPort = 0
+            else:
+                reverseConnectionLocalPort = transport.get_extra_info("sockname")[1]
+                
+            def spawned(initialData):
+                self._connectionSpawned(protocol)
+                self._controlProtocol.sendConnectionSpawned(self._connectionId, 
+                                                            reverseConnectionLocalPort, 
+                                                            protocol._portKey,
+                                                            initialData)
+            self._holdForResponse(protocol, spawned)
             
-            reverseConnectionLocalPort = transport.get_extra_info("sockname")[1]
-            self._controlProtocol.sendConnectionSpawned(self._connectionId, 
-                                                        reverseConnectionLocalPort, 
-                                                        protocol._portKey)
+    def _isUnixCallback(self):
+        return self._callbackAddr.startswith(UNIX_CALLBACK_PREFIX)
+        
+    def _spawnChannel(self, portIndex):
+        if self._closed or not self._controlProtocol.transport: return
+        protocol = ReverseOutboundSocketProtocol(self, portIndex)
+        channelId = self._controlProtocol.openChannel(protocol)
+        def spawned(initialData):
+            # the client has to know the channel before any data arrives on it
+            self._controlProtocol.sendChannelSpawned(self._connectionId, channelId, portIndex, initialData)
+            self._connectionSpawned(protocol)
+        self._holdForResponse(protocol, spawned)
+        
+    def _holdForResponse(self, protocol, spawned):
+        if not self._awaitResponse:
+            spawned(None)
+            return
+        def firstData(data):
+            if self._closed:
+                # closed while waiting. Nothing was spawned to close it.
+                protocol.transport and protocol.transport.close()
+                self.device().closeConnection(protocol._portKey)
+                return
+            spawned(data)
+        self.device().awaitFirstData(protocol._portKey, firstData, self._awaitResponse)
+        
+    def _connectionSpawned(self, protocol):
+        self._spawnedConnectionKeys.add(protocol._portKey)
+        self.device().spawnConnection(protocol._portKey, protocol)
         
 class ReverseOutboundSocketProtocol(Protocol):
     def __init__(self, control, portKey):
@@ -130,22 +231,166 @@ class ReverseOutboundSocketProtocol(Protocol):
         self.transport = transport
     def data_received(self, data):
         logger.debug("writing data from reverse to vnic")
-        self._control.device().write(self._portKey, data)
+        self._control.device().write(self._portKey, data, not self._control.noDelay())
     def connection_lost(self, reason=None):
         logger.debug("conneciton lost to reverse. reason={}".format(reason))
         self._control.closeSpawnedConnection(self._portKey)
 
+class MultiplexedChannel(Transport):
+    """
+    Transport for one connection carried over a VNIC control
+    connection instead of its own TCP connection. Data is sent
+    as VNICChannelDataPacket's tagged with the channel ID.
+    
+    Flow control is credit based. Each side may only have `window`
+    bytes outstanding on a channel; the receiver grants more credit
+    (VNICChannelCreditPacket) as its protocol consumes data. Data
+    written beyond the available credit is queued and the protocol
+    is paused until credit arrives.
+    
+    The multiplexer (the control protocol) provides `transport` and
+    `channelClosed(channelId, notify)`.
+    """
+    DEFAULT_WINDOW = 256*1024
+    
+    def __init__(self, multiplexer, channelId, protocol, credit, window, extra=None):
+        super().__init__(extra)
+        self._multiplexer = multiplexer
+        self._channelId = channelId
+        self._protocol = protocol
+        self._credit = credit
+        self._window = window
+        self._consumed = 0
+        self._queue = collections.deque()
+        self._queued = 0
+        self._paused = False
+        self._closing = False
+        self._lost = False
+        
+        # while reading is paused, data waits here without granting
+        # credit, so the peer can send at most one window.
+        self._readPaused = False
+        self._received = collections.deque()
+        
+    def channelId(self):
+        return self._channelId
+        
+    def get_protocol(self):
+        return self._protocol
+        
+    def is_closing(self):
+        return self._closing
+        
+    def get_write_buffer_size(self):
+        return self._queued
+        
+    def write(self, data):
+        if self._closing: return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        if not data: return
+        if self._queue or len(data) > self._credit:
+            self._queue.append(data)
+            self._queued += len(data)
+            self._flush()
+            if self._queued and not self._paused:
+                self._paused = True
+                self._protocol.pause_writing()
+        else:
+            self._send(data)
+            
+    def _send(self, data):
+        self._credit -= len(data)
+        dataPacket = VNICChannelDataPacket(channel=self._channelId, data=data)
+        self._multiplexer.transport.write(dataPacket.__serialize__())
+        
+    def _flush(self):
+        while self._queue and self._credit > 0:
+            data = self._queue.popleft()
+            if len(data) > self._credit:
+                self._queue.appendleft(data[self._credit:])
+                data = data[:self._credit]
+            self._queued -= len(data)
+            self._send(data)
+            
+    def addCredit(self, credit):
+        self._credit += credit
+        self._flush()
+        if self._paused and not self._queued:
+            self._paused = False
+            self._protocol.resume_writing()
+        if self._closing and not self._queued:
+            self._connectionLost(notify=True)
+            
+    def is_reading(self):
+        return not self._readPaused
+        
+    def pause_reading(self):
+        self._readPaused = True
+        
+    def resume_reading(self):
+        if not self._readPaused: return
+        self._readPaused = False
+        while self._received and not self._readPaused:
+            self.dataReceived(self._received.popleft())
+        
+    def dataReceived(self, data):
+        if self._lost: return
+        if self._readPaused:
+            self._received.append(data)
+            return
+        self._protocol.data_received(data)
+        self._consumed += len(data)
+        if self._consumed >= self._window//2 and not self._lost:
+            creditPacket = VNICChannelCreditPacket(channel=self._channelId, credit=self._consumed)
+            self._consumed = 0
+            self._multiplexer.transport.write(creditPacket.__serialize__())
+        
+    def close(self):
+        # like a socket transport, queued data is still sent before closing
+        if self._closing: return
+        self._closing = True
+        if not self._queued:
+            self._connectionLost(notify=True)
+            
+    def abort(self):
+        self._closing = True
+        self._connectionLost(notify=True)
+        
+    def remoteClosed(self):
+        """
+        The other side closed the channel, or the control connection was lost.
+        """
+        self._closing = True
+        self._connectionLost(notify=False)
+        
+    def _connectionLost(self, notify):
+        if self._lost: return
+        self._lost = True
+        self._queue.clear()
+        self._queued = 0
+        self._received.clear()
+        self._multiplexer.channelClosed(self._channelId, notify)
+        asyncio.get_event_loop().call_soon(self._protocol.connection_lost, None)
+
 class VNICSocketControlProtocol(Protocol):
     
     ERROR_UNKNOWN = Constant(strValue="An Unknown Error", intValue=255)
     ERROR_BUSY    = Constant(strValue="Port is not available", intValue=1)
     
-    def __init__(self, vnic):
+    def __init__(self, vnic, window=None):
         self._vnic = vnic
         self._deserializer = PacketType.Deserializer()
         self._control = {}
         self.transport = None
         self._dumping = False
+        self._dumpSession = None
+        
+        # multiplexed mode. Off until the client asks for it.
+        self._window = window or MultiplexedChannel.DEFAULT_WINDOW
+        self._peerWindow = None
+        self._channels = {}
+        self._nextChannelId = 0
         
     def controlLost(self, controlId):
         if controlId in self._control:
@@ -156,6 +401,21 @@ class VNICSocketControlProtocol(Protocol):
     def device(self):
         return self._vnic
         
+    def multiplexed(self):
+        return self._peerWindow != None
+        
+    def openChannel(self, protocol):
+        self._nextChannelId += 1
+        channel = MultiplexedChannel(self, self._nextChannelId, protocol, self._peerWindow, self._window)
+        self._channels[self._nextChannelId] = channel
+        protocol.connection_made(channel)
+        return self._nextChannelId
+        
+    def channelClosed(self, channelId, notify):
+        self._channels.pop(channelId, None)
+        if notify and self.transport:
+            self.transport.write(VNICChannelClosePacket(channel=channelId).__serialize__())
+        
     def close(self):
         self.transport and self.transport.close()
         
@@ -163,11 +423,19 @@ class VNICSocketControlProtocol(Protocol):
         logger.debug("VNIC socket control spawn {}".format(self))
         self.transport = transport
         
+    def pause_writing(self):
+        # a dump connection that can't keep up catches up from the capture ring
+        self._dumpSession and self._dumpSession.pause()
+        
+    def resume_writing(self):
+        self._dumpSession and self._dumpSession.resume()
+        
     def connection_lost(self, reason=None):
         logger.debug("VNIC connection_lost {} for reason {}".format(self, reason))
         if self._dumping:
             self._vnic.stopDump(self)
             self._dumping = False
+            self._dumpSession = None
         for controlId in self._control:
             control = self._control[controlId]
             try:
@@ -176,24 +444,50 @@ class VNICSocketControlProtocol(Protocol):
                 pass
         self._control = {}
         self.transport = None
+        for channel in list(self._channels.values()):
+            channel.remoteClosed()
         
     def data_received(self, data):
         self._deserializer.update(data)
         for controlPacket in self._deserializer.nextPackets():
-            if isinstance(controlPacket, VNICSocketOpenPacket):
+            if isinstance(controlPacket, VNICChannelDataPacket):
+                channel = self._channels.get(controlPacket.channel, None)
+                channel and channel.dataReceived(controlPacket.data)
+            elif isinstance(controlPacket, VNICChannelCreditPacket):
+                channel = self._channels.get(controlPacket.channel, None)
+                channel and channel.addCredit(controlPacket.credit)
+            elif isinstance(controlPacket, VNICChannelClosePacket):
+                channel = self._channels.get(controlPacket.channel, None)
+                channel and channel.remoteClosed()
+            elif isinstance(controlPacket, VNICMultiplexPacket):
+                logger.info("{} switching control connection to multiplexed mode.".format(self._vnic))
+                self._peerWindow = controlPacket.window
+                self.transport.write(VNICMultiplexPacket(window=self._window).__serialize__())
+            elif isinstance(controlPacket, VNICSocketOpenPacket):
                 logger.info("{} received socket open operation.".format(self._vnic))
                 self.socketOpenReceived(controlPacket)
             elif isinstance(controlPacket, VNICSocketClosePacket):
                 logger.info("{} received socket close {} operation".format(self._vnic, controlPacket.ConnectionId))
                 self.controlLost(controlPacket.ConnectionId)
+            elif isinstance(controlPacket, VNICSocketOptionPacket):
+                control = self._control.get(controlPacket.ConnectionId, None)
+                if control and controlPacket.noDelay != FIELD_NOT_SET:
+                    control.setNoDelay(bool(controlPacket.noDelay))
             elif isinstance(controlPacket, VNICStartDumpPacket) and not self._dumping:
                 logger.info("{} received start dump operation.".format(self._vnic))
                 self._dumping = True
-                self._vnic.startDump(self) 
+                self._dumpSession = self._vnic.startDump(self) 
             elif isinstance(controlPacket, VNICStopDumpPacket) and self._dumping:
                 logger.info("{} received stop dump operation.".format(self._vnic))
                 self._dumping = False
+                self._dumpSession = None
                 self._vnic.stopDump(self) 
+            elif isinstance(controlPacket, VNICDumpFilterPacket) and self._dumping:
+                logger.info("{} received dump filter {}.".format(self._vnic, controlPacket.filter))
+                try:
+                    self._dumpSession.setFilter(controlPacket.filter)
+                except Exception as e:
+                    logger.info("{} rejected dump filter because {}".format(self._vnic, e))
             elif isinstance(controlPacket, WirePacket):
                 logger.debug("{} received raw wire for dump mode connection.".format(self._vnic))
                 outboundKey = PortKey(controlPacket.source, controlPacket.sourcePort, 
@@ -233,12 +527,18 @@ class VNICSocketControlProtocol(Protocol):
                                     self)
             self._control[openSocketPacket.ConnectionId] = control
             connectData = openSocketPacket.connectData
+            if connectData.awaitResponse != FIELD_NOT_SET:
+                control.setAwaitResponse(connectData.awaitResponse/1000.0)
             port = self._vnic.createOutboundSocket(control, 
                                                     connectData.destination,
                                                     connectData.destinationPort)
             if port != None:
                 resp.port      = port
                 control.setPort(port)
+                if connectData.initialData != FIELD_NOT_SET and connectData.initialData:
+                    # sent now, without waiting for the callback to be set up
+                    portKey = PortKey(str(self._vnic.address()), port, connectData.destination, connectData.destinationPort)
+                    self._vnic.write(portKey, connectData.initialData, False)
             else:
                 resp.port         = 0
                 resp.errorCode    = int(self.ERROR_UNKNOWN)
@@ -265,7 +565,7 @@ class VNICSocketControlProtocol(Protocol):
         self.transport.write(resp.__serialize__())
 
                                         
-    def sendConnectionSpawned(self, connectionId, spawnTcpPort, portKey):
+    def sendConnectionSpawned(self, connectionId, spawnTcpPort, portKey, initialData=None):
         #logger.info("Spawning new connection for listener with resvId %d for %s %d on local TCP port %d" % 
         #            (resvId, dstAddr, dstPort, connPort))
         eventPacket = VNICConnectionSpawnedPacket(ConnectionId=connectionId,
@@ -274,19 +574,55 @@ class VNICSocketControlProtocol(Protocol):
                                                     sourcePort = portKey.sourcePort,
                                                     destination = portKey.destination,
                                                     destinationPort = portKey.destinationPort)
+        if initialData:
+            eventPacket.initialData = initialData
 
         self.transport.write(eventPacket.__serialize__())
+        
+    def sendChannelSpawned(self, connectionId, channelId, portKey, initialData=None):
+        eventPacket = VNICChannelSpawnedPacket(ConnectionId=connectionId,
+                                                channel = channelId,
+                                                source = portKey.source,
+                                                sourcePort = portKey.sourcePort,
+                                                destination = portKey.destination,
+                                                destinationPort = portKey.destinationPort)
+        if initialData:
+            eventPacket.initialData = initialData
+        self.transport.write(eventPacket.__serialize__())
 
 class VNICSocketControlClientProtocol(Protocol):
-    def __init__(self, callbackService):
+    def __init__(self, callbackService, multiplexed=False, window=None):
         self._connections = {}
         self._futures = {}
+        self._unclaimed = {}
         self._callbackService = callbackService
         self._connectionId = 0
         self._deserializer = VNICSocketControlPacket.Deserializer()
         self.transport=None 
+        
+        # Multiplexed mode is requested, but the callback service is still
+        # offered, so a VNIC without multiplexing falls back to callbacks.
+        self._multiplexed = multiplexed
+        self._window = window or MultiplexedChannel.DEFAULT_WINDOW
+        self._peerWindow = None
+        self._channels = {}
+        
+    def multiplexed(self):
+        return self._peerWindow != None
     
-    def connect(self, destination, destinationPort, applicationProtocolFactory):
+    def _sendNoDelay(self, connectionId):
+        # sent right after the open, so it is in effect before any data
+        optionPacket = VNICSocketOptionPacket(ConnectionId=connectionId, noDelay=1)
+        self.transport.write(optionPacket.__serialize__())
+        
+    def connect(self, destination, destinationPort, applicationProtocolFactory, noDelay=False, 
+                initialData=None, awaitResponse=None):
+        """
+        initialData is sent by the VNIC as-is (below any protocol stack)
+        as soon as it opens the port. With awaitResponse (seconds), the
+        VNIC waits that long for the first response before completing
+        the connection, and sends the response along with it.
+        """
         self._connectionId += 1
         logger.debug("Requesting connect to {}:{} from vnic (connection ID {})".format(destination,
                                                                                        destinationPort,
@@ -297,15 +633,41 @@ class VNICSocketControlClientProtocol(Protocol):
                                                 callbackPort=callbackPort)
         openSocketPacket.connectData = openSocketPacket.SocketConnectData(destination=destination, 
                                                                           destinationPort=destinationPort)
+        if initialData:
+            openSocketPacket.connectData.initialData = initialData
+        if awaitResponse:
+            openSocketPacket.connectData.awaitResponse = min(int(awaitResponse*1000), 2**16-1)
         packetBytes = openSocketPacket.__serialize__()
         self.transport.write(packetBytes)
+        noDelay and self._sendNoDelay(self._connectionId)
         
         future = Future()
         self._connections[self._connectionId] = applicationProtocolFactory
         self._futures[self._connectionId] = ("connect", future) 
         return future
     
-    def listen(self, listenPort, applicationProtocolFactory):
+    def claim(self, connectionId, applicationProtocolFactory, noDelay=False):
+        """
+        A connection opened with no application protocol factory is
+        spawned but left idle. Claiming it attaches the application
+        protocol. Returns False if the connection has since closed.
+        """
+        spawnKey = self._unclaimed.pop(connectionId, None)
+        if spawnKey is None: return False
+        if not self._callbackService.claimCallback(spawnKey, applicationProtocolFactory):
+            return False
+        self._connections[connectionId] = applicationProtocolFactory
+        noDelay and self._sendNoDelay(connectionId)
+        return True
+        
+    def discard(self, connectionId):
+        """
+        Close an unclaimed connection
+        """
+        if self._unclaimed.pop(connectionId, None) is not None and self.transport:
+            self.close(connectionId)
+    
+    def listen(self, listenPort, applicationProtocolFactory, noDelay=False):
         self._connectionId += 1
         logger.debug("Requesting listenting socket on port {} from vnic (connection ID {})".format(listenPort,
                                                                                        self._connectionId))
@@ -316,6 +678,7 @@ class VNICSocketControlClientProtocol(Protocol):
         openSocketPacket.listenData = openSocketPacket.SocketListenData(sourcePort = listenPort)
         
         self.transport.write(openSocketPacket.__serialize__())
+        noDelay and self._sendNoDelay(self._connectionId)
         future = Future()
         self._connections[self._connectionId] = applicationProtocolFactory
         self._futures[self._connectionId] = ("listen", future) 
@@ -325,14 +688,33 @@ class VNICSocketControlClientProtocol(Protocol):
         logger.debug("Closing connection {}".format(connectionId))
         self.transport.write(VNICSocketClosePacket(ConnectionId=connectionId).__serialize__())
     
+    def channelClosed(self, channelId, notify):
+        self._channels.pop(channelId, None)
+        if notify and self.transport:
+            self.transport.write(VNICChannelClosePacket(channel=channelId).__serialize__())
+    
     def connection_made(self, transport):
         logger.info("{} setting transport {}".format(self, transport))
         self.transport=transport
+        if self._multiplexed:
+            self.transport.write(VNICMultiplexPacket(window=self._window).__serialize__())
     
     def data_received(self, data):
         self._deserializer.update(data)
         for packet in self._deserializer.nextPackets():
-            if isinstance(packet, VNICSocketOpenResponsePacket):
+            if isinstance(packet, VNICChannelDataPacket):
+                channel = self._channels.get(packet.channel, None)
+                channel and channel.dataReceived(packet.data)
+            elif isinstance(packet, VNICChannelCreditPacket):
+                channel = self._channels.get(packet.channel, None)
+                channel and channel.addCredit(packet.credit)
+            elif isinstance(packet, VNICChannelClosePacket):
+                channel = self._channels.get(packet.channel, None)
+                channel and channel.remoteClosed()
+            elif isinstance(packet, VNICMultiplexPacket):
+                logger.debug("VNIC accepted multiplexed mode with window {}".format(packet.window))
+                self._peerWindow = packet.window
+            elif isinstance(packet, VNICSocketOpenResponsePacket):
                 logger.debug("Open callback for connection {}. Failure? {}".format(packet.ConnectionId, packet.isFailure()))
                 if not packet.ConnectionId in self._futures:
                     logger.debug("No such connection ID {}. Ignoring.".format(packet.ConnectionId))
@@ -350,43 +732,82 @@ class VNICSocketControlClientProtocol(Protocol):
                     future.set_result((packet.ConnectionId, packet.port))
                     
             elif isinstance(packet, VNICConnectionSpawnedPacket):
-                if packet.ConnectionId in self._futures:
-                    futureType, future = self._futures[packet.ConnectionId]
-                else:
-                    futureType = "listen"
-                logger.info("Connect {} callback {}:{} -> {}:{}".format(packet.ConnectionId,
-                                                                        packet.source, packet.sourcePort,
-                                                                        packet.destination, packet.destinationPort))
-                applicationProtocolFactory = self._connections[packet.ConnectionId]
-                self._callbackService.completeCallback(packet.ConnectionId, futureType, 
-                                                       applicationProtocolFactory(),
-                                                        packet.spawnTcpPort, 
-                                                        packet.source, packet.sourcePort, 
-                                                        packet.destination, packet.destinationPort)
-                if futureType == "connect":
-                    # A connect is done after a spawn. The listening socket is not.
-                    del self._futures[packet.ConnectionId]
-                    future.set_result((packet.ConnectionId, packet.sourcePort))
+                spawnKey = packet.spawnTcpPort
+                if spawnKey == 0:
+                    # unix domain callback. There is no port; use the header key.
+                    spawnKey = UnixSpawnKey(packet.source, packet.sourcePort, packet.destination, packet.destinationPort)
+                self._connectionSpawned(packet, spawnKey)
+                
+            elif isinstance(packet, VNICChannelSpawnedPacket):
+                # channels stand in for the spawned TCP connection. Key them
+                # so they cannot collide with real spawn ports.
+                spawnKey = "channel-{}".format(packet.channel)
+                dataProtocol = VNICCallbackProtocol(self._callbackService)
+                channel = MultiplexedChannel(self, packet.channel, dataProtocol, self._peerWindow, self._window,
+                                             {"spawnport":spawnKey})
+                self._channels[packet.channel] = channel
+                self._connectionSpawned(packet, spawnKey, dataProtocol, channel)
+                
+    def _connectionSpawned(self, packet, spawnKey, dataProtocol=None, channel=None):
+        if packet.ConnectionId in self._futures:
+            futureType, future = self._futures[packet.ConnectionId]
+        else:
+            futureType = "listen"
+        logger.info("Connect {} callback {}:{} -> {}:{}".format(packet.ConnectionId,
+                                                                packet.source, packet.sourcePort,
+                                                                packet.destination, packet.destinationPort))
+        applicationProtocolFactory = self._connections[packet.ConnectionId]
+        applicationProtocol = applicationProtocolFactory and applicationProtocolFactory()
+        if not applicationProtocol:
+            # pre-spawned. The application protocol is attached by claim()
+            self._unclaimed[packet.ConnectionId] = spawnKey
+        initialData = packet.initialData if packet.initialData != FIELD_NOT_SET else None
+        self._callbackService.completeCallback(packet.ConnectionId, futureType, 
+                                               applicationProtocol,
+                                                spawnKey, 
+                                                packet.source, packet.sourcePort, 
+                                                packet.destination, packet.destinationPort,
+                                                initialData)
+        if dataProtocol:
+            dataProtocol.connection_made(channel)
+        if futureType == "connect":
+            # A connect is done after a spawn. The listening socket is not.
+            del self._futures[packet.ConnectionId]
+            future.set_result((packet.ConnectionId, packet.sourcePort))
         
     def connection_lost(self, reason=None):
         logger.info("Connection Lost - VNIC Connect Protocol. Reason = {}.".format(reason))
+        for channel in list(self._channels.values()):
+            channel.remoteClosed()
         
 class VNICCallbackProtocol(StackingProtocol):
+    # Data that arrives before the application is connected is held
+    # here. Past MAX_BACKLOG bytes, reading is paused until then.
+    MAX_BACKLOG = 1024*1024
+    
     def __init__(self, callbackService):
         super().__init__(None)
         self.transport = None
         self._callbackService = callbackService
         self._spawnPort = None
-        self._backlog = []
+        self._spawnHeader = None
+        self._backlog = collections.deque()
+        self._backlogSize = 0
+        self._readingPaused = False
         self._higherConnectionMade = False
         
     def connection_made(self, transport):
         super().connection_made(transport)
         self.transport = transport
-        self._spawnPort = transport.get_extra_info("peername")[1]
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family == socket.AF_UNIX:
+            # the spawn key arrives as a header at the start of the data
+            self._spawnHeader = b""
+            return
+        self._spawnPort = transport.get_extra_info("spawnport") or transport.get_extra_info("peername")[1]
         self._callbackService.newDataConnection(self._spawnPort, self)
         
-    def setPlaygroundConnectionInfo(self, stack, application, source, sourcePort, destination, destinationPort):
+    def setPlaygroundConnectionInfo(self, stack, application, source, sourcePort, destination, destinationPort, initialData=None):
         self.setHigherProtocol(stack)
         nextTransport = StackingTransport(self.transport, {"sockname":(source, sourcePort),
                                                             "peername":(destination, destinationPort),
@@ -398,20 +819,39 @@ class VNICCallbackProtocol(StackingProtocol):
         logger.debug("Creating tranport for higher protocol {} with spawnport {}".format(self.higherProtocol(), self._spawnPort))
         self.higherProtocol().connection_made(nextTransport)
         self._higherConnectionMade = True
-        while self._backlog:
-            self.higherProtocol().data_received(self._backlog.pop(0))
+        if initialData:
+            # came with the spawn notification, ahead of anything on this connection
+            self._backlog.appendleft(initialData)
+        if self._backlog:
+            backlog = b"".join(self._backlog)
+            self._backlog.clear()
+            self._backlogSize = 0
+            self.higherProtocol().data_received(backlog)
+        if self._readingPaused:
+            self._readingPaused = False
+            self.transport.resume_reading()
 
     def connection_lost(self, reason=None):
         logger.debug("low level connection_lost for callback port {}, reason={}".format(self._spawnPort, reason))
         super().connection_lost(reason)
         #self.higherProtocol().transport.close()
-        self.higherProtocol().connection_lost(reason)
+        # an unclaimed (pre-spawned) connection has no higher protocol
+        self.higherProtocol() and self.higherProtocol().connection_lost(reason)
         # Checking the log so that we can ensure _spawnPort is always set
         logger.debug("Connection Lost towards higher protocol for connection initiated through spawned port {}".format(self._spawnPort))
         if self._spawnPort:
             self._callbackService.dataConnectionClosed(self, self._spawnPort)
             
     def data_received(self, buf):
+        if self._spawnPort == None and self._spawnHeader != None:
+            spawnKey, buf = DecodeSpawnHeader(self._spawnHeader + buf)
+            if spawnKey == None:
+                self._spawnHeader = buf
+                return
+            self._spawnPort = spawnKey
+            self._spawnHeader = None
+            self._callbackService.newDataConnection(self._spawnPort, self)
+            if not buf: return
         if self._higherConnectionMade:
             logger.debug("Pushing data to application, data received on {}".format(self._spawnPort)) 
             if self.higherProtocol():
@@ -421,14 +861,37 @@ class VNICCallbackProtocol(StackingProtocol):
                     logger.debug("Could not push data to application because {}.".format(e))
         else:
             self._backlog.append(buf)
+            self._backlogSize += len(buf)
+            if self._backlogSize >= self.MAX_BACKLOG and not self._readingPaused:
+                logger.debug("Backlog full on {}. Pausing reading".format(self._spawnPort))
+                self._readingPaused = True
+                self.transport.pause_reading()
+            
+    def _applicationProtocol(self):
+        p = self.higherProtocol()
+        while isinstance(p, StackingProtocol) and p.higherProtocol():
+            p = p.higherProtocol()
+        return p
+            
+    def pause_writing(self):
+        # pass back pressure from the data connection (or channel) to the application
+        application = self._higherConnectionMade and self._applicationProtocol()
+        application and application.pause_writing()
+        
+    def resume_writing(self):
+        application = self._higherConnectionMade and self._applicationProtocol()
+        application and application.resume_writing()
             
 class VNICDumpProtocol(Protocol):
-    def __init__(self):
+    def __init__(self, filter=None):
         self.transport = None
+        self.filter = filter
         
     def connection_made(self, transport):
         self.transport = transport
         self.transport.write(VNICStartDumpPacket().__serialize__())
+        if self.filter:
+            self.transport.write(VNICDumpFilterPacket(filter=self.filter).__serialize__())
         
     def data_received(self, data):
         pass
@@ -458,3 +921,174 @@ class VNICPromiscuousControl(Protocol):
             self.transport.close()
             self.transport=None
             break
+
+def basicUnitTest():
+    from playground.network.devices import VNIC
+    from playground.network.devices.vnic.connect import CallbackService
+    from playground.network.testing import MockTransportToProtocol, MockTransportToStorageStream
+    from playground.network.protocols.packets.switching_packets import WirePacket
+    import io
+    
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    
+    class ApplicationProtocol(Protocol):
+        def __init__(self):
+            self.transport = None
+            self.received = []
+            self.paused = False
+            self.lost = False
+        def connection_made(self, transport):
+            self.transport = transport
+        def data_received(self, data):
+            self.received.append(data)
+        def pause_writing(self):
+            self.paused = True
+        def resume_writing(self):
+            self.paused = False
+        def connection_lost(self, reason=None):
+            self.lost = True
+    
+    vnic = VNIC("1.1.1.1")
+    linkTx = vnic.switchConnectionFactory()
+    wire = io.BytesIO()
+    linkTx.connection_made(MockTransportToStorageStream(wire))
+    
+    # a small client window forces credit to be returned several times
+    server = VNICSocketControlProtocol(vnic, window=100)
+    client = VNICSocketControlClientProtocol(CallbackService("127.0.0.1", 0, (None, None)), 
+                                             multiplexed=True, window=10)
+    clientTransport, serverTransport = MockTransportToProtocol.CreateTransportPair(client, server)
+    server.connection_made(serverTransport)
+    client.connection_made(clientTransport)
+    assert client.multiplexed() and server.multiplexed()
+    
+    application = ApplicationProtocol()
+    future = client.connect("2.2.2.2", 101, lambda: application)
+    connectionId, port = loop.run_until_complete(future)
+    assert application.transport.get_extra_info("peername") == ("2.2.2.2", 101)
+    
+    def sentData():
+        deserializer = WirePacket.Deserializer()
+        deserializer.update(wire.getvalue())
+        return [packet.data for packet in deserializer.nextPackets() if isinstance(packet, WirePacket)]
+    
+    # application data goes out to the switch
+    application.transport.write(b"request")
+    assert sentData() == [b"request"]
+    
+    # inbound data is delivered within the client's credit
+    vnic.demux("2.2.2.2", 101, "1.1.1.1", port, b"x"*35)
+    assert b"".join(application.received) == b"x"*35
+    assert max(len(data) for data in application.received) <= 10
+    
+    # without credit, the application is paused until the VNIC grants more
+    clientChannel = list(client._channels.values())[0]
+    clientChannel._credit = 0
+    application.transport.write(b"queued")
+    assert application.paused and clientChannel.get_write_buffer_size() == 6
+    clientChannel.addCredit(100)
+    assert not application.paused and sentData() == [b"request", b"queued"]
+    
+    # a channel that is not reading holds data and withholds credit
+    clientChannel.pause_reading()
+    application.received = []
+    vnic.demux("2.2.2.2", 101, "1.1.1.1", port, b"y"*10)
+    assert application.received == [] and not clientChannel.is_reading()
+    clientChannel.resume_reading()
+    assert b"".join(application.received) == b"y"*10
+    
+    # the callback protocol's backlog is bounded by pausing its transport
+    class CallbackServiceStub:
+        def newDataConnection(self, spawnPort, protocol): pass
+    callbackProtocol = VNICCallbackProtocol(CallbackServiceStub())
+    callbackProtocol.MAX_BACKLOG = 20
+    callbackTransport = MockTransportToStorageStream(io.BytesIO(), extra={"peername":("127.0.0.1", 9000)})
+    callbackProtocol.connection_made(callbackTransport)
+    for i in range(3):
+        callbackProtocol.data_received(b"z"*10)
+    assert not callbackTransport.reading
+    backlogApplication = ApplicationProtocol()
+    callbackProtocol.setPlaygroundConnectionInfo(None, backlogApplication, "1.1.1.1", 2000, "2.2.2.2", 101)
+    assert backlogApplication.received == [b"z"*30] and callbackTransport.reading
+    
+    # closing the application closes the VNIC connection
+    application.transport.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert application.lost
+    assert len(client._channels) == 0 and len(server._channels) == 0
+    assert len(vnic._connections) == 0
+    
+    # a connection opened without a factory waits, unclaimed, for claim()
+    connectionId, port = loop.run_until_complete(client.connect("2.2.2.2", 103, None))
+    vnic.demux("2.2.2.2", 103, "1.1.1.1", port, b"early")
+    pooledApplication = ApplicationProtocol()
+    assert client.claim(connectionId, lambda: pooledApplication)
+    assert not client.claim(connectionId, lambda: pooledApplication)
+    assert pooledApplication.transport.get_extra_info("peername") == ("2.2.2.2", 103)
+    assert pooledApplication.received == [b"early"]
+    pooledApplication.transport.close()
+    
+    # discarding an unclaimed connection closes it
+    connectionId, port = loop.run_until_complete(client.connect("2.2.2.2", 104, None))
+    client.discard(connectionId)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not client.claim(connectionId, lambda: pooledApplication)
+    assert len(vnic._connections) == 0 and len(client._channels) == 0
+    
+    # initial data goes out with the open; the first response comes back with the spawn
+    application = ApplicationProtocol()
+    future = client.connect("2.2.2.2", 105, lambda: application, initialData=b"hello", awaitResponse=1)
+    assert sentData()[-1] == b"hello"
+    loop.run_until_complete(asyncio.sleep(0))
+    assert not future.done()
+    port = [portKey.sourcePort for portKey in vnic._connections if portKey.destinationPort == 105][0]
+    vnic.demux("2.2.2.2", 105, "1.1.1.1", port, b"world")
+    vnic.demux("2.2.2.2", 105, "1.1.1.1", port, b"!")
+    loop.run_until_complete(future)
+    assert application.received == [b"world", b"!"]
+    application.transport.close()
+    
+    # with no response, the connection completes when the wait is over
+    application = ApplicationProtocol()
+    future = client.connect("2.2.2.2", 106, lambda: application, awaitResponse=.01)
+    loop.run_until_complete(future)
+    assert application.transport and application.received == []
+    application.transport.close()
+    loop.run_until_complete(asyncio.sleep(0))
+    assert len(vnic._connections) == 0
+    
+    # callback connections over a unix domain socket
+    import tempfile, os
+    socketDirectory = tempfile.mkdtemp()
+    callbackPath = os.path.join(socketDirectory, "callback.sock")
+    callbackService = CallbackService(UNIX_CALLBACK_PREFIX+callbackPath, 0, (None, None))
+    loop.run_until_complete(loop.create_unix_server(lambda: VNICCallbackProtocol(callbackService), path=callbackPath))
+    
+    wire.seek(0)
+    wire.truncate()
+    server = VNICSocketControlProtocol(vnic)
+    client = VNICSocketControlClientProtocol(callbackService)
+    clientTransport, serverTransport = MockTransportToProtocol.CreateTransportPair(client, server)
+    server.connection_made(serverTransport)
+    client.connection_made(clientTransport)
+    
+    application = ApplicationProtocol()
+    connectionId, port = loop.run_until_complete(client.connect("2.2.2.2", 102, lambda: application))
+    assert application.transport.get_extra_info("spawnport") == UnixSpawnKey("1.1.1.1", port, "2.2.2.2", 102)
+    vnic.demux("2.2.2.2", 102, "1.1.1.1", port, b"over unix")
+    application.transport.write(b"unix request")
+    loop.run_until_complete(asyncio.sleep(.1))
+    assert application.received == [b"over unix"]
+    assert sentData() == [b"unix request"]
+    
+    application.transport.close()
+    loop.run_until_complete(asyncio.sleep(.1))
+    assert application.lost and len(vnic._connections) == 0
+    os.unlink(callbackPath)
+    os.rmdir(socketDirectory)
+    loop.close()
+    
+if __name__ == "__main__":
+    basicUnitTest()
+    print("Basic unit test completed successfully.")
@@ -9,6 +9,13 @@ class MockTransportBase(Transport):
         self.sink = None
         self.protocol = myProtocol
         self.closed = False
+        self.reading = True
+        
+    def pause_reading(self):
+        self.reading = False
+        
+    def resume_reading(self):
+        self.reading = True
         
     def setMyProtocol(self, protocol):
         self.protocol = protocol
@@ -46,7 +53,7 @@ class MockTransportBase(Transport):
             self._close(*args)
             
     def get_extra_info(self, key, default=None):
-        return default
+        return self._extra.get(key, default)
 
 class MockTransportToProtocol(MockTransportBase):
     @classmethod
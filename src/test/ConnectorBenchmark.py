@@ -0,0 +1,166 @@
+'''
+Measures playground connection setup through PlaygroundConnector
+against an in-process VNIC: many create_playground_connection calls
+are started at once on a fresh connector (so they all race to open
+the callback service and the VNIC control connection). With
+--sequential, the connections are instead short-lived and opened one
+after another to the same destination; --pool=N (implies --sequential)
+takes them from a pool of N pre-spawned connections.
+
+--first-byte measures time to first byte against an echo: a request
+written on connection_made, vs. the request sent with the open and
+the response returned with the spawn.
+
+Usage: python -m test.ConnectorBenchmark [--connections=N] [--multiplexed] [--sequential] [--pool=N]
+                                         [--first-byte]
+'''
+
+from playground.network.devices.vnic.VNIC import VNIC
+from playground.network.devices.vnic.connect import PlaygroundConnector
+from playground.network.common import PlaygroundAddress
+from asyncio import Protocol
+import asyncio, sys, time
+
+class BenchmarkVnicService:
+    def __init__(self, address, location):
+        self._address = address
+        self._location = location
+    def getDefaultVnic(self):
+        return "benchmark"
+    def getVnicByDestination(self, destination, destinationPort):
+        return "benchmark"
+    def getVnicPlaygroundAddress(self, vnicName):
+        return PlaygroundAddress.FromString(self._address)
+    def getVnicTcpLocation(self, vnicName):
+        return self._location
+    def getVnicUnixLocation(self, vnicName):
+        return None
+    def getUnixSocketDirectory(self):
+        return None
+
+class NullProtocol(Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+    def data_received(self, data):
+        pass
+
+class EchoLink:
+    """
+    Stands in for the VNIC's switch connection. Whatever is sent
+    comes back on the next loop iteration, as if from an echo server.
+    """
+    def __init__(self, vnic):
+        self._vnic = vnic
+        self.transport = self
+    def write(self, source, sourcePort, destination, destinationPort, data):
+        asyncio.get_event_loop().call_soon(self._vnic.demux, destination, destinationPort, source, sourcePort, data)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values)*p), len(values)-1)]
+
+async def benchmark(connectionCount, multiplexed, sequential, poolSize):
+    loop = asyncio.get_event_loop()
+    vnic = VNIC("1.1.1.1")
+    server = await loop.create_server(vnic.controlConnectionFactory, "127.0.0.1", 0)
+    location = server.sockets[0].getsockname()[:2]
+    connector = PlaygroundConnector(vnicService=BenchmarkVnicService("1.1.1.1", location), multiplexed=multiplexed,
+                                    poolSize=poolSize)
+
+    async def timedConnection(port):
+        start = time.perf_counter()
+        transport, protocol = await connector.create_playground_connection(NullProtocol, "2.2.2.2", port)
+        return time.perf_counter() - start, transport
+
+    start = time.perf_counter()
+    if sequential:
+        # short-lived connections to one destination. The first one fills any pool.
+        transport = (await timedConnection(1000))[1]
+        transport.close()
+        await asyncio.sleep(.5)
+        start = time.perf_counter()
+        latencies = []
+        for i in range(connectionCount):
+            latency, transport = await timedConnection(1000)
+            latencies.append(latency)
+            transport.close()
+    else:
+        results = await asyncio.gather(*[timedConnection(1000+i) for i in range(connectionCount)])
+        latencies = [latency for latency, transport in results]
+        for latency, transport in results:
+            transport.close()
+    elapsed = time.perf_counter() - start
+    server.close()
+    return {
+        "p50 (ms)":      percentile(latencies, .5)*1000,
+        "p99 (ms)":      percentile(latencies, .99)*1000,
+        "max (ms)":      max(latencies)*1000,
+        "connections/s": connectionCount/elapsed,
+    }
+
+async def benchmarkFirstByte(connectionCount, multiplexed):
+    loop = asyncio.get_event_loop()
+    vnic = VNIC("1.1.1.1")
+    vnic._linkTx = EchoLink(vnic)
+    server = await loop.create_server(vnic.controlConnectionFactory, "127.0.0.1", 0)
+    location = server.sockets[0].getsockname()[:2]
+    connector = PlaygroundConnector(vnicService=BenchmarkVnicService("1.1.1.1", location), multiplexed=multiplexed)
+    
+    async def timedFirstByte(fastOpen):
+        received = loop.create_future()
+        class RequestProtocol(Protocol):
+            def connection_made(self, transport):
+                self.transport = transport
+                fastOpen or transport.write(b"request")
+            def data_received(self, data):
+                received.done() or received.set_result(time.perf_counter())
+        start = time.perf_counter()
+        options = fastOpen and {"initialData":b"request", "awaitResponse":1} or {}
+        transport, protocol = await connector.create_playground_connection(RequestProtocol, "2.2.2.2", 1000, **options)
+        firstByte = await received
+        transport.close()
+        return firstByte - start
+        
+    results = {}
+    for fastOpen in (False, True, False, True):
+        # the first run of each warms things up
+        latencies = [await timedFirstByte(fastOpen) for i in range(connectionCount)]
+        name = fastOpen and "fast open" or "write on connect"
+        results[name+" p50 (ms)"] = percentile(latencies, .5)*1000
+        results[name+" p99 (ms)"] = percentile(latencies, .99)*1000
+    server.close()
+    return results
+
+def main():
+    options = {"--connections": "1000"}
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            k, v = arg.split("=")
+            options[k] = v
+        else:
+            options[arg] = True
+    connectionCount = int(options["--connections"])
+    multiplexed = "--multiplexed" in options
+    poolSize = int(options.get("--pool", 0))
+    sequential = poolSize or "--sequential" in options
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if "--first-byte" in options:
+        results = loop.run_until_complete(benchmarkFirstByte(connectionCount, multiplexed))
+        loop.close()
+        print("Time to first byte, {} connections{}".format(connectionCount, multiplexed and " (multiplexed)" or ""))
+        for key in results:
+            print("\t{:<26} {:8.2f}".format(key, results[key]))
+        return
+    results = loop.run_until_complete(benchmark(connectionCount, multiplexed, sequential, poolSize))
+    loop.close()
+
+    print("{} {} connections{}{}".format(connectionCount, sequential and "sequential" or "concurrent",
+                                         multiplexed and " (multiplexed)" or "",
+                                         poolSize and ", pool of {}".format(poolSize) or ""))
+    for key in results:
+        print("\t{:<14} {:10.1f}".format(key, results[key]))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,85 @@
+'''
+Measures VNIC.demux throughput with many concurrent connections:
+a single busy flow, all flows round-robin, and with a dumper attached
+(capturing everything, or filtering everything out).
+
+Usage: python -m test.DemuxBenchmark [--connections=N] [--packets=N]
+'''
+
+from playground.network.devices.vnic.VNIC import VNIC
+import sys, time
+
+class NullTransport:
+    def write(self, data):
+        pass
+    def writelines(self, data):
+        pass
+    def close(self):
+        pass
+
+class NullProtocol:
+    def __init__(self):
+        self.transport = NullTransport()
+
+class NullControl:
+    def spawnConnection(self, portKey):
+        pass
+    def isListener(self):
+        return False
+
+class NullDumper:
+    def __init__(self):
+        self.transport = NullTransport()
+
+def setup(connectionCount):
+    vnic = VNIC("1.1.1.1")
+    control = NullControl()
+    flows = []
+    for i in range(connectionCount):
+        # spread the remote side over many addresses and ports
+        destination = "2.2.{}.{}".format(i // 250, i % 250)
+        destinationPort = 100 + (i % 1000)
+        port = vnic.createOutboundSocket(control, destination, destinationPort)
+        flows.append((destination, destinationPort, "1.1.1.1", port))
+    for portKey in list(vnic._connections.keys()):
+        vnic.spawnConnection(portKey, NullProtocol())
+    return vnic, flows
+
+def run(vnic, flows, packetCount):
+    data = b"x"*100
+    demux = vnic.demux
+    flowCount = len(flows)
+    start = time.perf_counter()
+    for i in range(packetCount):
+        source, sourcePort, destination, destinationPort = flows[i % flowCount]
+        demux(source, sourcePort, destination, destinationPort, data)
+    return packetCount / (time.perf_counter() - start)
+
+def main():
+    options = {"--connections": "10000", "--packets": "1000000"}
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            k, v = arg.split("=")
+            options[k] = v
+    connectionCount = int(options["--connections"])
+    packetCount = int(options["--packets"])
+
+    vnic, flows = setup(connectionCount)
+    print("{} connections, {} packets per run".format(connectionCount, packetCount))
+
+    results = {}
+    results["single flow"] = run(vnic, flows[:1], packetCount)
+    results["round-robin"] = run(vnic, flows, packetCount)
+    dumper = NullDumper()
+    vnic.startDump(dumper)
+    results["dumper, 1 flow"] = run(vnic, flows[:1], packetCount)
+    results["dumper, all"] = run(vnic, flows, packetCount)
+    # the filter is checked before anything is serialized
+    vnic.startDump(dumper).setFilter("host 9.9.9.9")
+    results["filtered out"] = run(vnic, flows, packetCount)
+
+    for key in results:
+        print("\t{:<16} {:12,.0f} packets/s".format(key, results[key]))
+
+if __name__=="__main__":
+    main()
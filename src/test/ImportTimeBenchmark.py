@@ -0,0 +1,79 @@
+'''
+Measures import time for the playground entry points with
+"python -X importtime", in fresh interpreters, and checks it against
+a budget. Each target also lists modules it must not import; those
+checks don't depend on the machine, the time budgets do.
+
+Exits non-zero if any target goes over budget.
+
+Usage: python -m test.ImportTimeBenchmark [--runs=N] [--scale=FACTOR] [--verbose]
+
+--scale multiplies the time budgets (for slow machines). --verbose
+prints the slowest modules imported by each target.
+'''
+
+import os, subprocess, sys
+
+# (module, time budget in ms, modules it must not import)
+TARGETS = [
+    ("playground",                                   60, ["asyncio", "playground.network"]),
+    ("playground.network.devices.pnms.pnetworking", 140, ["playground.network.devices.switch",
+                                                          "playground.network.devices.vnic.connect"]),
+    ("playground.network.devices.vnic.VNIC",         150, ["playground.network.devices.vnic.connect",
+                                                          "playground.network.devices.pnms"]),
+]
+
+def importTimes(module):
+    """
+    Returns {module name: cumulative microseconds} for one import of
+    module in a new interpreter.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.getcwd()] + [p for p in [env.get("PYTHONPATH")] if p])
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env, check=True)
+    times = {}
+    for line in result.stderr.decode().splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line: continue
+        selfTime, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit(): continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+def imported(times, module):
+    return any(name == module or name.startswith(module+".") for name in times)
+
+def main():
+    options = {"--runs": "5", "--scale": "1.0"}
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            k, v = arg.split("=")
+            options[k] = v
+        else:
+            options[arg] = True
+    runs = int(options["--runs"])
+    scale = float(options["--scale"])
+
+    failures = 0
+    for module, budget, forbidden in TARGETS:
+        # best of N. Noise only ever adds time.
+        samples = [importTimes(module) for i in range(runs)]
+        best = min(samples, key=lambda times: times[module])
+        elapsed = best[module]/1000
+        overBudget = elapsed > budget*scale
+        forbiddenImports = [name for name in forbidden if imported(best, name)]
+        status = (overBudget or forbiddenImports) and "FAIL" or "ok"
+        failures += status == "FAIL"
+
+        print("{:<46} {:8.1f} ms (budget {:.0f}) {}".format(module, elapsed, budget*scale, status))
+        for name in forbiddenImports:
+            print("\timports {}".format(name))
+        if "--verbose" in options:
+            slowest = sorted(best.items(), key=lambda item: -item[1])[1:11]
+            for name, cumulative in slowest:
+                print("\t{:<46} {:8.1f} ms".format(name, cumulative/1000))
+    sys.exit(failures and 1 or 0)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,193 @@
+'''
+Measures what each layer of a protocol stack costs. Two stacks of N
+layers (StackingProtocolFactory.CreateFactoryType) are connected over a
+MockTransportToProtocol pair. The application on one side writes, and
+the application on the other receives.
+
+For each layer type, stack height, and payload size:
+  ns/op      time per application write, through both stacks
+  ns/layer   increase over an empty stack, per layer
+  bytes/op   tracemalloc peak during one write, above what was allocated
+             before it (roughly, the copies of the data made on the way)
+  blocks/op  blocks still allocated after the run, per write (retention)
+
+Layer types:
+  passthrough  a plain StackingTransport; data passes unchanged
+  framing      a length prefix, and a reassembly buffer on receive
+  packet       data wrapped in a PacketType, and a Deserializer on receive
+--layer=module:factory adds a StackingProtocol factory of your own.
+
+Payloads are small (64 bytes) and WirePacket-sized (the default switch
+MTU). With --max-layer-ns=N, exits non-zero if a layer costs more than N
+ns at the tallest stack.
+
+Usage: python -m test.StackBenchmark [--layers=1,2,4,8] [--writes=N] [--layer=module:factory]
+                                     [--max-layer-ns=N]
+'''
+
+from playground.network.common import StackingProtocol, StackingProtocolFactory, StackingTransport
+from playground.network.testing import MockTransportToProtocol
+from playground.network.protocols.switching import PlaygroundSwitchTxProtocol
+from playground.network.packet import PacketType
+from playground.network.packet.fieldtypes import BUFFER
+from asyncio import Protocol
+import gc, importlib, sys, time, tracemalloc
+
+class PassthroughProtocol(StackingProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+        self.higherProtocol().connection_made(StackingTransport(transport))
+    def data_received(self, data):
+        self.higherProtocol().data_received(data)
+    def connection_lost(self, exc):
+        self.higherProtocol().connection_lost(exc)
+
+class FramingTransport(StackingTransport):
+    def write(self, data):
+        self.lowerTransport().write(len(data).to_bytes(4, "big") + data)
+
+class FramingProtocol(PassthroughProtocol):
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+    def connection_made(self, transport):
+        self.transport = transport
+        self.higherProtocol().connection_made(FramingTransport(transport))
+    def data_received(self, data):
+        self._buffer += data
+        while len(self._buffer) >= 4:
+            size = int.from_bytes(self._buffer[:4], "big")
+            if len(self._buffer) < 4+size: break
+            frame = bytes(self._buffer[4:4+size])
+            del self._buffer[:4+size]
+            self.higherProtocol().data_received(frame)
+
+class BenchmarkPacket(PacketType):
+    DEFINITION_IDENTIFIER = "test.StackBenchmark.BenchmarkPacket"
+    DEFINITION_VERSION    = "1.0"
+    FIELDS = [
+        ("data", BUFFER)
+    ]
+
+class PacketTransport(StackingTransport):
+    def write(self, data):
+        self.lowerTransport().write(BenchmarkPacket(data=data).__serialize__())
+
+class PacketProtocol(PassthroughProtocol):
+    def __init__(self):
+        super().__init__()
+        self._deserializer = BenchmarkPacket.Deserializer()
+    def connection_made(self, transport):
+        self.transport = transport
+        self.higherProtocol().connection_made(PacketTransport(transport))
+    def data_received(self, data):
+        self._deserializer.update(data)
+        for packet in self._deserializer.nextPackets():
+            self.higherProtocol().data_received(packet.data)
+
+class SinkProtocol(Protocol):
+    def __init__(self):
+        self.transport = None
+        self.received = 0
+    def connection_made(self, transport):
+        self.transport = transport
+    def data_received(self, data):
+        self.received += len(data)
+
+PAYLOADS = [("small", 64), ("WirePacket", PlaygroundSwitchTxProtocol.MAX_MSG_SIZE)]
+
+def buildStack(application, layerFactory, layerCount):
+    if not layerCount:
+        return application
+    bottom = StackingProtocolFactory.CreateFactoryType(*([layerFactory]*layerCount))()()
+    top = bottom
+    while top.higherProtocol():
+        top = top.higherProtocol()
+    top.setHigherProtocol(application)
+    return bottom
+
+def connectedPair(layerFactory, layerCount):
+    sender, receiver = SinkProtocol(), SinkProtocol()
+    senderBottom = buildStack(sender, layerFactory, layerCount)
+    receiverBottom = buildStack(receiver, layerFactory, layerCount)
+    senderTransport, receiverTransport = MockTransportToProtocol.CreateTransportPair(senderBottom, receiverBottom)
+    senderBottom.connection_made(senderTransport)
+    receiverBottom.connection_made(receiverTransport)
+    return sender, receiver
+
+def measure(layerFactory, layerCount, payload, writes):
+    sender, receiver = connectedPair(layerFactory, layerCount)
+    write = sender.transport.write
+    for i in range(100):
+        write(payload)
+
+    start = time.perf_counter()
+    for i in range(writes):
+        write(payload)
+    elapsed = time.perf_counter() - start
+    if receiver.received != len(payload)*(writes+100):
+        raise Exception("Stack lost data: {} of {} bytes".format(receiver.received, len(payload)*(writes+100)))
+
+    tracemalloc.start()
+    peaks = []
+    for i in range(10):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        write(payload)
+        peaks.append(tracemalloc.get_traced_memory()[1] - current)
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    retentionWrites = min(writes, 1000)
+    for i in range(retentionWrites):
+        write(payload)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    retained = sum(stat.count_diff for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "filename"))
+    return {
+        "ns/op":     elapsed/writes*1e9,
+        "bytes/op":  sorted(peaks)[len(peaks)//2],
+        "blocks/op": retained/retentionWrites,
+    }
+
+def main():
+    options = {"--layers": "1,2,4,8", "--writes": "2000"}
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            k, v = arg.split("=", 1)
+            options[k] = v
+        else:
+            options[arg] = True
+    layerCounts = [int(n) for n in options["--layers"].split(",")]
+    writes = int(options["--writes"])
+    maxLayerNs = "--max-layer-ns" in options and float(options["--max-layer-ns"]) or None
+
+    layerTypes = [("passthrough", PassthroughProtocol), ("framing", FramingProtocol), ("packet", PacketProtocol)]
+    if "--layer" in options:
+        moduleName, factoryName = options["--layer"].split(":")
+        layerTypes.append((factoryName, getattr(importlib.import_module(moduleName), factoryName)))
+
+    failures = 0
+    for payloadName, payloadSize in PAYLOADS:
+        payload = b"x"*payloadSize
+        # fewer writes for big payloads. The per-op numbers are what matter.
+        payloadWrites = max(writes*64//payloadSize, 100)
+        baseline = measure(None, 0, payload, payloadWrites)
+        print("{} payload ({} bytes), {} writes".format(payloadName, payloadSize, payloadWrites))
+        print("\t{:<14} {:>6} {:>10} {:>10} {:>10} {:>10}".format("layer", "layers", "ns/op", "ns/layer", "bytes/op", "blocks/op"))
+        print("\t{:<14} {:>6} {:>10.0f} {:>10} {:>10} {:>10.2f}".format("(none)", 0, baseline["ns/op"], "",
+                                                                      baseline["bytes/op"], baseline["blocks/op"]))
+        for layerName, layerFactory in layerTypes:
+            for layerCount in layerCounts:
+                results = measure(layerFactory, layerCount, payload, payloadWrites)
+                perLayer = (results["ns/op"]-baseline["ns/op"])/layerCount
+                print("\t{:<14} {:>6} {:>10.0f} {:>10.0f} {:>10} {:>10.2f}".format(layerName, layerCount, results["ns/op"], perLayer,
+                                                                                results["bytes/op"], results["blocks/op"]))
+                if maxLayerNs and layerCount == max(layerCounts) and perLayer > maxLayerNs:
+                    print("\t\tover budget ({:.0f} ns/layer)".format(maxLayerNs))
+                    failures += 1
+    sys.exit(failures and 1 or 0)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,68 @@
+'''
+Compares the Timer backends (loop.call_later vs. TimingWheel)
+with a large number of timers.
+
+Usage: python -m test.TimerBenchmark [--timers=N] [--max-delay=SECONDS]
+'''
+
+from playground.common.Timer import Timer, Seconds, CallLaterBackend, TimingWheel
+import asyncio, random, sys, time
+
+def benchmark(backendType, timerCount, maxDelay):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    backend = backendType(loop)
+    rng = random.Random(0)
+    fired = [0]
+    def callback():
+        fired[0] += 1
+
+    results = {}
+    timers = [Timer(Seconds(rng.random()*maxDelay), callback, backend=backend) for i in range(timerCount)]
+
+    start = time.perf_counter()
+    for timer in timers:
+        timer.start()
+    results["start"] = time.perf_counter() - start
+
+    # extend half (the FragStorage pattern)
+    start = time.perf_counter()
+    for timer in timers[::2]:
+        timer.extend(Seconds(rng.random()*maxDelay))
+    results["extend"] = time.perf_counter() - start
+
+    # cancel and restart a quarter
+    start = time.perf_counter()
+    for timer in timers[1::4]:
+        timer.cancel()
+    results["cancel"] = time.perf_counter() - start
+    for timer in timers[1::4]:
+        timer.start()
+
+    start = time.perf_counter()
+    cpuStart = time.process_time()
+    while fired[0] < timerCount:
+        loop.run_until_complete(asyncio.sleep(maxDelay/20))
+    results["run (wall)"] = time.perf_counter() - start
+    results["run (cpu)"] = time.process_time() - cpuStart
+    loop.close()
+    return results
+
+def main():
+    options = {"--timers": "100000", "--max-delay": "2.0"}
+    for arg in sys.argv[1:]:
+        if "=" in arg:
+            k, v = arg.split("=")
+            options[k] = v
+    timerCount = int(options["--timers"])
+    maxDelay = float(options["--max-delay"])
+
+    print("{} timers, delays up to {} seconds (extended up to 2x)".format(timerCount, maxDelay))
+    for backendType in [CallLaterBackend, TimingWheel]:
+        results = benchmark(backendType, timerCount, maxDelay)
+        print("{}:".format(backendType.__name__))
+        for key in results:
+            print("\t{:<12} {:8.3f} s".format(key, results[key]))
+
+if __name__=="__main__":
+    main()